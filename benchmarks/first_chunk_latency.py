@@ -0,0 +1,103 @@
+"""
+Benchmark: latencia añadida entre la llegada del primer chunk y su aparición en pantalla.
+
+Simula un stream del SDK (mismo objeto GenerateContentResponse que devuelve la API) cuyo primer
+chunk llega tras --first-delay segundos y el segundo tras --gap segundos más. Mide, con el bucle
+real de turno (_stream_turn_attempt), cuánto tarda el texto del primer chunk en escribirse en
+stdout desde que el stream lo entrega. Sale con código 1 si el peor caso supera --max-added-ms.
+
+Uso:
+    python benchmarks/first_chunk_latency.py --runs 20
+"""
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+warnings.simplefilter("ignore")  # Aviso de obsolescencia de google-generativeai
+
+from pygemai_cli import main as pygemai  # noqa: E402
+
+FIRST_TEXT = "PRIMER-CHUNK"
+
+
+class TimestampedStdout:
+    """Reemplaza stdout y anota cuándo se escribe por primera vez el texto del primer chunk."""
+
+    def __init__(self):
+        self.first_text_at = None
+
+    def write(self, text):
+        if self.first_text_at is None and FIRST_TEXT in text:
+            self.first_text_at = time.perf_counter()
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+class FakeStreamModel:
+    model_name = "models/benchmark"
+
+    def __init__(self, first_delay, gap):
+        self.first_delay = first_delay
+        self.gap = gap
+        self.produced_at = None
+
+    def generate_content(self, contents, stream=True):
+        def raw_chunks():
+            time.sleep(self.first_delay)
+            self.produced_at = time.perf_counter()
+            yield pygemai.genai.protos.GenerateContentResponse(
+                {"candidates": [{"content": {"role": "model", "parts": [{"text": FIRST_TEXT}]}}]})
+            time.sleep(self.gap)
+            yield pygemai.genai.protos.GenerateContentResponse(
+                {"candidates": [{"content": {"role": "model", "parts": [{"text": " fin"}]}}]})
+
+        # Como el SDK: generate_content(stream=True) devuelve tras recibir el primer chunk
+        return pygemai.genai.types.GenerateContentResponse.from_iterator(raw_chunks())
+
+
+def run_once(first_delay, gap):
+    theme_manager = pygemai.ThemeManager({"Plain": {"colors": {}}}, "Plain")
+    model = FakeStreamModel(first_delay, gap)
+    chat = pygemai.genai.GenerativeModel(model.model_name).start_chat(history=[])
+    session = pygemai.ChatSessionState(theme_manager, pygemai.SessionProfiler(), model.model_name, model, chat,
+                                       "benchmark.json")
+    session.record_usage = False
+    user_content = pygemai.genai.protos.Content(role="user", parts=[pygemai.genai.protos.Part(text="hola")])
+    stdout = TimestampedStdout()
+    real_stdout, sys.stdout = sys.stdout, stdout
+    try:
+        outcome = pygemai._stream_turn_attempt(session, model, [user_content])
+    finally:
+        sys.stdout = real_stdout
+    assert outcome.status == "ok" and outcome.text == FIRST_TEXT + " fin", outcome.status
+    return (stdout.first_text_at - model.produced_at) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--first-delay", type=float, default=0.25, help="Segundos hasta el primer chunk.")
+    parser.add_argument("--gap", type=float, default=0.3, help="Segundos entre el primer y el segundo chunk.")
+    parser.add_argument("--max-added-ms", type=float, default=5.0,
+                        help="Latencia añadida máxima aceptable (margen para el planificador del SO).")
+    args = parser.parse_args()
+
+    samples = [run_once(args.first_delay, args.gap) for _ in range(args.runs)]
+    samples.sort()
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    print(f"Latencia añadida al primer chunk ({args.runs} turnos, primer chunk a {args.first_delay * 1000:.0f} ms, "
+          f"siguiente {args.gap * 1000:.0f} ms después):")
+    print(f"  mediana {statistics.median(samples):.3f} ms   p95 {p95:.3f} ms   máx {samples[-1]:.3f} ms")
+    print(f"  hilos activos al terminar: {threading.active_count()}")
+    return 0 if samples[-1] <= args.max_added_ms else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,76 @@
+"""
+Benchmark: coste del resaltado de sintaxis de los bloques de código, por KB de código.
+
+Formatea con format_gemini_output respuestas con un bloque de --sizes KB de Python y mide, para
+cada tamaño, el color plano (sin lenguaje en la valla), el resaltado sin caché y el resaltado de un
+bloque ya procesado durante el stream (caché). También comprueba que pygemai no carga el resaltador
+al arrancar y mide el coste del primer bloque. Sale con código 1 si el arranque carga el resaltador.
+
+Uso:
+    python benchmarks/highlight_overhead.py --sizes 1 8 32 --runs 10
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+warnings.simplefilter("ignore")  # Aviso de obsolescencia de google-generativeai
+
+from pygemai_cli import main as pygemai  # noqa: E402
+
+CODE_LINE = "    result = [transform(item, factor=2) for item in items if item is not None]  # comentario\n"
+
+
+def python_code(kilobytes, seed):
+    lines = [f"def function_{seed}_{n}(items, transform):\n{CODE_LINE}    return result\n\n"
+             for n in range(kilobytes * 1024 // (len(CODE_LINE) + 40) + 1)]
+    return "".join(lines)
+
+
+def median_ms(function, runs):
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        function()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 8, 32], help="Tamaños del bloque, en KB.")
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    if pygemai.code_highlighter._pygments is not None:
+        print("Error: el resaltador se cargó al importar pygemai; debe cargarse con el primer bloque.")
+        return 1
+    theme_manager = pygemai.ThemeManager(pygemai.PREDEFINED_THEMES, "Legacy")
+    started = time.perf_counter()
+    available = pygemai.code_highlighter.highlight("python", "x = 1") is not None
+    print(f"Primer bloque (carga Pygments y crea el lexer): {(time.perf_counter() - started) * 1000:.1f} ms")
+    if not available:
+        print("Pygments no está instalado: todos los bloques usan color plano.")
+
+    print(f"{'KB':>4}  {'plano':>10}  {'sin caché':>10}  {'por KB':>10}  {'en caché':>10}")
+    for kilobytes in args.sizes:
+        flat_text = f"Texto\n```\n{python_code(kilobytes, 0)}```\nFin"
+        fresh_texts = iter([f"Texto\n```python\n{python_code(kilobytes, seed)}```\nFin"
+                            for seed in range(1, args.runs + 1)])
+        cached_text = f"Texto\n```python\n{python_code(kilobytes, 0)}```\nFin"
+        pygemai.format_gemini_output(cached_text, theme_manager)  # Como si se hubiera resaltado durante el stream
+
+        flat = median_ms(lambda: pygemai.format_gemini_output(flat_text, theme_manager), args.runs)
+        fresh = median_ms(lambda: pygemai.format_gemini_output(next(fresh_texts), theme_manager), args.runs)
+        cached = median_ms(lambda: pygemai.format_gemini_output(cached_text, theme_manager), args.runs)
+        capped = len(python_code(kilobytes, 0)) > pygemai.HIGHLIGHT_MAX_BLOCK_CHARS
+        print(f"{kilobytes:>4}  {flat:>7.2f} ms  {fresh:>7.2f} ms  {(fresh - flat) / kilobytes:>7.2f} ms  "
+              f"{cached:>7.2f} ms" + ("  (supera el límite: color plano)" if capped else ""))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
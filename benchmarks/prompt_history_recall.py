@@ -0,0 +1,69 @@
+"""
+Benchmark: recuperar prompts del historial en disco (PromptHistory) con muchos prompts guardados.
+
+Crea en un directorio temporal un historial de --entries prompts y mide abrirlo (leer el índice),
+recuperar prompts al azar (flecha arriba), la búsqueda inversa (Ctrl+R) de un texto reciente y de
+uno que no aparece (recorre todo el archivo) y añadir un prompt. Sale con código 1 si alguna
+operación supera --max-ms.
+
+Uso:
+    python benchmarks/prompt_history_recall.py --entries 300000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+warnings.simplefilter("ignore")  # Aviso de obsolescencia de google-generativeai
+
+from pygemai_cli import main as pygemai  # noqa: E402
+
+
+def median_ms(function, runs):
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        function()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--entries", type=int, default=300_000)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--max-ms", type=float, default=50.0,
+                        help="Tiempo máximo aceptable por operación, en ms (por defecto 50).")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, pygemai.PROMPT_HISTORY_FILE)
+        history = pygemai.PromptHistory(path)
+        started = time.perf_counter()
+        for n in range(args.entries):
+            history.append(f"Prompt {n}: explica el error del paso {n % 97} en la línea {n % 1013}")
+        print(f"Historial de {args.entries} prompts creado en {time.perf_counter() - started:.1f} s "
+              f"({os.path.getsize(path) / 1024 / 1024:.1f} MB)")
+
+        timings = {
+            "abrir (leer el índice)": median_ms(lambda: len(pygemai.PromptHistory(path)), args.runs),
+            "recuperar uno al azar": median_ms(lambda: history.get(random.randrange(args.entries)), args.runs),
+            "buscar texto reciente": median_ms(lambda: history.search("paso 5 ", len(history)), args.runs),
+            "buscar texto ausente": median_ms(lambda: history.search("no aparece nunca", len(history)), args.runs),
+            "añadir un prompt": median_ms(lambda: history.append(f"nuevo {time.perf_counter()}"), args.runs),
+        }
+    for name, elapsed in timings.items():
+        print(f"{name:<24}{elapsed:>9.3f} ms")
+    if max(timings.values()) > args.max_ms:
+        print(f"Error: alguna operación supera {args.max_ms:g} ms.")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -27,11 +27,18 @@ setuptools.setup(
 
     # Lista de dependencias que se instalarán con tu paquete
     install_requires=[
-        "google-generativeai>=0.5.0", # Revisa la última versión estable recomendada
+        "google-generativeai>=0.5.0,<0.9", # <0.9: el streaming usa detalles internos del SDK (tests/test_streaming.py)
         "cryptography>=3.0.0",        # Revisa la última versión estable recomendada
         # Las dependencias como 'os', 'sys', 'json', 'getpass', etc., son parte de la librería estándar de Python
     ],
 
+    # Dependencias opcionales: pip install PyGemAi[rag]
+    extras_require={
+        "rag": ["numpy>=1.20"],  # Índice local de documentos (pygemai index build)
+        "attach": ["Pillow>=9.1"],  # Reducción de imágenes adjuntas (/attach)
+        "highlight": ["Pygments>=2.10"],  # Resaltado de sintaxis de los bloques de código
+    },
+
     # Metadatos para PyPI: clasifica tu paquete
     classifiers=[
         "Development Status :: 4 - Beta",  # O 4 - Beta, 5 - Production/Stable
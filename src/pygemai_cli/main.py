@@ -1,18 +1,58 @@
 import os
 import re
 import sys
+import array
+import bisect
+import codecs
+import mmap
+import select
 import time
 import getpass
 import threading
 import itertools
 import shutil
+import io
 import json
+import hashlib
+import datetime
+import argparse
+import atexit
+import subprocess
+import contextlib
+import functools
+import cProfile
+import pstats
+import tracemalloc
+import queue
+import random
+import shlex
+import socket
+import fnmatch
+import urllib.error
+import urllib.parse
+import urllib.request
+import concurrent.futures
 import google.generativeai as genai # Importa el módulo principal de genai
+from google.api_core import exceptions as google_exceptions
+from google.auth import exceptions as google_auth_exceptions
 from google.generativeai.types import HarmCategory, HarmBlockThreshold # Importa los tipos específicos
+from google.generativeai.types import content_types, generation_types
 from typing import Optional, List, Dict # Añadido para compatibilidad de tipos
 
+try:
+    import termios  # Entrada del chat en modo crudo (solo Unix); sin él se usa input()
+    import tty
+except ImportError:
+    termios = tty = None
+
+try:
+    import fcntl  # Bloqueo del historial de prompts entre sesiones (solo Unix)
+except ImportError:
+    fcntl = None
+
 try:
     from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+    from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
     from cryptography.hazmat.primitives import hashes
     from cryptography.hazmat.backends import default_backend
     from cryptography.fernet import Fernet, InvalidToken
@@ -40,12 +80,173 @@ class Colors:
 
 
 # --- Constantes ---
-ENCRYPTED_API_KEY_FILE = ".gemini_api_key_encrypted"  # noqa: E501
-UNENCRYPTED_API_KEY_FILE = ".gemini_api_key_unencrypted"  # noqa: E501
-PREFERENCES_FILE = ".gemini_chatbot_prefs.json"
-PROFILES_FILE = "pygemai_profiles.json"
+# Todo el estado vive en el directorio de datos (ver get_data_dir), repartido en espacios:
+# la raíz (claves, preferencias, perfiles), history, cache, index, metrics y queue.
+DATA_DIR_ENV_VAR = "PYGEMAI_DATA_DIR"
+DATA_DIR_NAME = "pygemai"  # Dentro de $XDG_DATA_HOME (o %APPDATA% en Windows)
+DATA_NAMESPACES = ("history", "cache", "index", "metrics", "queue")
+ENCRYPTED_API_KEY_FILE = "gemini_api_key_encrypted"
+UNENCRYPTED_API_KEY_FILE = "gemini_api_key_unencrypted"
+PREFERENCES_FILE = "preferences.json"
+PROFILES_FILE = "profiles.json"
+CONTEXT_CACHE_FILE = "context_cache.json"  # En cache/
+HISTORY_BLOBS_DIR = "blobs"  # En history/, junto a los chat_history_*.json
+RAG_INDEX_DIR = "default"  # En index/
+SEMANTIC_CACHE_DIR = "semantic"  # En cache/
+USAGE_LEDGER_FILE = "usage.jsonl"  # En metrics/. Registro de tokens por turno, solo se añaden líneas
+MODEL_STATS_FILE = "model_stats.json"  # En metrics/. Latencia y errores recientes por modelo
+KEY_POOL_STATE_FILE = "key_pool.json"  # En metrics/. Contadores por clave (solo nombres, nunca las claves)
+UPLOAD_CACHE_FILE = "uploads.json"  # En cache/. URIs de la File API por hash de contenido, con su caducidad
+PROMPT_HISTORY_FILE = "prompts.jsonl"  # En history/. Prompts enviados, una línea JSON cada uno
+PROMPT_HISTORY_INDEX_FILE = "prompts.idx"  # En history/. Desplazamiento de cada línea (8 bytes)
+# Archivos que versiones anteriores dejaban en el directorio de trabajo -> su sitio en el directorio de datos.
+# Los chat_history_*.json y *.pb sueltos van a history/.
+LEGACY_DATA_FILES = (
+    (".gemini_api_key_encrypted", (ENCRYPTED_API_KEY_FILE,)),
+    (".gemini_api_key_unencrypted", (UNENCRYPTED_API_KEY_FILE,)),
+    (".gemini_chatbot_prefs.json", (PREFERENCES_FILE,)),
+    ("pygemai_profiles.json", (PROFILES_FILE,)),
+    (".pygemai_context_cache.json", ("cache", CONTEXT_CACHE_FILE)),
+    ("chat_history_blobs", ("history", HISTORY_BLOBS_DIR)),
+    (".pygemai_index", ("index", RAG_INDEX_DIR)),
+    (".pygemai_semantic_cache", ("cache", SEMANTIC_CACHE_DIR)),
+    (".pygemai_usage.jsonl", ("metrics", USAGE_LEDGER_FILE)),
+    (".pygemai_model_stats.json", ("metrics", MODEL_STATS_FILE)),
+    (".pygemai_key_pool.json", ("metrics", KEY_POOL_STATE_FILE)),
+    (".pygemai_uploads.json", ("cache", UPLOAD_CACHE_FILE)),
+    (".pygemai_queue", ("queue",)),
+)
+MIGRATION_NOTICE_FILE = ".migration_notice"  # En la raíz: ya se explicó `pygemai migrate`
 SALT_SIZE = 16
-ITERATIONS = 390_000
+ITERATIONS = 390_000  # Coste PBKDF2 de los archivos de clave antiguos (sin cabecera)
+# Formato versionado del archivo de clave: MAGIC | versión (1 byte) | largo cabecera (2 bytes) | cabecera JSON | token
+KEY_FILE_MAGIC = b"PGAK"
+KEY_FILE_VERSION = 2
+DEFAULT_KDF_PARAMS = {"kdf": "pbkdf2-sha256", "iterations": ITERATIONS}
+SUPPORTED_KDFS = ("pbkdf2-sha256", "scrypt")
+MIN_PBKDF2_ITERATIONS = 100_000
+MIN_SCRYPT_LOG2_N = 14
+MAX_SCRYPT_LOG2_N = 20  # 2^20 con r=8 son ~1 GiB de memoria
+DEFAULT_KDF_TARGET_MS = 500
+DEFAULT_KEY_NAME = "default"
+KEY_POOL_STRATEGIES = ("round_robin", "least_throttled")
+KEY_SIDELINE_SECONDS = 60  # Tiempo que una clave con error de cuota queda fuera del reparto
+DEFAULT_CONTEXT_CACHE_TTL_SECONDS = 3600
+# Si al caché le queda menos de esta fracción de su TTL, se renueva antes de usarlo
+CONTEXT_CACHE_REFRESH_FRACTION = 0.25
+HISTORY_STORE_FORMAT = "pygemai-cas-v1"
+# Los blobs más recientes que esto no se recolectan: puede haber un guardado en curso
+HISTORY_GC_GRACE_SECONDS = 3600
+HISTORY_BLOB_CACHE_SIZE = 512  # Blobs parseados que se recuerdan en memoria
+# Instantánea binaria del historial: MAGIC | versión (1 byte) | (largo varint | Content serializado)*
+HISTORY_SNAPSHOT_MAGIC = b"PGHS"
+HISTORY_SNAPSHOT_VERSION = 1
+HISTORY_SNAPSHOT_EXTENSION = ".pb"
+HISTORY_FORMATS = ("json", "snapshot")
+
+# Recuperación local (RAG): índice de vectores en NumPy (abierto con mmap) + metadatos JSON
+RAG_VECTORS_FILE = "vectors.npy"
+RAG_METADATA_FILE = "chunks.json"
+DEFAULT_EMBEDDING_MODEL = "models/text-embedding-004"
+LOCAL_EMBEDDER = "local"  # Embeddings por hashing, sin red: para pruebas y uso sin conexión
+LOCAL_EMBEDDING_DIM = 256
+EMBED_BATCH_SIZE = 100
+RAG_CHUNK_CHARS = 1500
+RAG_CHUNK_OVERLAP_LINES = 3
+RAG_MAX_FILE_BYTES = 2 * 1024 * 1024
+RAG_TEXT_EXTENSIONS = {
+    ".md", ".txt", ".rst", ".py", ".json", ".yaml", ".yml", ".toml", ".ini", ".cfg", ".js", ".ts",
+    ".html", ".css", ".sh", ".java", ".go", ".rs", ".c", ".h", ".cpp", ".sql", ".csv",
+}
+DEFAULT_RAG_TOP_K = 4
+DEFAULT_RAG_MIN_SCORE = 0.2
+
+USAGE_GROUPINGS = ("profile", "model", "day")
+CASSETTE_FORMAT = "pygemai-cassette-v1"
+
+# Enrutado de modelos por turno (perfil "router")
+MODEL_STATS_WINDOW = 50  # Peticiones recientes que se recuerdan por modelo
+ROUTER_MIN_SAMPLES = 5  # Con menos muestras no se juzga la salud de un modelo
+DEFAULT_ROUTER_MAX_ERROR_RATE = 0.5
+CHARS_PER_TOKEN = 4  # Estimación local, sin llamar a count_tokens
+ROUTER_RULE_KINDS = ("code", "attachment", "tokens_over", "tokens_under")
+
+# Caché semántico de respuestas (opcional por perfil): prompts casi iguales reutilizan la respuesta
+DEFAULT_SEMANTIC_CACHE_THRESHOLD = 0.92
+DEFAULT_SEMANTIC_CACHE_CAPACITY = 500
+
+# Códigos de salida del modo de un solo disparo (-p)
+EXIT_OK = 0
+EXIT_ERROR = 1
+EXIT_USAGE = 2
+EXIT_API_ERROR = 3
+EXIT_BLOCKED = 4
+EXIT_INVALID_OUTPUT = 5  # --json-stream: la respuesta no es JSON válido o quedó incompleta
+EXIT_INTERRUPTED = 130
+
+# Perfilado (--profile-cpu / --trace-malloc / /profile)
+DEFAULT_PROFILE_TOP_N = 25
+DEFAULT_TRACE_MALLOC_EVERY_TURNS = 10
+TRACE_MALLOC_TOP_N = 10
+
+# Política de turno por perfil ("turn_policy"): plazos, reintentos y modelo de respaldo
+DEFAULT_TURN_POLICY = {
+    "first_chunk_timeout_seconds": None,  # Sin primer chunk en este plazo: cancelar y reintentar
+    "turn_timeout_seconds": None,         # Plazo total del turno
+    "retries": 0,                         # Reintentos con el mismo modelo tras agotar el primer plazo
+    "fallback_model": None,               # Último intento con este modelo
+    "keep_partial_on_cancel": False,      # Guardar en el historial la respuesta parcial al cancelar
+    "hedge_after_ms": None,               # Sin primer chunk en este plazo (o "p95"): lanzar una petición duplicada
+    "hedge_model": None,                  # Modelo de la duplicada (por defecto, el mismo)
+    "hedge_key": None,                    # Clave de la duplicada: un nombre de `pygemai key list` u "other"
+}
+HEDGE_MIN_AFTER_MS = 250  # Con "p95", nunca duplicar antes de este plazo
+# Máximo tiempo que el hilo principal espera sin revisar Ctrl+C (no añade latencia)
+STREAM_POLL_SECONDS = 0.5
+
+# Herramientas locales (function calling) declaradas por perfil ("tools" / "tool_settings")
+DEFAULT_TOOL_SETTINGS = {
+    "root": ".",                                   # read_file y grep no salen de este directorio
+    "shell_allowlist": [],                         # Ejecutables permitidos para la herramienta shell
+    "http_allowed_hosts": ["localhost", "127.0.0.1", "::1"],
+    "timeout_seconds": 15,                         # Plazo por llamada a herramienta
+    "max_workers": 4,                              # Llamadas concurrentes en un mismo turno
+    "max_output_chars": 20_000,
+}
+MAX_TOOL_ROUNDS = 8  # Rondas llamada/respuesta de herramientas por turno
+
+# Resaltado de sintaxis de los bloques de código (Pygments, opcional)
+HIGHLIGHT_STYLE = "monokai"
+HIGHLIGHT_MAX_BLOCK_CHARS = 64 * 1024  # Bloques más grandes se muestran en color plano
+HIGHLIGHT_CACHE_SIZE = 64              # Bloques resaltados que se recuerdan
+
+# Editor de la línea de entrada del chat (terminal en modo crudo)
+BRACKETED_PASTE_ON = "\x1b[?2004h"
+BRACKETED_PASTE_OFF = "\x1b[?2004l"
+PASTE_START = "\x1b[200~"
+PASTE_END = "\x1b[201~"
+ESCAPE_KEY_TIMEOUT_SECONDS = 0.05  # Un ESC sin nada detrás en este plazo es la tecla Esc
+
+# Adjuntos (/attach) configurables por perfil ("attachments")
+DEFAULT_ATTACHMENT_SETTINGS = {
+    "max_side": 1536,                     # Lado mayor de las imágenes tras reducirlas, en píxeles
+    "quality": 85,                        # Calidad JPEG al recodificar
+    "inline_max_bytes": 4 * 1024 * 1024,  # Más grande que esto: se sube por la File API
+    "workers": None,                      # Procesos para reducir imágenes (None = núcleos disponibles)
+}
+ATTACHMENT_IMAGE_TYPES = {".png": "image/png", ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".webp": "image/webp"}
+ATTACHMENT_DOCUMENT_TYPES = {".pdf": "application/pdf"}
+HASH_CHUNK_BYTES = 1024 * 1024
+UPLOAD_EXPIRY_MARGIN_SECONDS = 600  # No reutilizar una subida a la que le quede menos que esto
+UPLOAD_PROCESSING_TIMEOUT_SECONDS = 60
+
+# Cola de prompts sin conexión (/queue, pygemai queue)
+QUEUE_MAX_CONCURRENCY = 2
+QUEUE_BASE_BACKOFF_SECONDS = 5
+QUEUE_MAX_BACKOFF_SECONDS = 300
+QUEUE_POLL_SECONDS = 5
+QUEUE_REQUEST_TIMEOUT_SECONDS = 120
+QUEUE_LOCK_STALE_SECONDS = 900  # Una reserva más antigua es de un proceso que murió
 
 
 # --- Color Theme Definitions ---
@@ -163,6 +364,184 @@ class ThemeManager:
             return text
 
 
+# --- Medición de rutas calientes (activada por --profile-cpu, --trace-malloc o /profile) ---
+
+
+class HotPathTimer:
+    """Acumula llamadas y tiempos de funciones marcadas con @hot_path. Sin coste si está apagado."""
+
+    def __init__(self):
+        self.enabled = False
+        self.stats = {}  # nombre -> [llamadas, total_s, máximo_s]
+
+    def track(self, func):
+        name = func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not self.enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                entry = self.stats.setdefault(name, [0, 0.0, 0.0])
+                entry[0] += 1
+                entry[1] += elapsed
+                entry[2] = max(entry[2], elapsed)
+        return wrapper
+
+    def report(self, stream=None):
+        stream = stream or sys.stderr
+        if not self.stats:
+            return
+        stream.write("\n--- Rutas calientes ---\n")
+        stream.write(f"{'función':<28}{'llamadas':>10}{'total ms':>12}{'media ms':>12}{'máx ms':>12}\n")
+        for name, (calls, total, peak) in sorted(self.stats.items(), key=lambda kv: -kv[1][1]):
+            stream.write(f"{name:<28}{calls:>10}{total * 1000:>12.2f}{total * 1000 / calls:>12.3f}"
+                         f"{peak * 1000:>12.3f}\n")
+
+
+hot_path_timer = HotPathTimer()
+hot_path = hot_path_timer.track
+
+
+# --- Directorio de datos (claves, perfiles, historial, cachés, índices y métricas) ---
+
+_data_dir = None  # Se resuelve en la primera llamada a get_data_dir, o lo fija set_data_dir
+_ensured_data_dirs = set()
+
+
+def _default_data_dir() -> str:
+    configured = os.environ.get(DATA_DIR_ENV_VAR)
+    if configured:
+        return os.path.abspath(os.path.expanduser(configured))
+    if os.name == "nt":
+        base = os.environ.get("APPDATA") or os.path.expanduser("~")
+    else:
+        base = os.environ.get("XDG_DATA_HOME") or os.path.join(os.path.expanduser("~"), ".local", "share")
+    return os.path.join(base, DATA_DIR_NAME)
+
+
+def set_data_dir(path: Optional[str]):
+    """Fija el directorio de datos (--data-dir). Con None se vuelve a PYGEMAI_DATA_DIR o a XDG."""
+    global _data_dir
+    _data_dir = os.path.abspath(os.path.expanduser(path)) if path else None
+    _ensured_data_dirs.clear()
+    _history_blob_touched.clear()  # Los blobs del directorio anterior no cuentan como guardados
+
+
+def get_data_dir() -> str:
+    """--data-dir, PYGEMAI_DATA_DIR o $XDG_DATA_HOME/pygemai (por defecto ~/.local/share/pygemai)."""
+    global _data_dir
+    if _data_dir is None:
+        _data_dir = _default_data_dir()
+    return _data_dir
+
+
+def data_path(*parts: str) -> str:
+    """
+    Ruta absoluta dentro del directorio de datos, p. ej. data_path("metrics", USAGE_LEDGER_FILE). Si
+    hay varios componentes, el primero es el espacio (DATA_NAMESPACES). El directorio del espacio se
+    crea la primera vez que se pide, solo accesible para el usuario: guarda claves e historial.
+    """
+    root = get_data_dir()
+    directory = os.path.join(root, parts[0]) if len(parts) > 1 else root
+    if directory not in _ensured_data_dirs:
+        if len(parts) > 1 and parts[0] not in DATA_NAMESPACES:
+            raise ValueError(f"Espacio desconocido en el directorio de datos: {parts[0]}")
+        os.makedirs(root, mode=0o700, exist_ok=True)
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        _ensured_data_dirs.add(directory)
+    return os.path.join(root, *parts)
+
+
+def _rebase_queued_history_files(source_dir: str):
+    """Los prompts en cola guardaban su historial relativo al directorio de trabajo."""
+    for state in ("pending", "done"):
+        directory = os.path.join(data_path("queue"), state)
+        if not os.path.isdir(directory):
+            continue
+        for filename in os.listdir(directory):
+            if not filename.endswith(".json"):
+                continue
+            path = os.path.join(directory, filename)
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    item = json.load(f)
+            except (OSError, ValueError):
+                continue
+            history_file = item.get("history_file")
+            if not history_file or os.path.isabs(history_file):
+                continue
+            if os.path.basename(history_file) == history_file and history_file.startswith("chat_history_"):
+                item["history_file"] = data_path("history", history_file)  # Migrado junto con la cola
+            else:
+                item["history_file"] = os.path.join(source_dir, history_file)
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(item, f, ensure_ascii=False, indent=2)
+            os.replace(path + ".tmp", path)
+
+
+def migrate_legacy_data(source_dir: str) -> List[str]:
+    """
+    Mueve al directorio de datos el estado que versiones anteriores dejaban en el directorio desde
+    el que se ejecutaban (LEGACY_DATA_FILES y los chat_history_* sueltos). Solo se ejecuta a
+    petición (pygemai migrate DIR). Lo ya movido desaparece del origen y lo que ya existe en
+    destino no se toca. Devuelve los mensajes para el usuario.
+    """
+    source_dir = os.path.abspath(source_dir)
+    root = get_data_dir()
+    if source_dir == root or source_dir.startswith(root + os.sep):
+        return []
+    try:
+        present = set(os.listdir(source_dir))
+    except OSError:
+        return []
+    moves = [(name, parts) for name, parts in LEGACY_DATA_FILES if name in present]
+    moves += [(name, ("history", name)) for name in sorted(present)
+              if name.startswith("chat_history_") and name.endswith((".json", HISTORY_SNAPSHOT_EXTENSION))]
+    if not moves:
+        return []
+    messages, moved = [], []
+    for name, parts in moves:
+        target = data_path(*parts)
+        if os.path.exists(target):
+            messages.append(f"No se movió {name}: ya existe {target}. Revísalo y borra el que sobre.")
+            continue
+        try:
+            shutil.move(os.path.join(source_dir, name), target)
+        except OSError as e:
+            messages.append(f"No se pudo mover {name} a {target}: {e}")
+            continue
+        moved.append(name)
+    if ".pygemai_queue" in moved:
+        _rebase_queued_history_files(source_dir)
+    if moved:
+        messages.insert(0, f"Se movieron {len(moved)} archivo(s) de {source_dir} al directorio de datos "
+                           f"{root}: {', '.join(moved)}.")
+    return messages
+
+
+def show_legacy_data_notice(theme_manager: ThemeManager):
+    """
+    La primera sesión interactiva con un directorio de datos explica cómo traer los datos de
+    versiones anteriores. No busca nada en disco: solo comprueba (y deja) MIGRATION_NOTICE_FILE.
+    """
+    marker = data_path(MIGRATION_NOTICE_FILE)
+    if os.path.exists(marker):
+        return
+    print(theme_manager.style("info_message",
+          f"Los datos de PyGemAi se guardan en {get_data_dir()}. Si usabas una versión anterior, trae tu "
+          "clave, perfiles e historiales con: pygemai migrate <directorio desde el que la ejecutabas>"))
+    try:
+        with open(marker, "w", encoding="utf-8") as f:
+            f.write(datetime.datetime.now().isoformat(timespec="seconds") + "\n")
+    except OSError:
+        pass  # Se volverá a mostrar la próxima vez
+
+
 # --- Funciones de Perfiles de Chat ---
 
 
@@ -192,100 +571,384 @@ def _parse_safety_settings(profile_settings: dict, theme_manager: ThemeManager)
 
 
 def load_profiles(theme_manager: ThemeManager) -> list:
-    if not os.path.exists(PROFILES_FILE):
+    profiles_file = data_path(PROFILES_FILE)
+    if not os.path.exists(profiles_file):
         return []
     try:
-        with open(PROFILES_FILE, "r", encoding="utf-8") as f:
+        with open(profiles_file, "r", encoding="utf-8") as f:
             profiles = json.load(f)
             if not isinstance(profiles, list):
                 print(theme_manager.style("error_message",
-                      f"Error: El archivo de perfiles no contiene una lista. ({PROFILES_FILE})"))
+                      f"Error: El archivo de perfiles no contiene una lista. ({profiles_file})"))
                 return []
             return profiles
     except FileNotFoundError:
         return []
     except json.JSONDecodeError:
         print(theme_manager.style("error_message",
-              f"Error: El archivo de perfiles ({PROFILES_FILE}) está corrupto o no es un JSON válido."))
+              f"Error: El archivo de perfiles ({profiles_file}) está corrupto o no es un JSON válido."))
         return []
     except Exception as e:
         print(theme_manager.style("error_message",
-              f"Error inesperado al cargar perfiles desde {PROFILES_FILE}: {e}"))
+              f"Error inesperado al cargar perfiles desde {profiles_file}: {e}"))
         return []
 
 
 def save_profiles(profiles: list, theme_manager: ThemeManager):
+    profiles_file = data_path(PROFILES_FILE)
     try:
-        with open(PROFILES_FILE, "w", encoding="utf-8") as f:
+        with open(profiles_file, "w", encoding="utf-8") as f:
             json.dump(profiles, f, ensure_ascii=False, indent=2)
     except Exception as e:
-        print(theme_manager.style("error_message", f"Error al guardar perfiles en {PROFILES_FILE}: {e}"))
+        print(theme_manager.style("error_message", f"Error al guardar perfiles en {profiles_file}: {e}"))
 
 
 # --- Funciones de Encriptación/Desencriptación ---
 
 
-def _derive_key(password: str, salt: bytes) -> bytes:
-    kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=ITERATIONS, backend=default_backend())
+@hot_path
+def _derive_key(password: str, salt: bytes, kdf_params: Optional[dict] = None) -> bytes:
+    kdf_params = kdf_params or DEFAULT_KDF_PARAMS
+    kdf_name = kdf_params.get("kdf")
+    if kdf_name == "pbkdf2-sha256":
+        kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt,
+                         iterations=int(kdf_params["iterations"]), backend=default_backend())
+    elif kdf_name == "scrypt":
+        kdf = Scrypt(salt=salt, length=32, n=int(kdf_params["n"]), r=int(kdf_params["r"]),
+                     p=int(kdf_params["p"]), backend=default_backend())
+    else:
+        raise ValueError(f"KDF no soportada en el archivo de clave: {kdf_name}")
     return base64.urlsafe_b64encode(kdf.derive(password.encode()))
 
 
-def save_encrypted_api_key(api_key: str, password: str, theme_manager: ThemeManager):
+def _read_key_file() -> tuple:
+    """
+    Lee el archivo de clave encriptada. Devuelve (kdf_params, salt, token, es_formato_antiguo).
+    El formato antiguo es simplemente `salt || token` con PBKDF2 y ITERATIONS.
+    """
+    with open(data_path(ENCRYPTED_API_KEY_FILE), "rb") as key_file:
+        data = key_file.read()
+    if not data.startswith(KEY_FILE_MAGIC):
+        return dict(DEFAULT_KDF_PARAMS), data[:SALT_SIZE], data[SALT_SIZE:], True
+    offset = len(KEY_FILE_MAGIC)
+    version = data[offset]
+    if version != KEY_FILE_VERSION:
+        raise ValueError(f"Versión de archivo de clave no soportada: {version}")
+    header_len = int.from_bytes(data[offset + 1:offset + 3], "big")
+    header = json.loads(data[offset + 3:offset + 3 + header_len].decode("utf-8"))
+    salt = base64.b64decode(header.pop("salt"))
+    return header, salt, data[offset + 3 + header_len:], False
+
+
+def _write_key_file(kdf_params: dict, salt: bytes, token: bytes):
+    header = dict(kdf_params, salt=base64.b64encode(salt).decode("ascii"))
+    header_bytes = json.dumps(header, sort_keys=True).encode("utf-8")
+    key_path = data_path(ENCRYPTED_API_KEY_FILE)
+    tmp_path = f"{key_path}.tmp"
+    with open(tmp_path, "wb") as key_file:
+        key_file.write(KEY_FILE_MAGIC)
+        key_file.write(bytes([KEY_FILE_VERSION]))
+        key_file.write(len(header_bytes).to_bytes(2, "big"))
+        key_file.write(header_bytes)
+        key_file.write(token)
+    if os.name != "nt":
+        os.chmod(tmp_path, 0o600)
+    os.replace(tmp_path, key_path)  # Nunca dejar la clave a medio reescribir
+
+
+def _current_kdf_params() -> dict:
+    """Parámetros KDF del archivo existente (conserva una calibración previa) o los por defecto."""
+    if os.path.exists(data_path(ENCRYPTED_API_KEY_FILE)):
+        try:
+            return _read_key_file()[0]
+        except Exception:
+            pass
+    return dict(DEFAULT_KDF_PARAMS)
+
+
+def _encode_key_set(keys: Dict[str, str]) -> bytes:
+    # Una sola clave 'default' se guarda tal cual, legible por versiones anteriores
+    if list(keys) == [DEFAULT_KEY_NAME]:
+        return keys[DEFAULT_KEY_NAME].encode()
+    return json.dumps({"keys": keys}).encode()
+
+
+def _decode_key_set(payload: bytes) -> Dict[str, str]:
+    text = payload.decode()
+    if text.startswith("{"):
+        return json.loads(text)["keys"]
+    return {DEFAULT_KEY_NAME: text}
+
+
+def save_encrypted_api_keys(keys: Dict[str, str], password: str, theme_manager: ThemeManager,
+                            kdf_params: Optional[dict] = None):
+    """Guarda un conjunto de claves con nombre en el archivo encriptado."""
     try:
+        kdf_params = kdf_params or _current_kdf_params()
         salt = os.urandom(SALT_SIZE)
-        derived_key = _derive_key(password, salt)
+        derived_key = _derive_key(password, salt, kdf_params)
         f = Fernet(derived_key)
-        encrypted_api_key = f.encrypt(api_key.encode())
-        with open(ENCRYPTED_API_KEY_FILE, "wb") as key_file:
-            key_file.write(salt)
-            key_file.write(encrypted_api_key)
-        print(theme_manager.style("info_message", f"API Key encriptada y guardada en {ENCRYPTED_API_KEY_FILE}"))
-        if os.name != "nt":
-            os.chmod(ENCRYPTED_API_KEY_FILE, 0o600)
+        encrypted_api_key = f.encrypt(_encode_key_set(keys))
+        _write_key_file(kdf_params, salt, encrypted_api_key)
+        print(theme_manager.style("info_message",
+              f"API Key encriptada y guardada en {data_path(ENCRYPTED_API_KEY_FILE)}"))
     except Exception as e:
         print(theme_manager.style("error_message", f"Error al guardar la API Key encriptada: {e}"))
 
 
-def load_decrypted_api_key(password: str, theme_manager: ThemeManager) -> Optional[str]:
-    if not os.path.exists(ENCRYPTED_API_KEY_FILE):
+def save_encrypted_api_key(api_key: str, password: str, theme_manager: ThemeManager,
+                           kdf_params: Optional[dict] = None):
+    save_encrypted_api_keys({DEFAULT_KEY_NAME: api_key}, password, theme_manager, kdf_params)
+
+
+def load_decrypted_api_keys(password: str, theme_manager: ThemeManager) -> Optional[Dict[str, str]]:
+    """Todas las claves del archivo encriptado ({nombre: clave}), o None."""
+    if not os.path.exists(data_path(ENCRYPTED_API_KEY_FILE)):
         return None
     try:
-        with open(ENCRYPTED_API_KEY_FILE, "rb") as key_file:
-            salt = key_file.read(SALT_SIZE)
-            encrypted_api_key = key_file.read()
-        derived_key = _derive_key(password, salt)
+        kdf_params, salt, encrypted_api_key, is_legacy = _read_key_file()
+        derived_key = _derive_key(password, salt, kdf_params)
         f = Fernet(derived_key)
-        return f.decrypt(encrypted_api_key).decode()
+        keys = _decode_key_set(f.decrypt(encrypted_api_key))
     except InvalidToken:
         return None  # Contraseña incorrecta o token inválido
     except Exception as e: # Captura otros errores como IOError, problemas de desencriptación, etc.
         print(theme_manager.style("error_message", f"Error al cargar o desencriptar la API Key: {e}"))
         return None
+    if is_legacy:
+        # Actualización transparente al formato versionado, con el mismo coste KDF
+        print(theme_manager.style("info_message", "Actualizando el archivo de clave al formato versionado."))
+        save_encrypted_api_keys(keys, password, theme_manager, kdf_params)
+    return keys
+
+
+def load_decrypted_api_key(password: str, theme_manager: ThemeManager) -> Optional[str]:
+    keys = load_decrypted_api_keys(password, theme_manager)
+    if not keys:
+        return None
+    return keys.get(DEFAULT_KEY_NAME) or next(iter(keys.values()))
+
+
+def _time_kdf(kdf_params: dict) -> float:
+    start = time.perf_counter()
+    _derive_key("calibracion", os.urandom(SALT_SIZE), kdf_params)
+    return (time.perf_counter() - start) * 1000
+
+
+def calibrate_kdf_params(kdf_name: str, target_ms: float) -> dict:
+    """Mide esta máquina y elige parámetros KDF para que desbloquear la clave tarde ~target_ms."""
+    if kdf_name == "pbkdf2-sha256":
+        probe_iterations = 50_000
+        elapsed_ms = _time_kdf({"kdf": kdf_name, "iterations": probe_iterations})
+        iterations = int(probe_iterations * target_ms / max(elapsed_ms, 0.001))
+        iterations = max(MIN_PBKDF2_ITERATIONS, round(iterations, -3))
+        return {"kdf": kdf_name, "iterations": iterations}
+    if kdf_name == "scrypt":
+        # El coste de scrypt es lineal en n: subir n mientras no se pase del objetivo
+        log2_n = MIN_SCRYPT_LOG2_N
+        elapsed_ms = _time_kdf({"kdf": kdf_name, "n": 2 ** log2_n, "r": 8, "p": 1})
+        while log2_n < MAX_SCRYPT_LOG2_N and elapsed_ms * 2 <= target_ms * 1.25:
+            log2_n += 1
+            elapsed_ms *= 2
+        return {"kdf": kdf_name, "n": 2 ** log2_n, "r": 8, "p": 1}
+    raise ValueError(f"KDF desconocida: {kdf_name}")
+
+
+def recalibrate_encrypted_api_key(password: str, kdf_name: str, target_ms: float,
+                                  theme_manager: ThemeManager) -> bool:
+    """Desencripta la clave y la vuelve a guardar con parámetros KDF calibrados para esta máquina."""
+    keys = load_decrypted_api_keys(password, theme_manager)
+    if keys is None:
+        print(theme_manager.style("error_message", "Contraseña incorrecta o archivo corrupto."))
+        return False
+    kdf_params = calibrate_kdf_params(kdf_name, target_ms)
+    save_encrypted_api_keys(keys, password, theme_manager, kdf_params)
+    unlock_ms = _time_kdf(kdf_params)
+    details = ", ".join(f"{k}={v}" for k, v in kdf_params.items() if k != "kdf")
+    print(theme_manager.style("info_message",
+          f"KDF {kdf_params['kdf']} ({details}): desbloqueo medido en {unlock_ms:.0f} ms "
+          f"(objetivo {target_ms:.0f} ms)."))
+    return True
+
+
+# genai solo tiene una configuración global; KeyPool.generate_content la cambia un momento
+_genai_configure_lock = threading.Lock()
+_configured_key_id: Optional[str] = None  # api_key_id de la clave configurada
+
+
+def api_key_id(api_key: str) -> str:
+    """Identifica una clave sin guardarla (p. ej. en UploadCache: cada archivo subido es de su clave)."""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+def configure_genai(api_key: str):
+    """genai.configure recordando qué clave queda activa (ver current_key_id)."""
+    global _configured_key_id
+    genai.configure(api_key=api_key)
+    _configured_key_id = api_key_id(api_key)
+
+
+def current_key_id() -> Optional[str]:
+    return _configured_key_id
+
+
+class KeyPool:
+    """
+    Reparte las peticiones entre varias API Keys (round_robin o least_throttled). Una clave que
+    devuelve error de cuota queda apartada KEY_SIDELINE_SECONDS. Los contadores por clave se
+    guardan en KEY_POOL_STATE_FILE para que los compartan ejecuciones sucesivas (p. ej. en lotes):
+    al apartar una clave en el acto y el resto de cambios al salir, nunca antes de una petición.
+    """
+
+    def __init__(self, keys: Dict[str, str], strategy: str = "round_robin",
+                 state_file: Optional[str] = None):
+        if not keys:
+            raise ValueError("KeyPool necesita al menos una clave.")
+        if strategy not in KEY_POOL_STRATEGIES:
+            raise ValueError(f"Estrategia desconocida: {strategy} (usa {', '.join(KEY_POOL_STRATEGIES)}).")
+        self.keys = dict(keys)
+        self.strategy = strategy
+        state_file = state_file or data_path("metrics", KEY_POOL_STATE_FILE)
+        self.state_file = state_file
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._flush_registered = False
+        self.configured: Optional[str] = None  # Clave pasada a genai.configure por configure()
+        self.state = {"next": 0, "keys": {}}
+        if state_file and os.path.exists(state_file):
+            try:
+                with open(state_file, "r", encoding="utf-8") as f:
+                    loaded = json.load(f)
+                if isinstance(loaded, dict):
+                    self.state = loaded
+            except (OSError, ValueError):
+                pass  # Contadores ilegibles: se empieza de cero
+        if not isinstance(self.state.get("keys"), dict):
+            self.state["keys"] = {}
+        if not isinstance(self.state.get("next"), int):
+            self.state["next"] = 0
+        for name in self.keys:
+            self.state["keys"].setdefault(name, {"requests": 0, "throttles": 0, "last_used": 0,
+                                                 "last_throttled": 0, "sidelined_until": 0})
+
+    @classmethod
+    def from_env(cls, keys: Dict[str, str]) -> "KeyPool":
+        return cls(keys, os.getenv("PYGEMAI_KEY_STRATEGY", "round_robin"))
+
+    def acquire(self) -> tuple:
+        """(nombre, clave) para la siguiente petición. Si todas están apartadas, la que antes vuelva."""
+        with self._lock:
+            now = time.time()
+            names = list(self.keys)
+            counters = self.state["keys"]
+            available = [n for n in names if counters[n]["sidelined_until"] <= now]
+            if not available:
+                name = min(names, key=lambda n: counters[n]["sidelined_until"])
+            elif self.strategy == "least_throttled":
+                name = min(available, key=lambda n: (counters[n]["last_throttled"], counters[n]["last_used"]))
+            else:
+                start = self.state["next"] % len(names)
+                ordered = names[start:] + names[:start]
+                name = next(n for n in ordered if n in available)
+                self.state["next"] = names.index(name) + 1
+            counters[name]["requests"] += 1
+            counters[name]["last_used"] = now
+            self._dirty = True  # Se guarda al salir: el modo -p no escribe antes de enviar
+            if not self._flush_registered:
+                self._flush_registered = True
+                atexit.register(self.flush)
+            return name, self.keys[name]
+
+    def report_throttled(self, name: str, sideline_seconds: float = KEY_SIDELINE_SECONDS):
+        with self._lock:
+            now = time.time()
+            counters = self.state["keys"][name]
+            counters["throttles"] += 1
+            counters["last_throttled"] = now
+            counters["sidelined_until"] = now + sideline_seconds
+            self._save()  # En el acto: otras ejecuciones no deben usar la clave apartada
+
+    def stats(self) -> Dict[str, dict]:
+        with self._lock:
+            return {name: dict(self.state["keys"][name]) for name in self.keys}
+
+    def configure(self, name: str):
+        """genai.configure con la clave `name`; los GenerativeModel nuevos la usarán."""
+        with _genai_configure_lock:
+            configure_genai(self.keys[name])
+            self.configured = name
+
+    def generate_content(self, name: str, model, *args, **kwargs):
+        """
+        model.generate_content con la clave `name` mientras el resto sigue con la configurada.
+        Cada GenerativeModel toma su cliente de la configuración global en su primera petición, así
+        que `model` debe ser nuevo o haberse usado siempre con `name`.
+        """
+        with _genai_configure_lock:
+            configure_genai(self.keys[name])
+            try:
+                return model.generate_content(*args, **kwargs)
+            finally:
+                if self.configured is not None:
+                    configure_genai(self.keys[self.configured])
+
+    def flush(self):
+        """Guarda los contadores si cambiaron desde la última escritura (se llama al salir)."""
+        with self._lock:
+            if self._dirty:
+                self._save()
+
+    def _save(self):
+        self._dirty = False
+        if not self.state_file:
+            return
+        try:
+            with open(self.state_file + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(self.state, f, indent=2)
+            os.replace(self.state_file + ".tmp", self.state_file)
+        except OSError:
+            pass  # Los contadores son informativos; no deben romper una petición
+
+
+def is_quota_error(error: Exception) -> bool:
+    """Cuota agotada (HTTP 429), por el tipo o el código del error y no por su texto."""
+    if isinstance(error, (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)):
+        return True
+    return getattr(error, "code", None) == 429
+
+
+def is_connectivity_error(error: Exception) -> bool:
+    """Sin red o servicio no disponible: el mismo prompt puede enviarse más tarde."""
+    return isinstance(error, (google_exceptions.ServiceUnavailable, google_exceptions.DeadlineExceeded,
+                              google_exceptions.RetryError, google_auth_exceptions.TransportError,
+                              ConnectionError, TimeoutError, socket.gaierror))
 
 
 def save_unencrypted_api_key(api_key: str, theme_manager: ThemeManager):
+    key_path = data_path(UNENCRYPTED_API_KEY_FILE)
     try:
-        with open(UNENCRYPTED_API_KEY_FILE, "w") as key_file:
+        with open(key_path, "w") as key_file:
             key_file.write(api_key)
         warning_style_code = theme_manager.get_color("warning_message")
         print(f"{Colors.BOLD}{warning_style_code}ADVERTENCIA:{Colors.RESET}{warning_style_code} "
-              f"API Key guardada SIN ENCRIPTAR en {UNENCRYPTED_API_KEY_FILE}.{Colors.RESET}")
+              f"API Key guardada SIN ENCRIPTAR en {key_path}.{Colors.RESET}")
         if os.name != "nt":
-            os.chmod(UNENCRYPTED_API_KEY_FILE, 0o600)
+            os.chmod(key_path, 0o600)
     except Exception as e:
         print(theme_manager.style("error_message", f"Error al guardar la API Key sin encriptar: {e}"))
 
 
 def load_unencrypted_api_key(theme_manager: ThemeManager) -> Optional[str]:
-    if not os.path.exists(UNENCRYPTED_API_KEY_FILE):
+    key_path = data_path(UNENCRYPTED_API_KEY_FILE)
+    if not os.path.exists(key_path):
         return None
     try:
-        with open(UNENCRYPTED_API_KEY_FILE, "r") as key_file:
+        with open(key_path, "r") as key_file:
             api_key = key_file.read().strip()
             if api_key:
                 warning_style_code = theme_manager.get_color("warning_message")
                 print(f"{Colors.BOLD}{warning_style_code}ADVERTENCIA:{Colors.RESET}{warning_style_code} "
-                      f"API Key cargada SIN ENCRIPTAR desde {UNENCRYPTED_API_KEY_FILE}.{Colors.RESET}")
+                      f"API Key cargada SIN ENCRIPTAR desde {key_path}.{Colors.RESET}")
                 return api_key
             return None
     except Exception as e:
@@ -299,17 +962,18 @@ def load_unencrypted_api_key(theme_manager: ThemeManager) -> Optional[str]:
 
 def save_preferences(prefs: dict, theme_manager: ThemeManager):
     try:
-        with open(PREFERENCES_FILE, "w", encoding="utf-8") as f:
+        with open(data_path(PREFERENCES_FILE), "w", encoding="utf-8") as f:
             json.dump(prefs, f, ensure_ascii=False, indent=2)
     except Exception as e:
         print(theme_manager.style("error_message", f"Error al guardar las preferencias: {e}"))
 
 
 def load_preferences(theme_manager: ThemeManager) -> dict:
-    if not os.path.exists(PREFERENCES_FILE):
+    preferences_file = data_path(PREFERENCES_FILE)
+    if not os.path.exists(preferences_file):
         return {}
     try:
-        with open(PREFERENCES_FILE, "r", encoding="utf-8") as f:
+        with open(preferences_file, "r", encoding="utf-8") as f:
             return json.load(f)
     except Exception as e:
         print(theme_manager.style("error_message",
@@ -322,26 +986,130 @@ def load_preferences(theme_manager: ThemeManager) -> dict:
 
 def get_chat_history_filename(model_name: str) -> str:
     safe_model_name = "".join(c if c.isalnum() or c in ("-", "_") else "_" for c in model_name)
-    return f"chat_history_{safe_model_name}.json"
+    return data_path("history", f"chat_history_{safe_model_name}.json")
+
 
+# Blobs ya parseados, compartidos entre conversaciones y modelos; el orden de inserción hace de LRU
+_history_blob_cache: Dict[str, dict] = {}
+_history_blob_cache_lock = threading.Lock()
+# Cuándo renovó este proceso el mtime de cada blob que guarda (ver store_history_blob)
+_history_blob_touched: Dict[str, float] = {}
 
-def save_chat_history(chat_session, filename: str, theme_manager: ThemeManager):
-    history_to_save = [{'role': c.role, 'parts': [{'text': p.text} for p in c.parts if hasattr(p, "text")]}  # noqa: E501
-                       for c in chat_session.history]
+
+def _history_blob_path(blob_hash: str) -> str:
+    return os.path.join(data_path("history", HISTORY_BLOBS_DIR), blob_hash[:2], f"{blob_hash[2:]}.json")
+
+
+def _cache_history_blob(blob_hash: str, part: dict):
+    with _history_blob_cache_lock:
+        _history_blob_cache.pop(blob_hash, None)
+        _history_blob_cache[blob_hash] = part
+        while len(_history_blob_cache) > HISTORY_BLOB_CACHE_SIZE:
+            del _history_blob_cache[next(iter(_history_blob_cache))]
+
+
+def store_history_blob(part: dict) -> str:
+    """Guarda una parte de mensaje una sola vez, direccionada por el hash de su contenido."""
+    canonical = json.dumps(part, ensure_ascii=False, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    blob_hash = hashlib.sha256(canonical).hexdigest()
+    now = time.time()
+    # Un `history gc` de otro proceso solo borra blobs sin referencias cuyo mtime supera el plazo de
+    # gracia. Renovar el mtime al volver a referenciar un blob (como mucho una vez cada medio plazo)
+    # evita que lo borre antes de que el historial que lo usa llegue al disco
+    if now - _history_blob_touched.get(blob_hash, 0.0) < HISTORY_GC_GRACE_SECONDS / 2:
+        return blob_hash
+    path = _history_blob_path(blob_hash)
+    try:
+        os.utime(path)
+    except FileNotFoundError:  # Nuevo, o ya recolectado
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(canonical)
+        os.replace(tmp_path, path)  # Atómico: un blob nunca queda a medio escribir
+    _cache_history_blob(blob_hash, part)
+    _history_blob_touched[blob_hash] = now
+    return blob_hash
+
+
+def load_history_blob(blob_hash: str) -> dict:
+    part = _history_blob_cache.get(blob_hash)
+    if part is None:
+        with open(_history_blob_path(blob_hash), "r", encoding="utf-8") as f:
+            part = json.load(f)
+    _cache_history_blob(blob_hash, part)
+    return part
+
+
+def _part_to_dict(part) -> dict:
+    """Parte de mensaje como dict; conserva llamadas y respuestas de herramientas, no solo texto."""
+    if "text" in part:
+        return {'text': part.text}
+    return type(part).to_dict(part)
+
+
+def _history_to_dicts(history: list) -> List[dict]:
+    return [{'role': c.role, 'parts': [_part_to_dict(p) for p in c.parts]} for c in history]
+
+
+def _write_history_json(history: list, filename: str):
+    messages = [{'role': message['role'], 'parts': [store_history_blob(part) for part in message['parts']]}
+                for message in _history_to_dicts(history)]
+    # Atómico: un corte a medio escribir no puede dejar sin referencias (y a merced de la
+    # recolección) los blobs de la conversación
+    tmp_filename = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp_filename, "w", encoding="utf-8") as f:
+        json.dump({"format": HISTORY_STORE_FORMAT, "messages": messages}, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_filename, filename)
+
+
+def _read_history_json(filename: str) -> List[dict]:
+    with open(filename, "r", encoding="utf-8") as f:
+        history = json.load(f)
+    if isinstance(history, dict) and history.get("format") == HISTORY_STORE_FORMAT:
+        history = [{'role': message['role'], 'parts': [load_history_blob(h) for h in message['parts']]}
+                   for message in history["messages"]]
+    # Si no, es el formato antiguo: una lista de mensajes con las partes en línea
+    return history
+
+
+def _snapshot_is_current(filename: str) -> bool:
+    """True si la instantánea binaria del historial existe y es igual o más reciente que el JSON."""
+    snapshot_filename = get_history_snapshot_filename(filename)
+    return os.path.exists(snapshot_filename) and (
+        not os.path.exists(filename) or os.path.getmtime(snapshot_filename) >= os.path.getmtime(filename))
+
+
+@hot_path
+def save_chat_history(chat_session, filename: str, theme_manager: ThemeManager, history_format: str = "json"):
     try:
-        with open(filename, "w", encoding="utf-8") as f:
-            json.dump(history_to_save, f, ensure_ascii=False, indent=2)
+        if history_format == "snapshot":
+            filename = get_history_snapshot_filename(filename)
+            save_history_snapshot(chat_session.history, filename)
+        else:
+            _write_history_json(chat_session.history, filename)
         print(theme_manager.style("info_message", f"Historial de chat guardado en {filename}"))
     except Exception as e:
         print(theme_manager.style("error_message", f"Error al guardar el historial: {e}"))
 
 
 def load_chat_history(filename: str, theme_manager: ThemeManager) -> Optional[List]:
+    """
+    Carga el historial de una conversación. Si hay una instantánea binaria igual o más reciente
+    que el JSON, se usa esa (devuelve objetos `Content`); si no, el JSON (devuelve dicts).
+    """
+    snapshot_filename = get_history_snapshot_filename(filename)
+    if _snapshot_is_current(filename):
+        try:
+            history = load_history_snapshot(snapshot_filename)
+            print(theme_manager.style("info_message", f"Historial de chat cargado desde {snapshot_filename}"))
+            return history
+        except Exception as e:
+            print(theme_manager.style("error_message", f"Error al cargar la instantánea del historial: {e}."))
     if not os.path.exists(filename):
         return None
     try:
-        with open(filename, "r", encoding="utf-8") as f:
-            history = json.load(f)
+        history = _read_history_json(filename)
         print(theme_manager.style("info_message", f"Historial de chat cargado desde {filename}"))
         return history
     except Exception as e:
@@ -349,6 +1117,881 @@ def load_chat_history(filename: str, theme_manager: ThemeManager) -> Optional[Li
         return None
 
 
+def _first_user_text(message) -> Optional[str]:
+    """Texto de la primera parte de un mensaje del usuario, sea dict (JSON) o `Content` (instantánea)."""
+    if isinstance(message, dict):
+        role, parts = message.get('role'), message.get('parts') or []
+        text = parts[0].get('text') if parts and isinstance(parts[0], dict) else None
+    else:
+        role, parts = message.role, message.parts
+        text = parts[0].text if parts and "text" in parts[0] else None
+    return text if role == 'user' else None
+
+
+def get_history_snapshot_filename(history_filename: str) -> str:
+    return os.path.splitext(history_filename)[0] + HISTORY_SNAPSHOT_EXTENSION
+
+
+def _encode_varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte, value = value & 0x7F, value >> 7
+        out.append(byte | (0x80 if value else 0))
+        if not value:
+            return bytes(out)
+
+
+def _decode_varint(data: bytes, offset: int) -> tuple:
+    value = shift = 0
+    while True:
+        if offset >= len(data):
+            raise ValueError("instantánea truncada")
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+
+
+@hot_path
+def save_history_snapshot(history: list, filename: str):
+    """Guarda el historial tal cual (mensajes protobuf `Content`), sin pasar por dicts: todas las partes se conservan."""
+    chunks = [HISTORY_SNAPSHOT_MAGIC, bytes([HISTORY_SNAPSHOT_VERSION])]
+    for content in history:
+        data = genai.protos.Content.serialize(content)
+        chunks.append(_encode_varint(len(data)))
+        chunks.append(data)
+    tmp_path = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(b"".join(chunks))
+    os.replace(tmp_path, filename)  # Atómico: una instantánea nunca queda a medio escribir
+
+
+def load_history_snapshot(filename: str) -> List:
+    """Lee una instantánea directamente como objetos `Content`, listos para `start_chat`."""
+    with open(filename, "rb") as f:
+        data = f.read()
+    header_size = len(HISTORY_SNAPSHOT_MAGIC) + 1
+    if data[:len(HISTORY_SNAPSHOT_MAGIC)] != HISTORY_SNAPSHOT_MAGIC:
+        raise ValueError(f"{filename} no es una instantánea de historial")
+    if data[header_size - 1] != HISTORY_SNAPSHOT_VERSION:
+        raise ValueError(f"versión de instantánea no soportada: {data[header_size - 1]}")
+    history = []
+    offset = header_size
+    while offset < len(data):
+        size, offset = _decode_varint(data, offset)
+        if offset + size > len(data):
+            raise ValueError("instantánea truncada")
+        history.append(genai.protos.Content.deserialize(data[offset:offset + size]))
+        offset += size
+    return history
+
+
+def export_history_json(history: list, filename: str):
+    """Exporta el historial como JSON legible (lista de mensajes con las partes en línea)."""
+    with open(filename, "w", encoding="utf-8") as f:
+        json.dump(_history_to_dicts(history), f, ensure_ascii=False, indent=2)
+
+
+_history_file_lock = threading.Lock()  # La cola puede añadir respuestas desde otro hilo
+
+
+def append_to_history_file(filename: str, contents: list):
+    """Añade mensajes a un historial guardado, en el formato que ya tenga (JSON o instantánea)."""
+    with _history_file_lock:
+        if _snapshot_is_current(filename):
+            snapshot_filename = get_history_snapshot_filename(filename)
+            save_history_snapshot(load_history_snapshot(snapshot_filename) + list(contents), snapshot_filename)
+        else:
+            history = _read_history_json(filename) if os.path.exists(filename) else []
+            _write_history_json(content_types.to_contents(history) + list(contents), filename)
+
+
+def _referenced_history_blobs() -> set:
+    referenced = set()
+    history_dir = data_path("history")
+    for filename in os.listdir(history_dir):
+        if not (filename.startswith("chat_history_") and filename.endswith(".json")):
+            continue
+        filename = os.path.join(history_dir, filename)
+        try:
+            with open(filename, "r", encoding="utf-8") as f:
+                history = json.load(f)
+        except Exception as e:
+            raise RuntimeError(f"no se pudo leer {filename} ({e}); no se borrará nada") from e
+        if isinstance(history, dict) and history.get("format") == HISTORY_STORE_FORMAT:
+            for message in history["messages"]:
+                referenced.update(message['parts'])
+    return referenced
+
+
+def gc_history_blobs(theme_manager: ThemeManager, now: Optional[float] = None) -> int:
+    """Borra los blobs de historial que ya no referencia ninguna conversación. Devuelve cuántos."""
+    blobs_dir = data_path("history", HISTORY_BLOBS_DIR)
+    if not os.path.isdir(blobs_dir):
+        return 0
+    try:
+        referenced = _referenced_history_blobs()
+    except RuntimeError as e:
+        print(theme_manager.style("error_message", f"Recolección de historial cancelada: {e}"))
+        return 0
+    now = time.time() if now is None else now
+    removed = 0
+    for prefix in os.listdir(blobs_dir):
+        prefix_dir = os.path.join(blobs_dir, prefix)
+        if not os.path.isdir(prefix_dir):
+            continue
+        for blob_file in os.listdir(prefix_dir):
+            blob_hash = prefix + blob_file[:-len(".json")]
+            blob_path = os.path.join(prefix_dir, blob_file)
+            if (blob_file.endswith(".json") and blob_hash not in referenced
+                    and now - os.path.getmtime(blob_path) > HISTORY_GC_GRACE_SECONDS):
+                os.remove(blob_path)
+                _history_blob_cache.pop(blob_hash, None)
+                _history_blob_touched.pop(blob_hash, None)
+                removed += 1
+        if not os.listdir(prefix_dir):
+            os.rmdir(prefix_dir)
+    return removed
+
+
+# --- Funciones de Caché de Contexto (system prompt y documentos fijados) ---
+
+
+def load_context_cache_index(theme_manager: ThemeManager) -> dict:
+    """Carga el índice local de cachés de contexto creados en el servidor."""
+    index_file = data_path("cache", CONTEXT_CACHE_FILE)
+    if not os.path.exists(index_file):
+        return {}
+    try:
+        with open(index_file, "r", encoding="utf-8") as f:
+            index = json.load(f)
+        return index if isinstance(index, dict) else {}
+    except Exception as e:
+        print(theme_manager.style("warning_message",
+              f"Advertencia: No se pudo leer el índice de caché de contexto ({index_file}): {e}"))
+        return {}
+
+
+def save_context_cache_index(index: dict, theme_manager: ThemeManager):
+    try:
+        with open(data_path("cache", CONTEXT_CACHE_FILE), "w", encoding="utf-8") as f:
+            json.dump(index, f, ensure_ascii=False, indent=2)
+    except Exception as e:
+        print(theme_manager.style("error_message", f"Error al guardar el índice de caché de contexto: {e}"))
+
+
+def _read_pinned_documents(document_paths: list, theme_manager: ThemeManager) -> List[str]:
+    """Lee los documentos fijados de un perfil. Los que no se pueden leer se omiten."""
+    documents = []
+    for path in document_paths or []:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                documents.append(f"[Documento: {os.path.basename(path)}]\n{f.read()}")
+        except Exception as e:
+            print(theme_manager.style("warning_message",
+                  f"Advertencia: No se pudo leer el documento fijado '{path}': {e}. Se omitirá."))
+    return documents
+
+
+def _context_cache_key(model_name: str, system_prompt: str, documents: List[str]) -> str:
+    digest = hashlib.sha256()
+    for piece in [model_name, system_prompt or ""] + documents:
+        digest.update(piece.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def gc_context_cache_index(index: dict, now: Optional[float] = None) -> dict:
+    """Elimina del índice las entradas cuyo caché ya expiró en el servidor."""
+    now = time.time() if now is None else now
+    return {key: entry for key, entry in index.items() if entry.get("expire_at", 0) > now}
+
+
+def get_or_create_cached_content(model_name: str, profile_name: str, system_prompt: str,
+                                 documents: List[str], ttl_seconds: int, theme_manager: ThemeManager,
+                                 tools: Optional[list] = None):
+    """
+    Devuelve un `CachedContent` con el system prompt y los documentos fijados del perfil
+    (ya leídos con `_read_pinned_documents`).
+    Reutiliza (y renueva si está por expirar) el caché registrado localmente; si el contenido
+    cambió, crea uno nuevo y borra el anterior del perfil. Devuelve None si el modelo o la
+    versión del SDK no soportan caché de contexto, para que el llamador use el modo en línea.
+    """
+    try:
+        from google.generativeai import caching
+    except ImportError:
+        print(theme_manager.style("warning_message",
+              "Advertencia: Esta versión de google-generativeai no soporta caché de contexto. "
+              "Usando system prompt en línea."))
+        return None
+
+    # Las herramientas viajan dentro del caché: un modelo creado desde él no admite otras
+    cache_key = _context_cache_key(model_name, system_prompt, documents + [json.dumps(tools, sort_keys=True)])
+    now = time.time()
+    index = load_context_cache_index(theme_manager)
+    live_index = gc_context_cache_index(index, now)
+
+    entry = live_index.get(cache_key)
+    if entry:
+        try:
+            cached_content = caching.CachedContent.get(entry["name"])
+            index_changed = len(live_index) != len(index)
+            if entry["expire_at"] - now < ttl_seconds * CONTEXT_CACHE_REFRESH_FRACTION:
+                cached_content.update(ttl=datetime.timedelta(seconds=ttl_seconds))
+                entry["expire_at"] = now + ttl_seconds
+                index_changed = True
+                print(theme_manager.style("info_message", "Caché de contexto renovado."))
+            if index_changed:
+                save_context_cache_index(live_index, theme_manager)
+            return cached_content
+        except Exception:
+            # El servidor ya no lo tiene (borrado o expirado antes de lo previsto)
+            live_index.pop(cache_key, None)
+
+    # Borrar cachés anteriores de este perfil/modelo: su contenido ya no coincide
+    for stale_key in [k for k, e in live_index.items()
+                      if e.get("profile") == profile_name and e.get("model") == model_name]:
+        stale_entry = live_index.pop(stale_key)
+        try:
+            caching.CachedContent.get(stale_entry["name"]).delete()
+        except Exception:
+            pass
+
+    try:
+        contents = [{'role': 'user', 'parts': [{'text': doc}]} for doc in documents] or None
+        cached_content = caching.CachedContent.create(
+            model=model_name,
+            display_name=f"pygemai-{profile_name}"[:128],
+            system_instruction=system_prompt or None,
+            contents=contents,
+            tools=tools,
+            ttl=datetime.timedelta(seconds=ttl_seconds),
+        )
+    except Exception as e:
+        print(theme_manager.style("warning_message",
+              f"Advertencia: No se pudo crear el caché de contexto para '{model_name}' ({e}). "
+              "Usando system prompt en línea."))
+        if len(live_index) != len(index):
+            save_context_cache_index(live_index, theme_manager)
+        return None
+
+    live_index[cache_key] = {
+        "name": cached_content.name,
+        "model": model_name,
+        "profile": profile_name,
+        "expire_at": now + ttl_seconds,
+    }
+    save_context_cache_index(live_index, theme_manager)
+    print(theme_manager.style("info_message",
+          f"Caché de contexto creado ({cached_content.name}, TTL {ttl_seconds}s)."))
+    return cached_content
+
+
+# --- Registro de uso de tokens (por perfil, modelo y día) ---
+
+
+def _usage_counts(usage_metadata) -> dict:
+    """Tokens de `usage_metadata` (el último chunk del stream trae los totales del turno)."""
+    if usage_metadata is None:
+        return {"prompt_tokens": 0, "cached_tokens": 0, "output_tokens": 0, "total_tokens": 0}
+    return {
+        "prompt_tokens": getattr(usage_metadata, "prompt_token_count", 0) or 0,
+        "cached_tokens": getattr(usage_metadata, "cached_content_token_count", 0) or 0,
+        "output_tokens": getattr(usage_metadata, "candidates_token_count", 0) or 0,
+        "total_tokens": getattr(usage_metadata, "total_token_count", 0) or 0,
+    }
+
+
+class UsageLedger:
+    """
+    Registro local de solo-añadir (una línea JSON por petición). Las escrituras las hace un hilo
+    en segundo plano, así que registrar un turno no añade latencia. También lleva la cuenta de
+    los tokens del día por perfil, para los presupuestos.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self._path = path  # Sin ruta: metrics/ del directorio de datos, resuelto al escribir
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._spent = {}  # (día, perfil) -> tokens
+
+    @property
+    def path(self) -> str:
+        return self._path or data_path("metrics", USAGE_LEDGER_FILE)
+
+    def record(self, profile: str, model: str, usage: dict, latency: float,
+               first_chunk_latency: Optional[float], status: str, mode: str,
+               hedged: bool = False, hedge_won: bool = False):
+        now = datetime.datetime.now()
+        entry = dict(ts=now.isoformat(timespec="seconds"), day=now.date().isoformat(), profile=profile,
+                     model=model, status=status, mode=mode, latency_ms=round(latency * 1000),
+                     first_chunk_ms=None if first_chunk_latency is None else round(first_chunk_latency * 1000),
+                     **usage)
+        if hedged:  # Se lanzó una petición duplicada; hedge_won indica si ganó la duplicada
+            entry.update(hedged=True, hedge_won=hedge_won)
+        with self._lock:
+            key = (entry["day"], profile)
+            if key in self._spent:
+                self._spent[key] += usage["total_tokens"]
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._write_loop, daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+        self._queue.put(entry)
+
+    def _write_loop(self):
+        while True:
+            entry = self._queue.get()
+            if entry is None:
+                return
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                    while not self._queue.empty():  # Agrupar lo que se haya acumulado
+                        entry = self._queue.get_nowait()
+                        if entry is None:
+                            return
+                        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            except OSError:
+                pass  # El registro es informativo; nunca debe romper la sesión
+
+    def close(self, timeout: float = 2.0):
+        """Espera a que se escriban las entradas pendientes (se llama al salir)."""
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+    def iter_entries(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue  # Línea truncada (p. ej. por un corte de luz): se ignora
+
+    def spent_on(self, profile: str, day: Optional[str] = None) -> int:
+        """Tokens gastados por un perfil en un día. Se lee el registro una vez y luego se lleva en memoria."""
+        day = day or datetime.date.today().isoformat()
+        with self._lock:
+            if (day, profile) not in self._spent:
+                self._spent[(day, profile)] = sum(
+                    entry.get("total_tokens", 0) for entry in self.iter_entries()
+                    if entry.get("day") == day and entry.get("profile") == profile)
+            return self._spent[(day, profile)]
+
+    def summarize(self, by: str, since: Optional[str] = None) -> List[tuple]:
+        """Filas (clave, totales) agrupadas por profile, model o day, en una sola pasada."""
+        totals = {}
+        for entry in self.iter_entries():
+            if since and entry.get("day", "") < since:
+                continue
+            row = totals.setdefault(entry.get(by) or "-", {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0,
+                                                            "output_tokens": 0, "total_tokens": 0, "latency_ms": 0,
+                                                            "hedged": 0, "hedge_wins": 0})
+            row["requests"] += 1
+            row["hedged"] += 1 if entry.get("hedged") else 0
+            row["hedge_wins"] += 1 if entry.get("hedge_won") else 0
+            for field in ("prompt_tokens", "cached_tokens", "output_tokens", "total_tokens", "latency_ms"):
+                row[field] += entry.get(field) or 0
+        return sorted(totals.items())
+
+
+usage_ledger = UsageLedger()
+
+
+def check_token_budget(profile_name: str, budget: dict, theme_manager: ThemeManager) -> bool:
+    """Antes de enviar: avisa al pasar el límite blando y bloquea (False) al pasar el duro."""
+    if not budget:
+        return True
+    spent = usage_ledger.spent_on(profile_name)
+    hard_limit = budget.get("hard_tokens_per_day")
+    soft_limit = budget.get("soft_tokens_per_day")
+    if hard_limit and spent >= hard_limit:
+        print(theme_manager.style("error_message",
+              f"Presupuesto diario del perfil '{profile_name}' agotado ({spent}/{hard_limit} tokens). "
+              "Mensaje no enviado."))
+        return False
+    if soft_limit and spent >= soft_limit:
+        print(theme_manager.style("warning_message",
+              f"Aviso: el perfil '{profile_name}' lleva {spent} tokens hoy (límite blando {soft_limit})."))
+    return True
+
+
+# --- Recuperación local (RAG) sobre documentación del proyecto ---
+
+
+def _require_numpy():
+    try:
+        import numpy
+    except ImportError:
+        print("\033[91mEl índice de documentos necesita 'numpy'. Instálalo con: "
+              "pip install numpy  (o pip install PyGemAi[rag])\033[0m")
+        sys.exit(1)
+    return numpy
+
+
+def _local_embed_texts(texts: List[str], dim: int = LOCAL_EMBEDDING_DIM):
+    """Embedding local por hashing de palabras: determinista, sin red. Sustituto para pruebas."""
+    np = _require_numpy()
+    vectors = np.zeros((len(texts), dim), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for word in re.findall(r"\w+", text.lower()):
+            digest = hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest()
+            bucket = int.from_bytes(digest[:4], "little") % dim
+            vectors[row, bucket] += 1.0 if digest[4] & 1 else -1.0
+    return vectors
+
+
+def embed_texts(texts: List[str], embedder: str, task_type: str):
+    """Matriz (len(texts), dim) de embeddings normalizados. Las llamadas a la API van por lotes."""
+    np = _require_numpy()
+    if embedder == LOCAL_EMBEDDER:
+        vectors = _local_embed_texts(texts)
+    else:
+        rows = []
+        for start in range(0, len(texts), EMBED_BATCH_SIZE):
+            result = genai.embed_content(model=embedder, content=texts[start:start + EMBED_BATCH_SIZE],
+                                         task_type=task_type)
+            rows.extend(result["embedding"])
+        vectors = np.asarray(rows, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1.0, norms)
+
+
+def _chunk_text_file(text: str) -> List[tuple]:
+    """Divide por líneas en fragmentos de ~RAG_CHUNK_CHARS, solapando unas líneas. Devuelve (línea, texto)."""
+    lines = text.splitlines()
+    chunks = []
+    start = 0
+    while start < len(lines):
+        end, size = start, 0
+        while end < len(lines) and (size == 0 or size + len(lines[end]) <= RAG_CHUNK_CHARS):
+            size += len(lines[end]) + 1
+            end += 1
+        chunk = "\n".join(lines[start:end]).strip()
+        if chunk:
+            chunks.append((start + 1, chunk))
+        if end >= len(lines):
+            break
+        start = max(start + 1, end - RAG_CHUNK_OVERLAP_LINES)
+    return chunks
+
+
+def _iter_indexable_files(source_dir: str):
+    for directory, dirs, names in os.walk(source_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith(".") and d not in ("node_modules", "__pycache__"))
+        for name in sorted(names):
+            path = os.path.join(directory, name)
+            if os.path.splitext(name)[1].lower() in RAG_TEXT_EXTENSIONS and \
+                    os.path.getsize(path) <= RAG_MAX_FILE_BYTES:
+                yield path
+
+
+def build_rag_index(source_dir: str, index_dir: str, embedder: str, theme_manager: ThemeManager) -> dict:
+    """
+    Construye (o actualiza) el índice de `source_dir`. Solo se vuelven a trocear y a embeber
+    los archivos cuyo hash cambió; los vectores del resto se reutilizan tal cual.
+    """
+    np = _require_numpy()
+    old_metadata, old_vectors = {}, None
+    metadata_path = os.path.join(index_dir, RAG_METADATA_FILE)
+    vectors_path = os.path.join(index_dir, RAG_VECTORS_FILE)
+    if os.path.exists(metadata_path) and os.path.exists(vectors_path):
+        with open(metadata_path, "r", encoding="utf-8") as f:
+            old_metadata = json.load(f)
+        if old_metadata.get("embedder") == embedder:
+            old_vectors = np.load(vectors_path, mmap_mode="r")
+        else:
+            old_metadata = {}  # Otro modelo de embeddings: vectores incompatibles
+
+    files, chunks, vector_blocks = {}, [], []
+    pending_texts, pending_slots = [], []
+    stats = {"reused": 0, "embedded": 0, "removed": 0}
+    for path in _iter_indexable_files(source_dir):
+        relpath = os.path.relpath(path, source_dir)
+        with open(path, "rb") as f:
+            raw = f.read()
+        file_hash = hashlib.sha256(raw).hexdigest()
+        previous = old_metadata.get("files", {}).get(relpath)
+        first_row = len(chunks)
+        if previous and previous["sha256"] == file_hash and old_vectors is not None:
+            start, end = previous["rows"]
+            chunks.extend(old_metadata["chunks"][start:end])
+            vector_blocks.append(np.asarray(old_vectors[start:end]))
+            stats["reused"] += 1
+        else:
+            file_chunks = _chunk_text_file(raw.decode("utf-8", errors="replace"))
+            for line, text in file_chunks:
+                chunks.append({"file": relpath, "line": line, "text": text})
+            pending_texts.extend(f"{relpath}\n{text}" for _, text in file_chunks)
+            pending_slots.append((len(vector_blocks), len(file_chunks)))
+            vector_blocks.append(None)  # Se rellena tras embeber todos los pendientes en lote
+            stats["embedded"] += 1
+        files[relpath] = {"sha256": file_hash, "rows": [first_row, len(chunks)]}
+    stats["removed"] = len(set(old_metadata.get("files", {})) - set(files))
+
+    if pending_texts:
+        print(theme_manager.style("info_message", f"Generando embeddings de {len(pending_texts)} fragmento(s)..."))
+    new_vectors = embed_texts(pending_texts, embedder, "retrieval_document") if pending_texts else None
+    offset = 0
+    for block_index, count in pending_slots:
+        vector_blocks[block_index] = new_vectors[offset:offset + count] if count else None
+        offset += count
+    blocks = [block for block in vector_blocks if block is not None and len(block)]
+    dim = blocks[0].shape[1] if blocks else 0
+    vectors = np.concatenate(blocks).astype(np.float32) if blocks else np.zeros((0, dim), dtype=np.float32)
+
+    os.makedirs(index_dir, exist_ok=True)
+    tmp_vectors = vectors_path + ".tmp.npy"
+    np.save(tmp_vectors, vectors)
+    del old_vectors, vector_blocks, blocks  # Liberar el mmap antes de reemplazar el archivo
+    os.replace(tmp_vectors, vectors_path)
+    with open(metadata_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"embedder": embedder, "dim": int(dim), "source_dir": os.path.abspath(source_dir),
+                   "files": files, "chunks": chunks}, f, ensure_ascii=False)
+    os.replace(metadata_path + ".tmp", metadata_path)
+    stats["chunks"] = len(chunks)
+    return stats
+
+
+class RetrievalIndex:
+    """Índice abierto en modo mmap: la búsqueda es un producto matriz-vector sobre todos los fragmentos."""
+
+    def __init__(self, index_dir: str):
+        np = _require_numpy()
+        with open(os.path.join(index_dir, RAG_METADATA_FILE), "r", encoding="utf-8") as f:
+            metadata = json.load(f)
+        self.embedder = metadata["embedder"]
+        self.chunks = metadata["chunks"]
+        self.vectors = np.load(os.path.join(index_dir, RAG_VECTORS_FILE), mmap_mode="r")
+
+    def search(self, query: str, top_k: int = DEFAULT_RAG_TOP_K, min_score: float = DEFAULT_RAG_MIN_SCORE) -> list:
+        np = _require_numpy()
+        if not len(self.chunks):
+            return []
+        query_vector = embed_texts([query], self.embedder, "retrieval_query")[0]
+        scores = self.vectors @ query_vector  # Filas ya normalizadas: similitud coseno
+        top_k = min(top_k, len(scores))
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+        return [dict(self.chunks[i], score=float(scores[i])) for i in best if scores[i] >= min_score]
+
+
+class SemanticCache:
+    """
+    Pares prompt/respuesta anteriores con el embedding del prompt. Un prompt nuevo cuya similitud
+    con uno guardado supera el umbral reutiliza su respuesta. Al llenarse, se descarta la entrada
+    usada hace más tiempo. Hay un caché por perfil, modelo y system prompt. Los aciertos solo
+    cambian la memoria; se guardan con el siguiente store() o al salir (flush).
+    """
+
+    def __init__(self, cache_dir: str, embedder: str, threshold: float, capacity: int):
+        self.cache_dir = cache_dir
+        self.embedder = embedder
+        self.threshold = threshold
+        self.capacity = max(1, capacity)
+        self.history_independent = False
+        self.entries: List[dict] = []
+        self.vectors = None
+        self._dirty = False  # Aciertos (hits, last_used) aún sin guardar
+        self._flush_registered = False
+        np = _require_numpy()
+        entries_path = os.path.join(cache_dir, "entries.json")
+        if os.path.exists(entries_path):
+            try:
+                with open(entries_path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                if data.get("embedder") == embedder:
+                    self.entries = data["entries"]
+                    self.vectors = np.load(os.path.join(cache_dir, "vectors.npy"))
+            except (OSError, ValueError, KeyError):
+                self.entries, self.vectors = [], None  # Caché ilegible: se empieza de cero
+
+    @classmethod
+    def for_profile(cls, profile: dict, model_name: str) -> Optional["SemanticCache"]:
+        settings = (profile or {}).get("semantic_cache") or {}
+        if not settings.get("enabled"):
+            return None
+        key_source = json.dumps([profile.get("profile_name"), model_name, profile.get("system_prompt") or ""])
+        cache_dir = os.path.join(data_path("cache", SEMANTIC_CACHE_DIR),
+                                 hashlib.sha256(key_source.encode("utf-8")).hexdigest()[:16])
+        cache = cls(cache_dir, settings.get("embedder", DEFAULT_EMBEDDING_MODEL),
+                    float(settings.get("threshold", DEFAULT_SEMANTIC_CACHE_THRESHOLD)),
+                    int(settings.get("capacity", DEFAULT_SEMANTIC_CACHE_CAPACITY)))
+        cache.history_independent = bool(settings.get("history_independent"))
+        return cache
+
+    def embed(self, prompt: str):
+        return embed_texts([prompt], self.embedder, "semantic_similarity")[0]
+
+    def lookup(self, vector) -> Optional[tuple]:
+        """(entrada, similitud) de la mejor coincidencia por encima del umbral, o None."""
+        if not self.entries:
+            return None
+        scores = self.vectors @ vector
+        best = int(scores.argmax())
+        if scores[best] < self.threshold:
+            return None
+        entry = self.entries[best]
+        entry["last_used"] = time.time()
+        entry["hits"] = entry.get("hits", 0) + 1
+        self._dirty = True
+        if not self._flush_registered:
+            self._flush_registered = True
+            atexit.register(self.flush)
+        return entry, float(scores[best])
+
+    def store(self, prompt: str, vector, answer: str):
+        np = _require_numpy()
+        entry = {"prompt": prompt, "answer": answer, "created": time.time(), "last_used": time.time(), "hits": 0}
+        if self.vectors is None:
+            self.vectors = vector[np.newaxis, :].astype(np.float32)
+            self.entries = [entry]
+        elif len(self.entries) < self.capacity:
+            self.vectors = np.vstack([self.vectors, vector[np.newaxis, :]])
+            self.entries.append(entry)
+        else:
+            lru = min(range(len(self.entries)), key=lambda i: self.entries[i].get("last_used", 0))
+            self.vectors[lru] = vector
+            self.entries[lru] = entry
+        self._save()
+
+    def flush(self):
+        """Guarda los aciertos pendientes. Los vectores no cambian con un acierto: solo entries.json."""
+        if self._dirty:
+            self._save(vectors=False)
+
+    def _save(self, vectors: bool = True):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        if vectors:
+            np = _require_numpy()
+            vectors_path = os.path.join(self.cache_dir, "vectors.npy")
+            np.save(vectors_path + ".tmp.npy", self.vectors)
+            os.replace(vectors_path + ".tmp.npy", vectors_path)
+        self._dirty = False
+        entries_path = os.path.join(self.cache_dir, "entries.json")
+        with open(entries_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"embedder": self.embedder, "entries": self.entries}, f, ensure_ascii=False)
+        os.replace(entries_path + ".tmp", entries_path)
+
+
+def _semantic_cache_lookup(cache: SemanticCache, prompt: str, theme_manager: ThemeManager) -> tuple:
+    """(vector, coincidencia) para el prompt. Si el embedding falla, el caché se ignora en este turno."""
+    try:
+        vector = cache.embed(prompt)
+    except Exception as e:
+        print(theme_manager.style("warning_message", f"Advertencia: Caché semántico no disponible: {e}"))
+        return None, None
+    return vector, cache.lookup(vector)
+
+
+def augment_prompt_with_retrieval(user_input: str, retrieved: list) -> str:
+    """Antepone al mensaje solo los fragmentos recuperados para este turno."""
+    if not retrieved:
+        return user_input
+    context = "\n\n".join(f"[{n}] {chunk['file']} (línea {chunk['line']}):\n{chunk['text']}"
+                           for n, chunk in enumerate(retrieved, 1))
+    return ("Contexto recuperado de la documentación local (úsalo si es relevante):\n\n"
+            f"{context}\n\n---\n\n{user_input}")
+
+
+# --- Adjuntos (/attach): imágenes reducidas en paralelo y archivos grandes por la File API ---
+
+
+def _file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_CHUNK_BYTES), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _downscale_image(path: str, max_side: int, quality: int) -> tuple:
+    """
+    (mime_type, bytes, tamaño original) de la imagen reducida a `max_side` píxeles de lado mayor
+    y recodificada. Se ejecuta en un proceso aparte, por eso solo recibe y devuelve datos simples.
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(path) as image:
+        resized = max(image.size) > max_side
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+        output = io.BytesIO()
+        if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+            mime_type = "image/png"
+            image.save(output, format="PNG", optimize=True)
+        else:
+            mime_type = "image/jpeg"
+            image.convert("RGB").save(output, format="JPEG", quality=quality, optimize=True)
+    data = output.getvalue()
+    original_size = os.path.getsize(path)
+    if not resized and original_size <= len(data):
+        # Ya era pequeña y recodificarla no ahorra nada: se envía tal cual
+        with open(path, "rb") as f:
+            data = f.read()
+        mime_type = ATTACHMENT_IMAGE_TYPES[os.path.splitext(path)[1].lower()]
+    return mime_type, data, original_size
+
+
+class UploadCache:
+    """
+    Archivos ya subidos a la File API, por clave y hash de su contenido (UPLOAD_CACHE_FILE).
+    Volver a adjuntar el mismo archivo con la misma clave reutiliza su URI mientras no caduque en
+    el servidor; otra clave (otro proyecto) no puede leerlo y lo sube de nuevo.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self._path = path
+        self._lock = threading.Lock()
+        self._entries = None  # "api_key_id:sha256" -> {"uri", "mime_type", "name", "expires"}
+
+    @property
+    def path(self) -> str:
+        return self._path or data_path("cache", UPLOAD_CACHE_FILE)
+
+    def _load(self):
+        if self._entries is None:
+            self._entries = {}
+            if os.path.exists(self.path):
+                try:
+                    with open(self.path, "r", encoding="utf-8") as f:
+                        self._entries = json.load(f)
+                except (OSError, ValueError):
+                    pass  # Caché ilegible: se vuelve a subir lo que haga falta
+
+    def get(self, key_id: str, digest: str) -> Optional[dict]:
+        with self._lock:
+            self._load()
+            entry = self._entries.get(f"{key_id}:{digest}")
+            if entry and entry["expires"] - UPLOAD_EXPIRY_MARGIN_SECONDS > time.time():
+                return entry
+            return None
+
+    def put(self, key_id: str, digest: str, uri: str, mime_type: str, name: str, expires: float):
+        with self._lock:
+            self._load()
+            now = time.time()
+            # Sin caducados ni entradas sin clave (versiones anteriores)
+            self._entries = {k: v for k, v in self._entries.items() if ":" in k and v["expires"] > now}
+            self._entries[f"{key_id}:{digest}"] = {"uri": uri, "mime_type": mime_type, "name": name, "expires": expires}
+            try:
+                with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+                    json.dump(self._entries, f, indent=2)
+                os.replace(self.path + ".tmp", self.path)
+            except OSError:
+                pass  # Sin caché solo se pierde la deduplicación
+
+
+upload_cache = UploadCache()
+
+
+def _upload_attachment(source, digest: str, mime_type: str, display_name: str, cache: UploadCache):
+    """
+    Parte `file_data` para `source` (ruta o bytes). Si el mismo contenido ya está subido con la
+    clave configurada, no se sube otra vez.
+    """
+    key_id = current_key_id() or ""
+    entry = cache.get(key_id, digest)
+    if entry is None:
+        # Con una ruta, la librería lee y sube el archivo por bloques (subida reanudable)
+        uploaded = genai.upload_file(source if isinstance(source, str) else io.BytesIO(source),
+                                     mime_type=mime_type, display_name=display_name)
+        waited = 0.0
+        while uploaded.state.name == "PROCESSING" and waited < UPLOAD_PROCESSING_TIMEOUT_SECONDS:
+            time.sleep(1)
+            waited += 1
+            uploaded = genai.get_file(uploaded.name)
+        if uploaded.state.name == "FAILED":
+            raise RuntimeError(f"la File API no pudo procesar {display_name}")
+        if uploaded.state.name != "ACTIVE":
+            raise RuntimeError(f"la File API no terminó de procesar {display_name} en "
+                               f"{UPLOAD_PROCESSING_TIMEOUT_SECONDS} s (estado {uploaded.state.name}); "
+                               "vuelve a adjuntarlo más tarde")
+        entry = {"uri": uploaded.uri, "mime_type": uploaded.mime_type or mime_type}
+        cache.put(key_id, digest, uploaded.uri, entry["mime_type"], uploaded.name, uploaded.expiration_time.timestamp())
+    return genai.protos.Part(file_data={"mime_type": entry["mime_type"], "file_uri": entry["uri"]})
+
+
+def _run_downscale(function, *args):
+    try:
+        return function(*args)
+    except Exception as e:  # Imagen corrupta o formato no reconocido
+        return e
+
+
+def prepare_attachments(paths: List[str], settings: dict, theme_manager: ThemeManager,
+                        cache: Optional[UploadCache] = None) -> List:
+    """
+    Convierte rutas de imágenes y PDF en partes de mensaje. Las imágenes se reducen y recodifican
+    en un pool de procesos; lo que supera `inline_max_bytes` se sube por la File API.
+    """
+    cache = cache or upload_cache
+    inline_max_bytes = int(settings["inline_max_bytes"])
+    parts = {}
+    images = []
+    for index, path in enumerate(paths):
+        path = os.path.expanduser(path)
+        extension = os.path.splitext(path)[1].lower()
+        if not os.path.isfile(path):
+            print(theme_manager.style("error_message", f"No existe el archivo: {path}"))
+        elif extension in ATTACHMENT_IMAGE_TYPES:
+            images.append((index, path))
+        elif extension in ATTACHMENT_DOCUMENT_TYPES:
+            mime_type = ATTACHMENT_DOCUMENT_TYPES[extension]
+            try:
+                if os.path.getsize(path) <= inline_max_bytes:
+                    with open(path, "rb") as f:
+                        parts[index] = genai.protos.Part(inline_data={"mime_type": mime_type, "data": f.read()})
+                else:
+                    parts[index] = _upload_attachment(path, _file_sha256(path), mime_type,
+                                                      os.path.basename(path), cache)
+            except Exception as e:
+                print(theme_manager.style("error_message", f"No se pudo adjuntar {path}: {e}"))
+        else:
+            print(theme_manager.style("error_message",
+                  f"Tipo de archivo no soportado: {path} (imágenes: "
+                  f"{', '.join(sorted(ATTACHMENT_IMAGE_TYPES))}; documentos: {', '.join(ATTACHMENT_DOCUMENT_TYPES)})"))
+
+    if images:
+        try:
+            import PIL  # noqa: F401  (solo para comprobar que está instalado)
+        except ImportError:
+            print(theme_manager.style("error_message", "Reducir imágenes necesita 'Pillow'. Instálalo con: "
+                                      "pip install Pillow  (o pip install PyGemAi[attach])"))
+            images = []
+    if images:
+        max_side, quality = int(settings["max_side"]), int(settings["quality"])
+        if len(images) == 1:  # Una sola imagen: arrancar procesos costaría más que reducirla aquí
+            results = [_run_downscale(_downscale_image, images[0][1], max_side, quality)]
+        else:
+            workers = min(len(images), settings.get("workers") or os.cpu_count() or 1)
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(_downscale_image, path, max_side, quality) for _, path in images]
+                results = [_run_downscale(future.result) for future in futures]
+        for (index, path), result in zip(images, results):
+            if isinstance(result, Exception):
+                print(theme_manager.style("error_message", f"No se pudo procesar la imagen {path}: {result}"))
+                continue
+            mime_type, data, original_size = result
+            print(theme_manager.style("info_message", f"  {os.path.basename(path)}: "
+                  f"{original_size / 1024:.0f} KB -> {len(data) / 1024:.0f} KB"))
+            try:
+                if len(data) <= inline_max_bytes:
+                    parts[index] = genai.protos.Part(inline_data={"mime_type": mime_type, "data": data})
+                else:
+                    parts[index] = _upload_attachment(data, hashlib.sha256(data).hexdigest(), mime_type,
+                                                      os.path.basename(path), cache)
+            except Exception as e:
+                print(theme_manager.style("error_message", f"No se pudo adjuntar {path}: {e}"))
+    return [parts[index] for index in sorted(parts)]
+
+
 # --- Funciones de Formateo de Salida ---
 
 
@@ -638,24 +2281,141 @@ def process_standard_markdown(text: str, theme_manager: ThemeManager) -> str:
     return text
 
 
-def format_gemini_output(text: str, theme_manager: ThemeManager) -> str:
-    processed_parts = []
-    last_end = 0
-    for match in re.finditer(r"```(\w*)\n?(.*?)```", text, flags=re.DOTALL):
-        pre_match_text = text[last_end:match.start()]
-        processed_parts.append(process_standard_markdown(pre_match_text, theme_manager))
-        lang = match.group(1) or ""
-        code_content = match.group(2).strip('\n')
-        indented_code = "\n".join([f"  {line}" for line in code_content.split('\n')])
-        lang_styled = theme_manager.style("code_block_lang", f"```{lang}", apply_reset=False)
-        content_styled = theme_manager.style("code_block_content", indented_code)
-        code_block_formatted = (f"{lang_styled}{Colors.RESET}\n{content_styled}\n"
-                                f"{theme_manager.style('code_block_lang', '```')}")
-        processed_parts.append(code_block_formatted)
-        last_end = match.end()
-    remaining_text = text[last_end:]
-    processed_parts.append(process_standard_markdown(remaining_text, theme_manager))
-    base_response_color = theme_manager.get_color("response_text")
+CODE_BLOCK_PATTERN = re.compile(r"```(\w*)\n?(.*?)```", flags=re.DOTALL)
+
+
+class CodeHighlighter:
+    """
+    Resaltado de sintaxis por lenguaje para los bloques de código, con Pygments si está instalado.
+    La librería se importa con el primer bloque (no al arrancar), los lexers se guardan por lenguaje
+    y los bloques ya resaltados por contenido: un bloque resaltado mientras llegaba el stream
+    (`prefetch`) no se vuelve a procesar al mostrar la respuesta.
+    """
+
+    def __init__(self, max_block_chars: int = HIGHLIGHT_MAX_BLOCK_CHARS, cache_size: int = HIGHLIGHT_CACHE_SIZE):
+        self.max_block_chars = max_block_chars
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._pygments = None  # Módulo una vez importado; False si no está instalado
+        self._formatter = None
+        self._lexers = {}
+        self._cache = {}    # (lenguaje, código) -> texto resaltado; el orden de inserción hace de LRU
+        self._pending = {}  # (lenguaje, código) -> Future de un prefetch en curso
+        self._executor = None
+
+    def _load(self) -> bool:
+        if self._pygments is None:
+            try:
+                import pygments
+                import pygments.formatters
+                import pygments.lexers
+                import pygments.util
+                self._formatter = pygments.formatters.Terminal256Formatter(style=HIGHLIGHT_STYLE)
+                self._pygments = pygments
+            except ImportError:
+                self._pygments = False
+        return bool(self._pygments)
+
+    def _lexer(self, lang: str):
+        if lang not in self._lexers:
+            try:
+                self._lexers[lang] = self._pygments.lexers.get_lexer_by_name(lang, stripnl=False, ensurenl=False)
+            except self._pygments.util.ClassNotFound:
+                self._lexers[lang] = None  # Lenguaje desconocido: color plano, sin volver a buscarlo
+        return self._lexers[lang]
+
+    def _highlight_uncached(self, key: tuple) -> Optional[str]:
+        with self._lock:
+            if not self._load():
+                return None
+            lexer = self._lexer(key[0])
+        if lexer is None:
+            return None
+        highlighted = self._pygments.highlight(key[1], lexer, self._formatter).rstrip("\n")
+        with self._lock:
+            self._cache[key] = highlighted
+            while len(self._cache) > self.cache_size:
+                del self._cache[next(iter(self._cache))]
+        return highlighted
+
+    def highlight(self, lang: str, code: str) -> Optional[str]:
+        """Código con colores ANSI, o None (sin lenguaje, desconocido, bloque enorme o sin Pygments)."""
+        if not lang or len(code) > self.max_block_chars:
+            return None
+        key = (lang.lower(), code)
+        with self._lock:
+            if key in self._cache:
+                self._cache[key] = self._cache.pop(key)  # Usado ahora: al final de la cola LRU
+                return self._cache[key]
+            pending = self._pending.get(key)
+        if pending is not None:
+            return pending.result()
+        return self._highlight_uncached(key)
+
+    def prefetch(self, lang: str, code: str):
+        """Resalta en segundo plano un bloque que acaba de cerrarse en el stream."""
+        if not lang or len(code) > self.max_block_chars or self._pygments is False:
+            return
+        key = (lang.lower(), code)
+        with self._lock:
+            if key in self._cache or key in self._pending:
+                return
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            future = self._executor.submit(self._highlight_uncached, key)
+            self._pending[key] = future
+        future.add_done_callback(lambda _: self._discard_pending(key))
+
+    def _discard_pending(self, key: tuple):
+        with self._lock:
+            self._pending.pop(key, None)
+
+
+code_highlighter = CodeHighlighter()
+
+
+class CodeFenceTracker:
+    """Sigue el texto del stream y manda a resaltar cada bloque ``` en cuanto se cierra."""
+
+    def __init__(self, highlighter: CodeHighlighter):
+        self.highlighter = highlighter
+        self._text = ""
+        self._scan_from = 0  # Fin del último bloque cerrado
+
+    def feed(self, text: str):
+        previous_length = len(self._text)
+        self._text += text
+        # Solo hace falta buscar si el texto nuevo (o su unión con el anterior) trae una valla ```
+        if "```" not in self._text[max(self._scan_from, previous_length - 2):]:
+            return
+        for match in CODE_BLOCK_PATTERN.finditer(self._text, self._scan_from):
+            self.highlighter.prefetch(match.group(1), match.group(2).strip('\n'))
+            self._scan_from = match.end()
+
+
+@hot_path
+def format_gemini_output(text: str, theme_manager: ThemeManager) -> str:
+    processed_parts = []
+    last_end = 0
+    for match in CODE_BLOCK_PATTERN.finditer(text):
+        pre_match_text = text[last_end:match.start()]
+        processed_parts.append(process_standard_markdown(pre_match_text, theme_manager))
+        lang = match.group(1) or ""
+        code_content = match.group(2).strip('\n')
+        lang_styled = theme_manager.style("code_block_lang", f"```{lang}", apply_reset=False)
+        highlighted = code_highlighter.highlight(lang, code_content)
+        if highlighted is None:  # Sin resaltado: todo el bloque en el color plano del tema
+            indented_code = "\n".join([f"  {line}" for line in code_content.split('\n')])
+            content_styled = theme_manager.style("code_block_content", indented_code)
+        else:
+            content_styled = "\n".join(f"  {line}" for line in highlighted.split('\n')) + Colors.RESET
+        code_block_formatted = (f"{lang_styled}{Colors.RESET}\n{content_styled}\n"
+                                f"{theme_manager.style('code_block_lang', '```')}")
+        processed_parts.append(code_block_formatted)
+        last_end = match.end()
+    remaining_text = text[last_end:]
+    processed_parts.append(process_standard_markdown(remaining_text, theme_manager))
+    base_response_color = theme_manager.get_color("response_text")
     final_content = "".join(processed_parts)
     # Only apply base color if content is not empty and not already starting with an ANSI code from markdown
     if final_content.strip() and not final_content.startswith("\033["):
@@ -663,48 +2423,2967 @@ def format_gemini_output(text: str, theme_manager: ThemeManager) -> str:
     return final_content  # Already colored or empty
 
 
+# --- Entrada del chat: pegado de bloques, modo multilínea e historial de prompts ---
+
+
+ANSI_ESCAPE_PATTERN = re.compile(r"\x1b\[[0-9;]*m")
+ESCAPE_SEQUENCE_PATTERN = re.compile(r"\x1b(\[[0-9;]*[A-Za-z~]|O[A-Za-z]|[\r\nbf\x7f])")
+PARTIAL_ESCAPE_PATTERN = re.compile(r"\x1b(\[[0-9;]*|O)?")
+PRINTABLE_RUN_PATTERN = re.compile(r"[^\x00-\x08\x0a-\x1f\x7f]+")  # Tabuladores incluidos
+CONTROL_CHARS_PATTERN = re.compile(r"[\x00-\x08\x0a-\x1f\x7f]")
+WORD_BEFORE_PATTERN = re.compile(r"\S+\s*\Z")
+WORD_AFTER_PATTERN = re.compile(r"\s*\S+")
+ESCAPE_KEYS = {
+    "[A": "up", "[B": "down", "[C": "right", "[D": "left", "OA": "up", "OB": "down", "OC": "right", "OD": "left",
+    "[H": "home", "[F": "end", "OH": "home", "OF": "end", "[1~": "home", "[7~": "home", "[4~": "end", "[8~": "end",
+    "[3~": "delete", "[1;5D": "word_left", "[1;5C": "word_right", "[1;3D": "word_left", "[1;3C": "word_right",
+    "b": "word_left", "f": "word_right", "\x7f": "kill_word", "\r": "alt_enter", "\n": "alt_enter",
+}
+CONTROL_KEYS = {
+    "\x7f": "backspace", "\x08": "backspace", "\x01": "home", "\x05": "end", "\x02": "left", "\x06": "right",
+    "\x10": "up", "\x0e": "down", "\x03": "interrupt", "\x04": "eof", "\x07": "cancel", "\x12": "search",
+    "\x0b": "kill_end", "\x15": "kill_start", "\x17": "kill_word",
+}
+
+
+class PromptHistory:
+    """
+    Historial de prompts en disco, de solo-añadir: una línea JSON por prompt y, en un índice
+    aparte, el desplazamiento de cada línea (8 bytes por prompt). Abrirlo solo lee el índice,
+    recuperar un prompt es un seek y la búsqueda inversa recorre el archivo mapeado en memoria,
+    así que nada depende de cargar los prompts anteriores, aunque sean cientos de miles.
+
+    Varias sesiones pueden compartirlo: cada escritura (y cada reparación al abrirlo) se hace con
+    un flock exclusivo sobre el propio historial, y cada prompt se añade con una sola escritura
+    O_APPEND. Sin fcntl (Windows) no hay bloqueo entre sesiones.
+    """
+
+    def __init__(self, path: str, index_path: Optional[str] = None):
+        self.path = path
+        self.index_path = index_path or os.path.splitext(path)[0] + ".idx"
+        self._offsets = None  # array("q"): dónde empieza cada prompt
+        self._size = 0        # Fin del último prompt completo que conoce esta sesión
+
+    @contextlib.contextmanager
+    def _locked(self):
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            yield fd
+        finally:
+            os.close(fd)  # También libera el flock
+
+    def _scan(self, offsets: array.array, position: int) -> int:
+        """Añade a `offsets` los prompts completos a partir de `position`; devuelve dónde acaba el último."""
+        with open(self.path, "rb") as f:
+            f.seek(position)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                offsets.append(position)
+                position += len(line)
+        return position
+
+    def _write_index(self, offsets: array.array):
+        with open(self.index_path + ".tmp", "wb") as f:
+            offsets.tofile(f)
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+    def _load(self):
+        if self._offsets is not None:
+            return
+        offsets = array.array("q")
+        with self._locked() as fd:
+            size = os.fstat(fd).st_size
+            try:
+                with open(self.index_path, "rb") as f:
+                    data = f.read()
+                offsets.frombytes(data[:len(data) - len(data) % offsets.itemsize])
+            except OSError:
+                pass
+            if offsets and not self._starts_entry(offsets[-1], size):
+                offsets = array.array("q")  # Índice dañado o de otro archivo: se reconstruye
+            indexed = len(offsets)
+            position = 0
+            if offsets:
+                with open(self.path, "rb") as f:
+                    f.seek(offsets[-1])
+                    position = offsets[-1] + len(f.readline())
+            # Prompts escritos sin su entrada de índice (corte entre las dos escrituras)
+            position = self._scan(offsets, position)
+            if position < size:
+                # Con el bloqueo tomado nadie está escribiendo: es una línea a medias de un proceso que murió
+                os.truncate(self.path, position)
+            if len(offsets) != indexed:
+                self._write_index(offsets)
+        self._offsets = offsets
+        self._size = position
+
+    def _starts_entry(self, offset: int, size: int) -> bool:
+        if not 0 <= offset < size:
+            return False
+        if offset == 0:
+            return True
+        with open(self.path, "rb") as f:
+            f.seek(offset - 1)
+            return f.read(1) == b"\n"
+
+    def __len__(self) -> int:
+        self._load()
+        return len(self._offsets)
+
+    def get(self, index: int) -> str:
+        self._load()
+        with open(self.path, "rb") as f:
+            f.seek(self._offsets[index])
+            return json.loads(f.readline())
+
+    def append(self, text: str):
+        """Añade un prompt (salvo que repita el último), después de los que hayan añadido otras sesiones."""
+        self._load()
+        if not text:
+            return
+        line = (json.dumps(text, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._locked() as fd:
+            size = os.fstat(fd).st_size
+            if size > self._size:
+                self._size = self._scan(self._offsets, self._size)  # Prompts de otras sesiones abiertas
+                if self._size < size:
+                    os.truncate(self.path, self._size)
+            if self._offsets and self.get(len(self._offsets) - 1) == text:
+                return
+            if os.write(fd, line) != len(line):
+                os.truncate(self.path, self._size)
+                raise OSError(f"escritura incompleta en {self.path}")
+            self._offsets.append(self._size)
+            self._size += len(line)
+            try:
+                indexed = os.path.getsize(self.index_path) // self._offsets.itemsize
+            except OSError:
+                indexed = 0
+            if indexed == len(self._offsets) - 1:
+                with open(self.index_path, "ab") as f:
+                    f.write(self._offsets[-1:].tobytes())
+            else:
+                self._write_index(self._offsets)  # A otra sesión le faltó su entrada: se rehace entero
+
+    def search(self, query: str, before: int) -> Optional[int]:
+        """Índice del prompt más reciente anterior a `before` que contiene `query`, o None."""
+        self._load()
+        before = min(before, len(self._offsets))
+        if not query or before <= 0:
+            return None
+        needle = json.dumps(query, ensure_ascii=False)[1:-1].encode("utf-8")  # Tal como está en disco
+        with open(self.path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            end = self._offsets[before] if before < len(self._offsets) else len(data)
+            position = data.rfind(needle, 0, end)
+        return None if position < 0 else bisect.bisect_right(self._offsets, position) - 1
+
+
+class PromptEditor:
+    """
+    Lee los prompts del chat. En una terminal la pone en modo crudo con pegado entre corchetes
+    (bracketed paste): un pegado llega como un único bloque y se inserta entero, con sus saltos de
+    línea, como un solo prompt. Enter envía y Alt+Enter añade una línea; en modo multilínea
+    (/multiline) es al revés, y Ctrl+D también envía. Flechas arriba/abajo y Ctrl+R recorren el
+    PromptHistory. Sin terminal (stdin redirigido) o sin termios (Windows) se usa input().
+    """
+
+    def __init__(self, history: Optional[PromptHistory] = None, theme_manager: Optional[ThemeManager] = None):
+        self.history = history
+        self.theme_manager = theme_manager
+        self.multiline = False
+
+    def __call__(self, prompt: str = "") -> str:
+        if termios is None or not sys.stdin.isatty() or not sys.stdout.isatty():
+            return input(prompt)
+        text = self._read(prompt)
+        if self.history is not None and text.strip():
+            try:
+                self.history.append(text)
+            except OSError:
+                pass  # Sin historial en disco el chat sigue funcionando
+        return text
+
+    def _read(self, prompt: str) -> str:
+        fd = sys.stdin.fileno()
+        saved_attributes = termios.tcgetattr(fd)
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._prompt = prompt
+        self._prompt_width = len(ANSI_ESCAPE_PATTERN.sub("", prompt))
+        self._buffer, self._cursor = "", 0
+        self._history_position = len(self.history) if self.history is not None else 0
+        self._draft = ""
+        self._search = None  # [consulta, índice del prompt encontrado] durante Ctrl+R
+        self._cursor_row = 0
+        self._top = 0
+        sys.stdout.write(BRACKETED_PASTE_ON)
+        try:
+            tty.setraw(fd)
+            self._render()
+            pending = ""
+            while True:
+                data = os.read(fd, 65536)
+                if not data:
+                    raise EOFError
+                pending = self._process(pending + decoder.decode(data))
+                if pending == "\x1b" and not select.select([fd], [], [], ESCAPE_KEY_TIMEOUT_SECONDS)[0]:
+                    pending = self._process(pending, escape_complete=True)
+                if pending is None:
+                    break
+                self._render()
+        finally:
+            termios.tcsetattr(fd, termios.TCSADRAIN, saved_attributes)
+            sys.stdout.write(BRACKETED_PASTE_OFF)
+            sys.stdout.flush()
+        return self._buffer
+
+    def _process(self, text: str, escape_complete: bool = False) -> Optional[str]:
+        """Aplica las teclas de `text`. Devuelve lo que queda por completar, o None al enviar."""
+        i = 0
+        while i < len(text):
+            char = text[i]
+            if char == "\x1b":
+                if text.startswith(PASTE_START, i):
+                    end = text.find(PASTE_END, i + len(PASTE_START))
+                    if end < 0:
+                        return text[i:]  # El resto del pegado llega en las próximas lecturas
+                    self._accept_search()
+                    pasted = text[i + len(PASTE_START):end]
+                    self._insert(pasted.replace("\r\n", "\n").replace("\r", "\n"))
+                    i = end + len(PASTE_END)
+                    continue
+                match = ESCAPE_SEQUENCE_PATTERN.match(text, i)
+                if match is None:
+                    if not escape_complete and PARTIAL_ESCAPE_PATTERN.fullmatch(text, i):
+                        return text[i:]  # Secuencia cortada entre dos lecturas
+                    key, i = "escape", i + 1
+                else:
+                    key, i = ESCAPE_KEYS.get(match.group(1), ""), match.end()
+                if key and self._key(key):
+                    return None
+                continue
+            if char in "\r\n":
+                if char == "\r" and text.startswith("\n", i + 1):
+                    i += 1
+                i += 1
+                # Más texto detrás en la misma lectura: es un pegado sin corchetes, no un Enter
+                if self._search is None and i < len(text):
+                    self._insert("\n")
+                elif self._key("enter"):
+                    return None
+                continue
+            if char in CONTROL_KEYS:
+                i += 1
+                if self._key(CONTROL_KEYS[char]):
+                    return None
+                continue
+            run = PRINTABLE_RUN_PATTERN.match(text, i)
+            if run is None:
+                i += 1  # Otros caracteres de control: se ignoran
+                continue
+            if self._search is not None:
+                self._search[0] += run.group()
+                self._search[1] = self.history.search(self._search[0], self._search_from(inclusive=True))
+            else:
+                self._insert(run.group())
+            i = run.end()
+        return ""
+
+    def _key(self, key: str) -> bool:
+        """Aplica una tecla especial. Devuelve True si el prompt queda enviado."""
+        if self._search is not None:
+            query, found = self._search
+            if key == "search":
+                self._search[1] = self.history.search(query, self._search_from(inclusive=False))
+                return False
+            if key == "backspace":
+                self._search[0] = query[:-1]
+                self._search[1] = self.history.search(self._search[0], len(self.history))
+                return False
+            if key in ("escape", "cancel", "interrupt"):
+                self._search = None
+                return False
+            self._accept_search()
+            if key == "enter":
+                return self._submit()
+        if key in ("enter", "alt_enter"):
+            # Enter envía y Alt+Enter añade una línea; en modo multilínea, al revés
+            if (key == "enter") != self.multiline:
+                return self._submit()
+            self._insert("\n")
+        if key == "interrupt":
+            if not self._buffer:
+                self._render(final=True)
+                raise KeyboardInterrupt
+            self._buffer, self._cursor = "", 0  # Ctrl+C con texto: vacía la línea, como una shell
+        elif key == "eof":
+            if not self._buffer:
+                self._render(final=True)
+                raise EOFError
+            if self.multiline:
+                return self._submit()
+            self._buffer = self._buffer[:self._cursor] + self._buffer[self._cursor + 1:]
+        elif key == "search":
+            if self.history is not None:
+                self._search = ["", None]
+        elif key == "backspace" and self._cursor:
+            self._buffer = self._buffer[:self._cursor - 1] + self._buffer[self._cursor:]
+            self._cursor -= 1
+        elif key == "delete":
+            self._buffer = self._buffer[:self._cursor] + self._buffer[self._cursor + 1:]
+        elif key == "left":
+            self._cursor = max(0, self._cursor - 1)
+        elif key == "right":
+            self._cursor = min(len(self._buffer), self._cursor + 1)
+        elif key == "word_left":
+            match = WORD_BEFORE_PATTERN.search(self._buffer, 0, self._cursor)
+            self._cursor = match.start() if match else 0
+        elif key == "word_right":
+            match = WORD_AFTER_PATTERN.match(self._buffer, self._cursor)
+            self._cursor = match.end() if match else len(self._buffer)
+        elif key == "home":
+            self._cursor = self._buffer.rfind("\n", 0, self._cursor) + 1
+        elif key == "end":
+            end = self._buffer.find("\n", self._cursor)
+            self._cursor = len(self._buffer) if end < 0 else end
+        elif key == "kill_start":
+            start = self._buffer.rfind("\n", 0, self._cursor) + 1
+            self._buffer, self._cursor = self._buffer[:start] + self._buffer[self._cursor:], start
+        elif key == "kill_end":
+            end = self._buffer.find("\n", self._cursor)
+            self._buffer = self._buffer[:self._cursor] + ("" if end < 0 else self._buffer[end:])
+        elif key == "kill_word":
+            start = len(self._buffer[:self._cursor].rstrip())
+            start = max(self._buffer.rfind(" ", 0, start), self._buffer.rfind("\n", 0, start)) + 1
+            self._buffer, self._cursor = self._buffer[:start] + self._buffer[self._cursor:], start
+        elif key in ("up", "down"):
+            if not self._move_line(-1 if key == "up" else 1):
+                self._recall(-1 if key == "up" else 1)
+        return False
+
+    def _insert(self, text: str) -> bool:
+        self._buffer = self._buffer[:self._cursor] + text + self._buffer[self._cursor:]
+        self._cursor += len(text)
+        return False
+
+    def _submit(self) -> bool:
+        self._render(final=True)
+        sys.stdout.write("\r\n")
+        return True
+
+    def _move_line(self, delta: int) -> bool:
+        """Sube o baja una línea dentro de un prompt multilínea; False si ya está en el borde."""
+        line_start = self._buffer.rfind("\n", 0, self._cursor) + 1
+        column = self._cursor - line_start
+        if delta < 0:
+            if line_start == 0:
+                return False
+            previous_start = self._buffer.rfind("\n", 0, line_start - 1) + 1
+            self._cursor = min(previous_start + column, line_start - 1)
+            return True
+        line_end = self._buffer.find("\n", self._cursor)
+        if line_end < 0:
+            return False
+        next_end = self._buffer.find("\n", line_end + 1)
+        self._cursor = min(line_end + 1 + column, len(self._buffer) if next_end < 0 else next_end)
+        return True
+
+    def _recall(self, delta: int):
+        if self.history is None:
+            return
+        position = self._history_position + delta
+        if not 0 <= position <= len(self.history):
+            return
+        if self._history_position == len(self.history):
+            self._draft = self._buffer  # Lo que se estaba escribiendo vuelve al bajar del todo
+        self._history_position = position
+        self._buffer = self._draft if position == len(self.history) else self.history.get(position)
+        self._cursor = len(self._buffer)
+
+    def _search_from(self, inclusive: bool) -> int:
+        found = self._search[1]
+        if found is None:
+            return len(self.history)
+        return found + 1 if inclusive else found
+
+    def _accept_search(self):
+        if self._search is not None:
+            if self._search[1] is not None:
+                self._history_position = self._search[1]
+                self._buffer = self.history.get(self._search[1])
+                self._cursor = len(self._buffer)
+            self._search = None
+
+    def _render(self, final: bool = False):
+        """Redibuja el prompt. Un texto más alto que la terminal se muestra por la ventana del cursor."""
+        columns, rows = shutil.get_terminal_size((80, 24))
+        if self._search is not None:
+            query, found = self._search
+            prompt = f"(búsqueda inversa{'' if found is not None or not query else ' sin resultados'}) '{query}': "
+            prompt_width = len(prompt)
+            text = self.history.get(found) if found is not None else ""
+            cursor = len(text)
+        else:
+            prompt, prompt_width, text = self._prompt, self._prompt_width, self._buffer
+            cursor = len(text) if final else self._cursor
+        lines = text.split("\n")
+        cursor_line = text.count("\n", 0, cursor)
+        cursor_column = len(text[text.rfind("\n", 0, cursor) + 1:cursor].expandtabs(4))
+        visible = max(1, rows - 3)
+        if cursor_line < self._top:
+            self._top = cursor_line
+        elif cursor_line >= self._top + visible:
+            self._top = cursor_line - visible + 1
+        top = self._top = min(self._top, max(0, len(lines) - visible))
+        bottom = min(len(lines), top + visible)
+        margin = " " * prompt_width
+        shown = [(prompt, prompt_width, self._note(f"[… {top} líneas más arriba]"))] if top else []
+        shown += [(margin if shown else prompt, prompt_width,
+                   CONTROL_CHARS_PATTERN.sub("?", line.expandtabs(4))) for line in lines[top:bottom]]
+        if bottom < len(lines):
+            shown.append((margin, prompt_width, self._note(f"[… {len(lines) - bottom} líneas más abajo]")))
+        heights = [max(1, -(-(width + len(ANSI_ESCAPE_PATTERN.sub("", body))) // columns))
+                   for _, width, body in shown]
+        cursor_index = cursor_line - top + (1 if top else 0)
+        offset = prompt_width + cursor_column
+        target_row = sum(heights[:cursor_index]) + offset // columns
+        output = ["\r", f"\x1b[{self._cursor_row}A" if self._cursor_row else "", "\x1b[J",
+                  "\r\n".join(lead + body for lead, _, body in shown)]
+        total_rows = sum(heights)
+        if target_row >= total_rows:  # Cursor justo tras una fila completa: hace falta una fila más
+            output.append("\r\n")
+            total_rows += 1
+        output.append("\r")
+        if total_rows - 1 - target_row:
+            output.append(f"\x1b[{total_rows - 1 - target_row}A")
+        if offset % columns:
+            output.append(f"\x1b[{offset % columns}C")
+        self._cursor_row = target_row
+        sys.stdout.write("".join(output))
+        sys.stdout.flush()
+
+    def _note(self, text: str) -> str:
+        return self.theme_manager.style("info_message", text) if self.theme_manager else text
+
+
 # --- Animación de "Pensando" ---
 THINKING_MESSAGES = [
     "Pensando...", "Thinking...", "Réflexion...", "Nachdenken...", "Meditando...",
     "Elaborando...", "考え中...", "思考中...", "Processando...", "Un momento...",
 ]
 SPINNER_CHARS = itertools.cycle(['-', '\\', '|', '/'])
-stop_animation_event = threading.Event()
 
 
-def animate_thinking(theme_manager: ThemeManager, model_prompt_text: str):
+class ThinkingIndicator:
     """
-    Muestra una animación de 'pensando' en la consola.
-    `model_prompt_text` debe ser el texto del prompt del modelo ya estilizado y SIN Colors.RESET al final.
+    Animación de 'pensando' con un único hilo de dibujo para toda la sesión. Dibujar y detener
+    comparten un candado, así que `stop()` no espera a ningún hilo y, al volver, la línea ya es
+    del consumidor del stream: no puede colarse ningún fotograma más.
     """
-    message_cycler = itertools.cycle(THINKING_MESSAGES)
-    current_message = next(message_cycler)
-    message_display_counter = 0
-    # Cambiar mensaje cada ~2 segundos (20 * 0.1s)
-    MESSAGE_CHANGE_INTERVAL_TICKS = 20
 
-    thinking_style_key = "thinking_message"
-    if thinking_style_key not in theme_manager.active_theme_colors:
-        thinking_style_key = "info_message" # Fallback
+    FRAME_SECONDS = 0.1
+    MESSAGE_CHANGE_FRAMES = 20  # Cambiar mensaje cada ~2 segundos
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._active = False
+        self._thread = None
+        self._theme_manager = None
+        self._model_prompt_text = ""
+        self._width = 80
+
+    def start(self, theme_manager: ThemeManager, model_prompt_text: str):
+        """`model_prompt_text` debe ser el prompt del modelo ya estilizado y SIN Colors.RESET al final."""
+        with self._cond:
+            self._theme_manager = theme_manager
+            self._model_prompt_text = model_prompt_text
+            self._width = shutil.get_terminal_size((80, 24)).columns
+            self._messages = itertools.cycle(THINKING_MESSAGES)
+            self._message = next(self._messages)
+            self._frame = 0
+            self._active = True
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._render_loop, daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def stop(self, takeover_text: Optional[str] = None):
+        """Borra la animación y, en la misma operación, escribe `takeover_text` al inicio de la línea."""
+        with self._cond:
+            if self._active:
+                self._active = False
+                sys.stdout.write("\r" + " " * self._width + "\r")  # Limpiar la línea completa
+            if takeover_text is not None:
+                sys.stdout.write("\r" + takeover_text)
+            sys.stdout.flush()
+
+    def _render_loop(self):
+        with self._cond:
+            while True:
+                while not self._active:
+                    self._cond.wait()
+                self._draw_frame()
+                self._cond.wait(timeout=self.FRAME_SECONDS)  # stop()/start() no esperan a este plazo
+
+    def _draw_frame(self):
+        if self._frame and self._frame % self.MESSAGE_CHANGE_FRAMES == 0:
+            self._message = next(self._messages)
+        self._frame += 1
+        thinking_style_key = "thinking_message"
+        if thinking_style_key not in self._theme_manager.active_theme_colors:
+            thinking_style_key = "info_message" # Fallback
+        thinking_msg_styled = self._theme_manager.style(
+            thinking_style_key, f" {self._message} {next(SPINNER_CHARS)}", apply_reset=False)
+        full_line = f"\r{self._model_prompt_text}{thinking_msg_styled}{Colors.RESET} "
+        sys.stdout.write(full_line.ljust(self._width)[:self._width] + '\r') # Escribir y limpiar el resto de la línea
+        sys.stdout.flush()
 
-    terminal_width = shutil.get_terminal_size((80, 24)).columns
 
-    while not stop_animation_event.is_set():
-        if message_display_counter >= MESSAGE_CHANGE_INTERVAL_TICKS:
-            current_message = next(message_cycler)
-            message_display_counter = 0
+thinking_indicator = ThinkingIndicator()
+
+# --- Perfilado de sesión (--profile-cpu, --trace-malloc, /profile) ---
+
+
+class SessionProfiler:
+    """
+    Perfilado opcional de una sesión completa. Los informes van a stderr para no
+    mezclarse con la salida del modelo en el modo -p.
+    """
+
+    def __init__(self, cpu_profile_file: Optional[str] = None, top_n: int = DEFAULT_PROFILE_TOP_N,
+                 trace_malloc: bool = False, trace_malloc_every: int = DEFAULT_TRACE_MALLOC_EVERY_TURNS):
+        self.cpu_profile_file = cpu_profile_file
+        self.top_n = top_n
+        self.trace_malloc = trace_malloc
+        self.trace_malloc_every = max(1, trace_malloc_every)
+        self.profiler = None
+        self.sampling = False
+        self.turns = 0
+        self._baseline_snapshot = None
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> "SessionProfiler":
+        return cls(args.profile_cpu, args.profile_top, args.trace_malloc, args.trace_malloc_every)
+
+    @property
+    def active(self) -> bool:
+        return bool(self.cpu_profile_file or self.trace_malloc or self.profiler)
+
+    @contextlib.contextmanager
+    def session(self):
+        if self.trace_malloc:
+            tracemalloc.start(25)
+            self._baseline_snapshot = tracemalloc.take_snapshot()
+        if self.cpu_profile_file:
+            self.profiler = cProfile.Profile()
+            self._set_sampling(True)
+        hot_path_timer.enabled = self.active
+        try:
+            yield self
+        finally:
+            self.finish()
+
+    def _set_sampling(self, enabled: bool):
+        if enabled and not self.sampling:
+            self.profiler.enable()
+        elif not enabled and self.sampling:
+            self.profiler.disable()
+        self.sampling = enabled
+
+    def toggle_sampling(self, theme_manager: ThemeManager):
+        """Comando /profile: activa o pausa el muestreo de CPU a mitad de sesión."""
+        if self.profiler is None:
+            self.profiler = cProfile.Profile()
+        self._set_sampling(not self.sampling)
+        hot_path_timer.enabled = True
+        if self.sampling:
+            print(theme_manager.style("info_message", "Perfilado de CPU activado. Usa /profile para pausarlo."))
+        else:
+            print(theme_manager.style("info_message", "Perfilado de CPU pausado. Resumen del intervalo:"))
+            self._print_cpu_summary()
+
+    def checkpoint(self, label: str):
+        """Toma una instantánea de tracemalloc e informa los principales sitios de asignación."""
+        if not self.trace_malloc or not tracemalloc.is_tracing():
+            return
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+        sys.stderr.write(f"\n--- tracemalloc: {label} (actual {current / 1024:.1f} KiB, "
+                         f"pico {peak / 1024:.1f} KiB) ---\n")
+        if self._baseline_snapshot is not None:
+            top_stats = snapshot.compare_to(self._baseline_snapshot, "lineno")
+        else:
+            top_stats = snapshot.statistics("lineno")
+        for stat in top_stats[:TRACE_MALLOC_TOP_N]:
+            sys.stderr.write(f"  {stat}\n")
+
+    def on_turn_end(self):
+        self.turns += 1
+        if self.trace_malloc and self.turns % self.trace_malloc_every == 0:
+            self.checkpoint(f"turno {self.turns}")
+
+    def _print_cpu_summary(self):
+        if self.profiler is None:
+            return
+        try:
+            stats = pstats.Stats(self.profiler, stream=sys.stderr)
+        except TypeError:
+            return  # Nunca se activó: no hay datos
+        sys.stderr.write(f"\n--- Perfil de CPU (top {self.top_n} por tiempo acumulado) ---\n")
+        stats.sort_stats("cumulative").print_stats(self.top_n)
+
+    def finish(self):
+        if self.trace_malloc:
+            # Antes del volcado de pstats, para no contar sus propias asignaciones
+            self.checkpoint("fin de sesión")
+            tracemalloc.stop()
+        if self.profiler is not None:
+            self._set_sampling(False)
+            if self.cpu_profile_file:
+                try:
+                    self.profiler.dump_stats(self.cpu_profile_file)
+                    sys.stderr.write(f"\nPerfil de CPU guardado en {self.cpu_profile_file} "
+                                     f"(ábrelo con `python -m pstats {self.cpu_profile_file}`).\n")
+                except Exception as e:
+                    sys.stderr.write(f"\nError al guardar el perfil de CPU: {e}\n")
+            self._print_cpu_summary()
+        if hot_path_timer.enabled:
+            hot_path_timer.report()
+            hot_path_timer.enabled = False
+
+
+# --- Ramas de conversación (/branch, /checkout, /rewind) ---
+
+
+class ConversationTree:
+    """
+    Árbol de turnos de la conversación. Las ramas comparten su prefijo común: cada nodo
+    guarda un único `Content` y un puntero a su padre, así que crear una rama no copia nada
+    y cambiar de rama solo toca los mensajes que difieren (O(delta), no O(historial)).
+    """
+
+    ROOT = -1
+
+    def __init__(self, history: list, branch_name: str = "main"):
+        self._parents: List[int] = []
+        self._depths: List[int] = []
+        self._contents: list = []
+        tip = self.ROOT
+        for content in history:
+            tip = self._add_node(content, tip)
+        self.branches: Dict[str, int] = {branch_name: tip}
+        self.current = branch_name
+
+    def _add_node(self, content, parent: int) -> int:
+        self._parents.append(parent)
+        self._depths.append(self.depth(parent) + 1)
+        self._contents.append(content)
+        return len(self._contents) - 1
+
+    def depth(self, node: int) -> int:
+        return 0 if node == self.ROOT else self._depths[node]
+
+    def _ancestor(self, node: int, depth: int) -> int:
+        while self.depth(node) > depth:
+            node = self._parents[node]
+        return node
+
+    def sync(self, history: list):
+        """Incorpora a la rama actual los mensajes que la sesión añadió (o quitó) desde la última vez."""
+        tip = self.branches[self.current]
+        if self.depth(tip) > len(history):
+            tip = self._ancestor(tip, len(history))
+        for content in history[self.depth(tip):]:
+            tip = self._add_node(content, tip)
+        self.branches[self.current] = tip
+
+    def create_branch(self, name: str):
+        self.branches[name] = self.branches[self.current]
+        self.current = name
+
+    def checkout(self, name: str, history: list):
+        """Cambia a la rama `name` editando `history` en su sitio (debe reflejar la rama actual)."""
+        source, target = self.branches[self.current], self.branches[name]
+        a = self._ancestor(source, self.depth(target))
+        b = self._ancestor(target, self.depth(source))
+        while a != b:
+            a, b = self._parents[a], self._parents[b]
+        del history[self.depth(a):]
+        suffix = []
+        node = target
+        while node != a:
+            suffix.append(self._contents[node])
+            node = self._parents[node]
+        history.extend(reversed(suffix))
+        self.current = name
+
+    def rewind(self, n_messages: int, history: list) -> Optional[str]:
+        """
+        Retrocede la rama actual `n_messages` mensajes. Si la punta descartada no queda
+        en ninguna otra rama, se conserva como rama nueva y se devuelve su nombre.
+        """
+        tip = self.branches[self.current]
+        new_depth = max(0, self.depth(tip) - n_messages)
+        saved_as = None
+        if tip not in [node for name, node in self.branches.items() if name != self.current]:
+            suffix = 1
+            while f"{self.current}~{suffix}" in self.branches:
+                suffix += 1
+            saved_as = f"{self.current}~{suffix}"
+            self.branches[saved_as] = tip
+        self.branches[self.current] = self._ancestor(tip, new_depth)
+        del history[new_depth:]
+        return saved_as
+
+
+class ChatSessionState:
+    """Estado de la sesión interactiva que comparten el bucle de chat y los comandos '/'."""
+
+    def __init__(self, theme_manager: ThemeManager, profiler: SessionProfiler, model_name: str,
+                 model, chat, history_filename: str, safety_settings: Optional[dict] = None,
+                 turn_policy: Optional[dict] = None):
+        self.theme_manager = theme_manager
+        self.profiler = profiler
+        self.model_name = model_name
+        self.model = model
+        self.chat = chat
+        self.history_filename = history_filename
+        self.safety_settings = safety_settings
+        self.turn_policy = dict(DEFAULT_TURN_POLICY, **(turn_policy or {}))
+        self.tools = None
+        self.tool_settings = dict(DEFAULT_TOOL_SETTINGS)
+        self.attachment_settings = dict(DEFAULT_ATTACHMENT_SETTINGS)
+        self.pending_attachments: List = []  # Partes preparadas con /attach para el próximo mensaje
+        self.prompt_queue: Optional[PromptQueue] = None  # Cola sin conexión (None al reproducir un cassette)
+        self.queued_answers = queue.Queue()  # Respuestas de la cola para esta conversación, aún sin mostrar
+        self.queue_drainer: Optional[QueueDrainer] = None
+        self.retrieval_index: Optional[RetrievalIndex] = None
+        self.retrieval_settings: dict = {}
+        self.semantic_cache: Optional[SemanticCache] = None
+        self.profile_name = "Default"
+        self.token_budget: dict = {}
+        self.record_usage = True
+        self.generation_config: Optional[dict] = None
+        self.context_instruction: Optional[str] = None  # Contenido del caché de contexto, para los demás modelos
+        self.router: Optional[ModelRouter] = None
+        self.cassette = None  # CassetteRecorder (--record) o CassettePlayer (--replay)
+        self.key_pool: Optional[KeyPool] = None  # Claves guardadas (para hedge_key)
+        self.key_name: Optional[str] = None      # Clave fija de esta sesión
+        self.prompt_editor: Optional[PromptEditor] = None  # Lector de la terminal (/multiline)
+        self.tree = ConversationTree(chat.history)
+        self._models = {model_name: model}
+
+    def get_model(self, model_name: str):
+        """Modelo por nombre (p. ej. el de respaldo), creado una sola vez por sesión."""
+        if model_name not in self._models:
+            if isinstance(self.cassette, CassettePlayer):
+                model = ReplayModel(self.cassette, model_name)
+            else:
+                model = self.build_model(model_name)
+                if isinstance(self.cassette, CassetteRecorder):
+                    model = self.cassette.wrap(model)
+            self._models[model_name] = model
+        return self._models[model_name]
+
+    def build_model(self, model_name: str):
+        """
+        GenerativeModel nuevo con los ajustes del perfil. Si el modelo principal usa el caché de
+        contexto, el historial no incluye el system prompt ni los documentos fijados, así que este
+        modelo los recibe como system_instruction.
+        """
+        return genai.GenerativeModel(model_name, safety_settings=self.safety_settings, tools=self.tools,
+                                     generation_config=self.generation_config,
+                                     system_instruction=self.context_instruction)
+
+    def queued_model_settings(self) -> dict:
+        """Los ajustes de build_model en JSON, para que la cola reconstruya el modelo al enviar."""
+        return {"safety_settings": {HarmCategory(category).name: HarmBlockThreshold(threshold).name
+                                    for category, threshold in (self.safety_settings or {}).items()},
+                "generation_config": self.generation_config, "tools": self.tools,
+                "system_instruction": self.context_instruction}
+
+
+def _messages_in_last_turns(history: list, n_turns: int) -> int:
+    """Mensajes que ocupan los últimos `n_turns` turnos (un turno empieza con un texto del usuario)."""
+    count = seen = 0
+    for content in reversed(history):
+        count += 1
+        if content.role == "user" and any("text" in part for part in content.parts):
+            seen += 1
+            if seen == n_turns:
+                break
+    return count
+
+
+def _handle_branch_command(command: str, arguments: List[str], session: ChatSessionState):
+    theme_manager = session.theme_manager
+    tree = session.tree
+    try:
+        history = session.chat.history
+    except Exception as e:
+        print(theme_manager.style("error_message", f"El último turno está incompleto ({e}). Usa /rewind 1."))
+        return
+    tree.sync(history)
+
+    if command == "/branch":
+        if not arguments:
+            for name in sorted(tree.branches):
+                marker = "*" if name == tree.current else " "
+                turns = tree.depth(tree.branches[name]) // 2
+                print(theme_manager.style("list_item_bullet", f"{marker} ") +
+                      theme_manager.style("list_item_text", f"{name} ({turns} turno(s))"))
+            return
+        name = arguments[0]
+        if name in tree.branches:
+            print(theme_manager.style("error_message", f"La rama '{name}' ya existe."))
+            return
+        tree.create_branch(name)
+        print(theme_manager.style("info_message", f"Nueva rama '{name}' creada desde el turno actual."))
+    elif command == "/checkout":
+        if not arguments or arguments[0] not in tree.branches:
+            print(theme_manager.style("error_message",
+                  f"Rama desconocida. Ramas: {', '.join(sorted(tree.branches))}"))
+            return
+        tree.checkout(arguments[0], history)
+        print(theme_manager.style("info_message",
+              f"En la rama '{tree.current}' ({len(history) // 2} turno(s))."))
+    elif command == "/rewind":
+        try:
+            n_turns = int(arguments[0]) if arguments else 1
+        except ValueError:
+            print(theme_manager.style("error_message", "Uso: /rewind N (número de turnos)."))
+            return
+        if n_turns < 1:
+            print(theme_manager.style("error_message", "N debe ser al menos 1."))
+            return
+        saved_as = tree.rewind(_messages_in_last_turns(history, n_turns), history)
+        print(theme_manager.style("info_message", f"Retrocedidos {n_turns} turno(s) en '{tree.current}'."))
+        if saved_as:
+            print(theme_manager.style("info_message",
+                  f"Los turnos descartados siguen disponibles en la rama '{saved_as}'."))
+
+
+# --- Herramientas locales para el modelo (function calling) ---
+
+
+def _tool_path(path: str, settings: dict) -> str:
+    """Resuelve `path` dentro de la raíz configurada; rechaza escapes con '..' o enlaces."""
+    root = os.path.realpath(settings["root"])
+    resolved = os.path.realpath(os.path.join(root, path))
+    if resolved != root and not resolved.startswith(root + os.sep):
+        raise PermissionError(f"'{path}' está fuera del directorio permitido")
+    return resolved
+
+
+def _tool_time_left(settings: dict) -> float:
+    """Segundos que le quedan a la llamada en curso (run_tool_calls fija su 'deadline' al empezar)."""
+    deadline = settings.get("deadline")
+    if deadline is None:
+        return settings["timeout_seconds"]
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError(f"tiempo agotado ({settings['timeout_seconds']}s)")
+    return remaining
+
+
+def _truncate_tool_output(text: str, settings: dict) -> str:
+    limit = settings["max_output_chars"]
+    return text if len(text) <= limit else text[:limit] + f"\n[... truncado a {limit} caracteres]"
+
+
+def _tool_read_file(args: dict, settings: dict) -> dict:
+    path = _tool_path(args["path"], settings)
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        content = f.read(settings["max_output_chars"] + 1)
+    return {"path": args["path"], "content": _truncate_tool_output(content, settings)}
+
+
+def _tool_grep(args: dict, settings: dict) -> dict:
+    pattern = re.compile(args["pattern"])
+    base = _tool_path(args.get("path") or ".", settings)
+    glob = args.get("glob") or "*"
+    max_matches = int(args.get("max_matches") or 100)
+    root = os.path.realpath(settings["root"])
+    matches = []
+    files = [base] if os.path.isfile(base) else (
+        os.path.join(d, name) for d, dirs, names in os.walk(base)
+        if not any(part.startswith(".") for part in os.path.relpath(d, base).split(os.sep) if part != ".")
+        for name in names)
+    for file_path in files:
+        _tool_time_left(settings)  # Parar al agotar el plazo en vez de seguir recorriendo en segundo plano
+        if not fnmatch.fnmatch(os.path.basename(file_path), glob):
+            continue
+        real_path = os.path.realpath(file_path)
+        if not real_path.startswith(os.path.join(root, "")):
+            continue  # Enlace a un archivo fuera del directorio permitido
+        try:
+            with open(real_path, "r", encoding="utf-8") as f:
+                for line_number, line in enumerate(f, 1):
+                    if line_number % 10000 == 0:
+                        _tool_time_left(settings)
+                    if pattern.search(line):
+                        matches.append(f"{os.path.relpath(file_path, root)}:{line_number}: {line.rstrip()[:300]}")
+                        if len(matches) >= max_matches:
+                            return {"matches": matches, "truncated": True}
+        except (UnicodeDecodeError, OSError):
+            continue  # Binario o ilegible
+    return {"matches": matches, "truncated": False}
+
+
+def _check_tool_url(url: str, settings: dict):
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme not in ("http", "https"):
+        raise PermissionError(f"esquema '{parsed.scheme}' no permitido; solo http y https")
+    if parsed.hostname not in settings["http_allowed_hosts"]:
+        raise PermissionError(f"host '{parsed.hostname}' no permitido (http_allowed_hosts)")
+
+
+class _AllowedHostRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """Sigue una redirección solo si el destino también está en http_allowed_hosts."""
+
+    def __init__(self, settings: dict):
+        self.settings = settings
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        _check_tool_url(newurl, self.settings)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+def _tool_http_request(args: dict, settings: dict) -> dict:
+    url = args["url"]
+    _check_tool_url(url, settings)
+    method = (args.get("method") or "GET").upper()
+    body = args.get("body")
+    request = urllib.request.Request(url, method=method, data=body.encode("utf-8") if body else None)
+    if body:
+        request.add_header("Content-Type", args.get("content_type") or "application/json")
+    opener = urllib.request.build_opener(_AllowedHostRedirectHandler(settings))
+    try:
+        with opener.open(request, timeout=_tool_time_left(settings)) as response:
+            return {"status": response.status,
+                    "body": _truncate_tool_output(response.read().decode("utf-8", "replace"), settings)}
+    except urllib.error.HTTPError as e:
+        return {"status": e.code, "body": _truncate_tool_output(e.read().decode("utf-8", "replace"), settings)}
+
+
+def _tool_shell(args: dict, settings: dict) -> dict:
+    argv = shlex.split(args["command"])
+    allowed = [name for name in settings["shell_allowlist"] if "/" not in name and os.sep not in name]
+    # Solo el nombre exacto: './git' o '/tmp/x/git' no cuentan como 'git'
+    if not argv or argv[0] not in allowed:
+        raise PermissionError(f"comando no permitido; permitidos: {', '.join(allowed) or 'ninguno'}")
+    executable = shutil.which(argv[0])
+    if executable is None:
+        raise FileNotFoundError(f"'{argv[0]}' no está en el PATH")
+    # Sin shell=True: ni tuberías ni sustituciones, solo el ejecutable permitido y sus argumentos
+    result = subprocess.run([os.path.abspath(executable)] + argv[1:], capture_output=True, text=True,
+                            timeout=_tool_time_left(settings), cwd=os.path.realpath(settings["root"]))
+    return {"exit_code": result.returncode,
+            "stdout": _truncate_tool_output(result.stdout, settings),
+            "stderr": _truncate_tool_output(result.stderr, settings)}
+
+
+TOOL_REGISTRY = {
+    "read_file": {
+        "handler": _tool_read_file,
+        "declaration": {
+            "name": "read_file",
+            "description": "Lee un archivo de texto local (ruta relativa al directorio del proyecto).",
+            "parameters": {"type": "object", "properties": {
+                "path": {"type": "string", "description": "Ruta relativa del archivo."}},
+                "required": ["path"]},
+        },
+    },
+    "grep": {
+        "handler": _tool_grep,
+        "declaration": {
+            "name": "grep",
+            "description": "Busca una expresión regular en los archivos locales y devuelve 'archivo:línea: texto'.",
+            "parameters": {"type": "object", "properties": {
+                "pattern": {"type": "string", "description": "Expresión regular (sintaxis de Python)."},
+                "path": {"type": "string", "description": "Archivo o directorio relativo donde buscar."},
+                "glob": {"type": "string", "description": "Filtro de nombre de archivo, p. ej. '*.py'."},
+                "max_matches": {"type": "integer", "description": "Máximo de coincidencias (100)."}},
+                "required": ["pattern"]},
+        },
+    },
+    "http_request": {
+        "handler": _tool_http_request,
+        "declaration": {
+            "name": "http_request",
+            "description": "Hace una petición HTTP a un servicio local permitido y devuelve estado y cuerpo.",
+            "parameters": {"type": "object", "properties": {
+                "url": {"type": "string", "description": "URL completa, p. ej. http://localhost:8080/health."},
+                "method": {"type": "string", "description": "GET (por defecto), POST, PUT o DELETE."},
+                "body": {"type": "string", "description": "Cuerpo de la petición (opcional)."},
+                "content_type": {"type": "string", "description": "Content-Type del cuerpo (application/json)."}},
+                "required": ["url"]},
+        },
+    },
+    "shell": {
+        "handler": _tool_shell,
+        "declaration": {
+            "name": "shell",
+            "description": "Ejecuta un comando permitido (sin tuberías ni redirecciones) y devuelve su salida.",
+            "parameters": {"type": "object", "properties": {
+                "command": {"type": "string", "description": "Comando y argumentos, p. ej. 'git status'."}},
+                "required": ["command"]},
+        },
+    },
+}
+
+
+def build_tool_declarations(tool_names: list, theme_manager: ThemeManager) -> Optional[list]:
+    """Declaraciones para `GenerativeModel(tools=...)` a partir de los nombres del perfil."""
+    declarations = []
+    for name in tool_names or []:
+        if name in TOOL_REGISTRY:
+            declarations.append(TOOL_REGISTRY[name]["declaration"])
+        else:
+            print(theme_manager.style("warning_message",
+                  f"Advertencia: Herramienta desconocida '{name}' en el perfil. Se omitirá."))
+    return [{"function_declarations": declarations}] if declarations else None
+
+
+def _function_calls(content) -> list:
+    if content is None:
+        return []
+    return [part.function_call for part in content.parts if "function_call" in part]
+
+
+def run_tool_calls(function_calls: list, tool_settings: dict, theme_manager: ThemeManager):
+    """
+    Ejecuta en paralelo las llamadas a herramientas de un turno y devuelve el Content con las
+    respuestas en el mismo orden para reenviarlo al modelo. Cada llamada tiene su propio plazo,
+    contado desde que empieza a ejecutarse; los handlers lo reciben como settings["deadline"] y
+    se detienen solos al agotarlo.
+    """
+    timeout = tool_settings["timeout_seconds"]
+
+    def call_tool(function_call, started: dict) -> dict:
+        started["at"] = time.monotonic()
+        tool = TOOL_REGISTRY.get(function_call.name)
+        if tool is None:
+            raise LookupError(f"herramienta desconocida '{function_call.name}'")
+        settings = dict(tool_settings, deadline=started["at"] + timeout)
+        return tool["handler"](dict(type(function_call).to_dict(function_call).get("args") or {}), settings)
+
+    def wait_for(future, started: dict):
+        while True:
+            begun = started.get("at")
+            remaining = timeout if begun is None else begun + timeout - time.monotonic()
+            try:
+                return future.result(timeout=max(0.0, remaining))
+            except concurrent.futures.TimeoutError:
+                if begun is not None:
+                    raise
+                # Seguía en cola tras otras llamadas: su plazo aún no ha empezado a contar
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=tool_settings["max_workers"])
+    try:
+        starts = [{} for _ in function_calls]
+        futures = [executor.submit(call_tool, fc, started) for fc, started in zip(function_calls, starts)]
+        parts = []
+        for function_call, future, started in zip(function_calls, futures, starts):
+            try:
+                result = {"result": wait_for(future, started)}
+                status = "ok"
+            except (concurrent.futures.TimeoutError, TimeoutError):
+                future.cancel()
+                result = {"error": f"tiempo agotado ({timeout}s)"}
+                status = "tiempo agotado"
+            except Exception as e:
+                result = {"error": str(e)}
+                status = f"error: {e}"
+            print(theme_manager.style("info_message", f"[herramienta] {function_call.name} → {status}"))
+            parts.append(genai.protos.Part(function_response=genai.protos.FunctionResponse(
+                name=function_call.name, response=result)))
+    finally:
+        executor.shutdown(wait=False)  # No esperar a herramientas que agotaron su plazo
+    return genai.protos.Content(role="user", parts=parts)
+
+
+# --- Enrutado de modelos por turno (tamaño del prompt, reglas y latencia observada) ---
+
+
+class ModelStats:
+    """
+    Últimas MODEL_STATS_WINDOW peticiones de cada modelo (latencia hasta el primer chunk y si
+    falló), guardadas en MODEL_STATS_FILE. Las usan el enrutado de modelos y los presupuestos de espera.
+    """
+
+    def __init__(self, path: Optional[str] = None, window: int = MODEL_STATS_WINDOW):
+        self._path = path
+        self.window = window
+        self._lock = threading.Lock()
+        self._samples = None  # modelo -> [[first_chunk_ms | None, ok], ...]
+
+    @property
+    def path(self) -> str:
+        return self._path or data_path("metrics", MODEL_STATS_FILE)
+
+    def _load(self):
+        if self._samples is None:
+            self._samples = {}
+            if os.path.exists(self.path):
+                try:
+                    with open(self.path, "r", encoding="utf-8") as f:
+                        self._samples = json.load(f)
+                except (OSError, ValueError):
+                    pass  # Historial ilegible: se empieza de cero
+
+    def record(self, model_name: str, first_chunk_ms: Optional[float], ok: bool):
+        with self._lock:
+            self._load()
+            samples = self._samples.setdefault(model_name, [])
+            samples.append([None if first_chunk_ms is None else round(first_chunk_ms), ok])
+            del samples[:-self.window]
+            try:
+                with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+                    json.dump(self._samples, f)
+                os.replace(self.path + ".tmp", self.path)
+            except OSError:
+                pass  # Estadística informativa: nunca debe romper un turno
+
+    def summary(self, model_name: str) -> dict:
+        """count, error_rate y percentiles p50/p95 de la latencia al primer chunk (ms, None si no hay datos)."""
+        with self._lock:
+            self._load()
+            samples = list(self._samples.get(model_name, []))
+        latencies = sorted(ms for ms, ok in samples if ok and ms is not None)
+
+        def percentile(fraction):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] if latencies else None
+
+        errors = sum(1 for _, ok in samples if not ok)
+        return {"count": len(samples), "error_rate": errors / len(samples) if samples else 0.0,
+                "p50_ms": percentile(0.5), "p95_ms": percentile(0.95)}
+
+
+model_stats = ModelStats()
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+class ModelRouter:
+    """
+    Elige el modelo de cada turno entre los del perfil. Las reglas se evalúan en orden y gana la
+    primera que se cumple; si ninguna, se usa `default` ("fastest" = menor latencia observada).
+    Si el modelo elegido está fallando (tasa de error reciente >= max_error_rate), se cambia por
+    el más sano. No hace llamadas de red: se puede probar con `pygemai route`.
+    """
+
+    def __init__(self, settings: dict, stats: ModelStats):
+        models = settings.get("models") or {}
+        if isinstance(models, list):
+            models = {name.split("/")[-1]: name for name in models}
+        if not models:
+            raise ValueError("El router necesita al menos un modelo en 'models'.")
+        self.models = models
+        self.rules = settings.get("rules") or []
+        for rule in self.rules:
+            if rule.get("when") not in ROUTER_RULE_KINDS or rule.get("use") not in self.models:
+                raise ValueError(f"Regla de router inválida: {rule}")
+        self.default = settings.get("default") or next(iter(models))
+        if self.default != "fastest" and self.default not in self.models:
+            raise ValueError(f"Modelo por defecto del router desconocido: {self.default}")
+        self.max_error_rate = float(settings.get("max_error_rate", DEFAULT_ROUTER_MAX_ERROR_RATE))
+        self.stats = stats
+
+    @classmethod
+    def for_profile(cls, profile: Optional[dict], stats: Optional[ModelStats] = None) -> Optional["ModelRouter"]:
+        settings = (profile or {}).get("router")
+        return cls(settings, stats or model_stats) if settings else None
+
+    def _rule_matches(self, rule: dict, tokens: int, has_code: bool, has_attachments: bool) -> Optional[str]:
+        kind = rule["when"]
+        if kind == "code" and has_code:
+            return "el prompt contiene bloques de código"
+        if kind == "attachment" and has_attachments:
+            return "el prompt lleva adjuntos"
+        if kind == "tokens_over" and tokens > rule.get("value", 0):
+            return f"prompt largo (~{tokens} tokens > {rule['value']})"
+        if kind == "tokens_under" and tokens < rule.get("value", 0):
+            return f"prompt corto (~{tokens} tokens < {rule['value']})"
+        return None
+
+    def _fastest(self, candidates: List[str]) -> str:
+        # Sin datos cuenta como 0 ms: así cada modelo se prueba al menos una vez
+        return min(candidates, key=lambda alias: self.stats.summary(self.models[alias])["p50_ms"] or 0)
+
+    def choose(self, prompt: str, has_attachments: bool = False) -> tuple:
+        """(nombre del modelo, razón legible)."""
+        tokens = estimate_tokens(prompt)
+        has_code = "```" in prompt
+        alias, reason = None, None
+        for rule in self.rules:
+            reason = self._rule_matches(rule, tokens, has_code, has_attachments)
+            if reason:
+                alias = rule["use"]
+                break
+        if alias is None:
+            if self.default == "fastest":
+                alias = self._fastest(list(self.models))
+                reason = "menor latencia observada"
+            else:
+                alias, reason = self.default, "modelo por defecto"
+
+        summary = self.stats.summary(self.models[alias])
+        if summary["count"] >= ROUTER_MIN_SAMPLES and summary["error_rate"] >= self.max_error_rate:
+            healthy = [other for other in self.models if other != alias and
+                       self.stats.summary(self.models[other])["error_rate"] < self.max_error_rate]
+            if healthy:
+                previous, alias = alias, self._fastest(healthy)
+                reason = f"{previous} falla ({summary['error_rate']:.0%} de errores recientes)"
+        return self.models[alias], reason
+
+
+# --- Grabación y reproducción de sesiones (--record / --replay) ---
+
+
+def _proto_to_dict(message) -> dict:
+    return type(message).to_dict(message)
+
+
+class _RecordingIterator:
+    """Envuelve el iterador crudo del SDK y anota cada chunk con el tiempo desde el anterior."""
+
+    def __init__(self, iterator, recorder: "CassetteRecorder", entry: dict, last_at: float):
+        self._iterator = iterator
+        self._recorder = recorder
+        self._entry = entry
+        self._last_at = last_at
+        self._written = False
+        self._write_lock = threading.Lock()
+
+    def __iter__(self):
+        return self
+
+    def _write_entry(self):
+        with self._write_lock:  # Fin, error o cancelación (puede llegar desde otro hilo): solo la primera vez
+            if self._written:
+                return
+            self._written = True
+        self._recorder.write_request(self._entry)
+
+    def __next__(self):
+        try:
+            chunk = next(self._iterator)
+        except StopIteration:
+            self._write_entry()
+            raise
+        except Exception as e:
+            self._entry["error"] = str(e)
+            self._write_entry()
+            raise
+        now = time.monotonic()
+        self._entry["chunks"].append({"delay": now - self._last_at, "chunk": _proto_to_dict(chunk)})
+        self._last_at = now
+        return chunk
+
+    def cancel(self):
+        self._entry["cancelled"] = True
+        self._write_entry()
+        for method_name in ("cancel", "close"):  # Igual que _close_stream, sobre el iterador real
+            method = getattr(self._iterator, method_name, None)
+            if callable(method):
+                method()
+                return
+
+
+class RecordingModel:
+    """Modelo que delega en el real y graba cada petición con sus chunks en el cassette."""
+
+    def __init__(self, model, recorder: "CassetteRecorder"):
+        self._model = model
+        self._recorder = recorder
+        self.model_name = model.model_name
+
+    def generate_content(self, contents, stream: bool = False, **kwargs):
+        started = time.monotonic()
+        response = self._model.generate_content(contents, stream=stream, **kwargs)  # Espera el primer chunk
+        entry = {"type": "request", "model": self.model_name,
+                 "contents": [_proto_to_dict(c) if isinstance(c, genai.protos.Content) else c for c in contents],
+                 "chunks": [{"delay": time.monotonic() - started, "chunk": _proto_to_dict(response._chunks[0])}]}
+        response._iterator = _RecordingIterator(response._iterator, self._recorder, entry, time.monotonic())
+        return response
+
+
+class CassetteRecorder:
+    """Graba entradas del usuario y peticiones (con chunks y tiempos) en un archivo JSONL."""
+
+    def __init__(self, path: str, model_name: str):
+        self._lock = threading.Lock()
+        self._file = open(path, "w", encoding="utf-8")
+        self._write({"type": "header", "format": CASSETTE_FORMAT, "model": model_name,
+                     "created": datetime.datetime.now().isoformat(timespec="seconds")})
+
+    def _write(self, entry: dict):
+        with self._lock:
+            self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self._file.flush()
+
+    def record_input(self, text: str):
+        self._write({"type": "input", "text": text})
+
+    def write_request(self, entry: dict):
+        self._write(entry)
+
+    def wrap(self, model):
+        return RecordingModel(model, self)
+
+    def record_input_reader(self, read_input):
+        def read_and_record(prompt: str = ""):
+            text = read_input(prompt)
+            self.record_input(text)
+            return text
+        return read_and_record
+
+    def close(self):
+        self._file.close()
+
+
+class ReplayModel:
+    """Sustituto del modelo que sirve las respuestas grabadas, con los mismos objetos que el SDK."""
+
+    def __init__(self, player: "CassettePlayer", model_name: str):
+        self._player = player
+        self.model_name = model_name
+
+    def generate_content(self, contents, stream: bool = False, **kwargs):
+        entry = self._player.next_request()
+        speed = self._player.speed
+
+        def chunks():
+            for recorded in entry["chunks"]:
+                if speed > 0:
+                    time.sleep(recorded["delay"] / speed)
+                yield genai.protos.GenerateContentResponse(recorded["chunk"])
+            if entry.get("error"):
+                raise RuntimeError(entry["error"])
+
+        response = genai.types.GenerateContentResponse.from_iterator(chunks())
+        if not stream:
+            response.resolve()
+        return response
+
+
+class CassettePlayer:
+    """Lee un cassette y entrega, en orden, las entradas del usuario y las peticiones grabadas."""
+
+    def __init__(self, path: str, speed: float = 1.0):
+        self.speed = speed
+        self._inputs = []
+        self._requests = []
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry["type"] == "header":
+                    if entry.get("format") != CASSETTE_FORMAT:
+                        raise ValueError(f"Formato de cassette no soportado: {entry.get('format')}")
+                    self.model_name = entry["model"]
+                elif entry["type"] == "input":
+                    self._inputs.append(entry["text"])
+                elif entry["type"] == "request" and entry["chunks"]:
+                    self._requests.append(entry)
+        self._inputs.reverse()
+        self._requests.reverse()
+
+    def read_input(self, prompt: str = "") -> str:
+        if not self._inputs:
+            raise EOFError
+        text = self._inputs.pop()
+        print(prompt + text)  # Eco, para que la transcripción se vea igual que en vivo
+        return text
+
+    def next_request(self) -> dict:
+        if not self._requests:
+            raise RuntimeError("El cassette no tiene más respuestas grabadas.")
+        return self._requests.pop()
+
+
+# --- Turno de chat: streaming cancelable (Ctrl+C) y con plazos ---
+
+
+def _close_stream(response):
+    """Deja de consumir un stream y libera su conexión (gRPC: cancel(); REST: close())."""
+    iterator = getattr(response, "_iterator", None)
+    for method_name in ("cancel", "close"):
+        method = getattr(iterator, method_name, None)
+        if callable(method):
+            try:
+                method()
+            except Exception:
+                pass  # Ya terminado o ejecutándose en otro hilo: el hilo lo descartará
+            return
+
+
+_stream_internals_warned = False
+
+
+def _iter_stream_chunks(response):
+    """
+    Itera un stream entregando cada chunk en cuanto llega. El iterador del SDK retiene cada chunk
+    hasta recibir el siguiente (para saber si era el último), lo que retrasa el primer texto en
+    pantalla todo un intervalo entre chunks. La respuesta agregada (`candidates`) se mantiene igual.
+    """
+    chunks = getattr(response, "_chunks", None)
+    iterator = getattr(response, "_iterator", None)
+    join_chunks = getattr(generation_types, "_join_chunks", None)
+    if getattr(response, "_done", True):
+        yield from response  # Respuesta ya resuelta u objeto desconocido: iteración normal
+        return
+    if iterator is None or join_chunks is None or chunks is None or len(chunks) != 1:
+        # SDK fuera del rango fijado en pyproject.toml: funciona, pero el primer texto llega tarde
+        global _stream_internals_warned
+        if not _stream_internals_warned:
+            _stream_internals_warned = True
+            sys.stderr.write("Aviso: esta versión de google-generativeai no es compatible con la entrega "
+                             "inmediata de fragmentos; el primer texto puede tardar más en aparecer.\n")
+        yield from response
+        return
+    yield generation_types.GenerateContentResponse.from_response(chunks[0])
+    for item in iterator:
+        chunks.append(item)
+        response._result = join_chunks([response._result, item])
+        yield generation_types.GenerateContentResponse.from_response(item)
+    response._done = True
+
+
+class StreamPump:
+    """
+    Consume un stream de respuesta en un hilo propio y entrega los chunks por una cola.
+    El hilo principal puede así esperar con plazo y atender Ctrl+C sin quedar bloqueado
+    dentro de la librería de red. Un stream cancelado se descarta sin tocar la sesión.
+    Varios pumps pueden compartir la cola `events` (peticiones duplicadas): cada evento lleva
+    el pump que lo produjo.
+    """
+
+    def __init__(self, start_stream, events: Optional[queue.Queue] = None):
+        self._start_stream = start_stream
+        self._queue = events if events is not None else queue.Queue()
+        self._lock = threading.Lock()
+        self.cancelled = False
+        self.response = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> "StreamPump":
+        self._thread.start()
+        return self
+
+    def _run(self):
+        try:
+            response = self._start_stream()
+            with self._lock:
+                self.response = response
+                if self.cancelled:
+                    _close_stream(response)
+                    return
+            for chunk in _iter_stream_chunks(response):
+                if self.cancelled:
+                    return
+                self._queue.put((self, "chunk", chunk))
+            self._queue.put((self, "end", None))
+        except Exception as e:
+            if not self.cancelled:
+                self._queue.put((self, "error", e))
+
+    def get(self, timeout: Optional[float]):
+        """Devuelve (pump, "chunk" | "end" | "error", valor). Lanza queue.Empty si vence `timeout`."""
+        return self._queue.get(timeout=timeout)
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            response = self.response
+        if response is not None:
+            _close_stream(response)
+
+
+class TurnOutcome:
+    """
+    Resultado de un intento de turno: status es ok, blocked, cancelled, first_chunk_timeout,
+    turn_timeout o budget_exceeded.
+    """
+
+    def __init__(self, status: str, text: str = "", content=None):
+        self.status = status
+        self.text = text
+        self.content = content  # Content del modelo a registrar en el historial (si aplica)
+        self.usage = None  # Tokens de la petición (ver _usage_counts), si la hubo
+
+
+def _response_content(response):
+    """Content completo del modelo tras consumir el stream, o None si no hubo candidatos."""
+    try:
+        content = response.candidates[0].content
+    except (AttributeError, IndexError):
+        return None
+    if not content.role:
+        content.role = "model"
+    return content
+
+
+def _hedge_delay(policy: dict, model_name: str) -> Optional[float]:
+    """Segundos sin primer chunk tras los que se lanza la petición duplicada (None = sin duplicar)."""
+    after = policy.get("hedge_after_ms")
+    if after == "p95":
+        summary = model_stats.summary(model_name)
+        if summary["count"] < ROUTER_MIN_SAMPLES or summary["p95_ms"] is None:
+            return None  # Sin historial suficiente no se sabe qué es "lento"
+        after = max(summary["p95_ms"], HEDGE_MIN_AFTER_MS)
+    return None if after is None else float(after) / 1000
 
-        spinner_char = next(SPINNER_CHARS)
-        thinking_msg_styled = theme_manager.style(thinking_style_key, f" {current_message} {spinner_char}", apply_reset=False)
-        full_line = f"\r{model_prompt_text}{thinking_msg_styled}{Colors.RESET} "
-        
-        sys.stdout.write(full_line.ljust(terminal_width)[:terminal_width] + '\r') # Escribir y limpiar el resto de la línea
-        sys.stdout.flush()
-        message_display_counter += 1
-        time.sleep(0.1)
 
-    sys.stdout.write('\r' + ' ' * terminal_width + '\r') # Limpiar la línea completa al salir
+def _hedge_request(session: ChatSessionState, model, contents: list) -> tuple:
+    """
+    (modelo, petición) de la duplicada: hedge_model (o el mismo), con otra clave si hedge_key lo
+    pide. Cada clave tiene su propio GenerativeModel, que solo se usa con ella.
+    """
+    policy = session.turn_policy
+    model_name = policy.get("hedge_model") or model.model_name
+    key_name = policy.get("hedge_key")
+    pool = session.key_pool
+    if key_name == "other" and pool is not None:
+        key_name = next((name for name in pool.keys if name != session.key_name), None)
+    # Los archivos subidos a la File API solo los puede leer la clave que los subió
+    uploads = any("file_data" in part for content in contents for part in content.parts)
+    if not key_name or pool is None or key_name not in pool.keys or key_name == session.key_name or uploads:
+        hedge_model = session.get_model(model_name)
+        return hedge_model, lambda: hedge_model.generate_content(contents, stream=True)
+    if (model_name, key_name) not in session._models:
+        session._models[(model_name, key_name)] = session.build_model(model_name)
+    hedge_model = session._models[(model_name, key_name)]
+    return hedge_model, lambda: pool.generate_content(key_name, hedge_model, contents, stream=True)
+
+
+def _stream_turn_attempt(session: ChatSessionState, model, contents: list) -> TurnOutcome:
+    theme_manager = session.theme_manager
+    policy = session.turn_policy
+    styled_model_name_prompt = theme_manager.style(
+        "prompt_model_name", f"{model.model_name.split('/')[-1]}:", apply_reset=False)
+
+    def stop_animation(write_model_prompt: bool = False):
+        # Sin esperas: la animación se borra y el prompt del modelo ocupa la línea en un solo paso.
+        # El nombre es el del modelo que respondió (puede ser el de la petición duplicada)
+        model_prompt = theme_manager.style(
+            "prompt_model_name", f"{model.model_name.split('/')[-1]}:", apply_reset=False) + Colors.RESET + " "
+        thinking_indicator.stop(model_prompt if write_model_prompt else None)
+
+    full_response_text_parts = []
+    fence_tracker = CodeFenceTracker(code_highlighter)  # Resalta cada bloque de código según se cierra
+    first_chunk_received = False
+    first_chunk_at = None
+    usage_metadata = None
+    started = time.monotonic()
+
+    def finish(outcome: TurnOutcome) -> TurnOutcome:
+        outcome.usage = _usage_counts(usage_metadata)
+        if outcome.status != "cancelled":  # Un Ctrl+C no dice nada de la salud del modelo
+            model_stats.record(model.model_name,
+                               None if first_chunk_at is None else (first_chunk_at - pump_started[pump]) * 1000,
+                               outcome.status not in ("first_chunk_timeout", "turn_timeout"))
+        if session.record_usage:
+            usage_ledger.record(session.profile_name, model.model_name, outcome.usage, time.monotonic() - started,
+                                None if first_chunk_at is None else first_chunk_at - started,
+                                outcome.status, "interactive", hedged=hedge_pump is not None,
+                                hedge_won=hedge_pump is not None and pump is hedge_pump)
+        return outcome
+    first_chunk_deadline = (started + policy["first_chunk_timeout_seconds"]
+                            if policy.get("first_chunk_timeout_seconds") else None)
+    turn_deadline = started + policy["turn_timeout_seconds"] if policy.get("turn_timeout_seconds") else None
+    # Petición duplicada si el primer chunk tarda; no con casetes, que graban una sola petición por turno
+    hedge_delay = _hedge_delay(policy, model.model_name) if session.cassette is None else None
+    hedge_deadline = started + hedge_delay if hedge_delay is not None else None
+    hedge_pump = None
+
+    thinking_indicator.start(theme_manager, styled_model_name_prompt)
+    events = queue.Queue()
+    pump = StreamPump(lambda: model.generate_content(contents, stream=True), events).start()
+    pumps = {pump: model}  # Streams vivos; tras el primer chunk solo queda el ganador
+    pump_started = {pump: started}
+
+    def cancel_all():
+        for other in pumps:
+            other.cancel()
+
+    try:
+        while True:
+            pending_hedge = hedge_deadline if hedge_pump is None and not first_chunk_received else None
+            deadlines = [d for d in (turn_deadline, None if first_chunk_received else first_chunk_deadline,
+                                     pending_hedge) if d]
+            deadline = min(deadlines) if deadlines else None
+            wait = STREAM_POLL_SECONDS if deadline is None else min(STREAM_POLL_SECONDS,
+                                                                     max(0.0, deadline - time.monotonic()))
+            try:
+                source, kind, value = events.get(timeout=wait)
+            except queue.Empty:
+                now = time.monotonic()
+                if deadline is None or now < deadline:
+                    continue
+                if pending_hedge is not None and now >= pending_hedge:
+                    hedge_model, hedge_request = _hedge_request(session, model, contents)
+                    hedge_pump = StreamPump(hedge_request, events).start()
+                    pumps[hedge_pump] = hedge_model
+                    pump_started[hedge_pump] = now
+                    continue
+                cancel_all()
+                stop_animation(write_model_prompt=not first_chunk_received)
+                if not first_chunk_received:
+                    sys.stdout.write("\n")
+                    return finish(TurnOutcome("first_chunk_timeout"))
+                print(theme_manager.style("warning_message",
+                      f"\n[Plazo total del turno agotado ({policy['turn_timeout_seconds']}s)]"))
+                return finish(TurnOutcome("turn_timeout", "".join(full_response_text_parts)))
+
+            if source not in pumps:
+                continue  # Evento tardío de un stream ya descartado
+            if kind == "error" and not first_chunk_received and len(pumps) > 1:
+                # Falló una de las dos peticiones duplicadas: se sigue esperando la otra
+                model_stats.record(pumps.pop(source).model_name, None, False)
+                pump = next(iter(pumps))
+                model = pumps[pump]
+                continue
+            if not first_chunk_received and len(pumps) > 1:
+                # Gana el primer stream que entrega algo; el otro se cancela y no llega al historial
+                for other in [p for p in pumps if p is not source]:
+                    other.cancel()
+                    del pumps[other]
+            pump, model = source, pumps[source]
+
+            if kind == "error":
+                raise value
+            if kind == "end":
+                break
+
+            chunk = value
+            if not first_chunk_received:  # Al recibir el primer dato (texto o feedback)
+                stop_animation(write_model_prompt=True)
+                first_chunk_received = True
+                first_chunk_at = time.monotonic()
+            if getattr(chunk, "usage_metadata", None):
+                usage_metadata = chunk.usage_metadata
+
+            text = _chunk_text(chunk)
+            if text:
+                sys.stdout.write(text)  # Salida progresiva del texto
+                sys.stdout.flush()
+                full_response_text_parts.append(text)
+                fence_tracker.feed(text)
+
+            if chunk.prompt_feedback and chunk.prompt_feedback.block_reason:
+                pump.cancel()
+                sys.stdout.write("\n")  # Nueva línea para el mensaje de error
+                print(theme_manager.style("error_message",
+                      f"Prompt bloqueado: {chunk.prompt_feedback.block_reason_message}"))
+                return finish(TurnOutcome("blocked"))
+    except KeyboardInterrupt:
+        # Ctrl+C durante la generación: abortar solo esta petición, la sesión sigue viva
+        cancel_all()
+        stop_animation(write_model_prompt=not first_chunk_received)
+        print(theme_manager.style("warning_message", "\n[Respuesta cancelada]"))
+        return finish(TurnOutcome("cancelled", "".join(full_response_text_parts)))
+    except Exception:
+        # Si el error ocurrió antes de imprimir el prompt del modelo
+        cancel_all()
+        stop_animation(write_model_prompt=not first_chunk_received)
+        model_stats.record(model.model_name, None, False)
+        raise
+    finally:
+        stop_animation()
+
+    if not first_chunk_received:
+        stop_animation(write_model_prompt=True)  # Respuesta vacía, sin errores
+    sys.stdout.write("\n")  # Nueva línea después de la salida progresiva
     sys.stdout.flush()
+    return finish(TurnOutcome("ok", "".join(full_response_text_parts), _response_content(pump.response)))
+
+
+def _run_turn_attempts(session: ChatSessionState, contents: list) -> TurnOutcome:
+    """Un envío con la política de turno: si no llega el primer chunk a tiempo, reintenta o usa el respaldo."""
+    theme_manager = session.theme_manager
+    policy = session.turn_policy
+    attempt_models = [session.model] * (1 + int(policy.get("retries") or 0))
+    if policy.get("fallback_model"):
+        attempt_models.append(session.get_model(policy["fallback_model"]))
+
+    for attempt, model in enumerate(attempt_models):
+        outcome = _stream_turn_attempt(session, model, contents)
+        if outcome.status != "first_chunk_timeout":
+            break
+        timeout = policy["first_chunk_timeout_seconds"]
+        if attempt + 1 < len(attempt_models):
+            next_model = attempt_models[attempt + 1]
+            action = ("reintentando" if next_model is model
+                      else f"usando modelo de respaldo '{next_model.model_name}'")
+            print(theme_manager.style("warning_message", f"[Sin respuesta en {timeout}s; {action}]"))
+        else:
+            print(theme_manager.style("error_message", f"[Sin respuesta en {timeout}s; turno abandonado]"))
+    return outcome
+
+
+def _render_model_answer(text: str, theme_manager: ThemeManager):
+    if text.strip():  # Solo si hay contenido real
+        sys.stdout.write(format_gemini_output(text, theme_manager))
+        sys.stdout.write("\n")  # Añade la nueva línea final para el turno de respuesta
+        sys.stdout.flush()
+
+
+def run_chat_turn(session: ChatSessionState, user_input: str, attachments: Optional[List] = None) -> TurnOutcome:
+    """
+    Envía un mensaje (con los adjuntos de /attach, si los hay) y muestra la respuesta en streaming.
+    Si el modelo pide herramientas, las ejecuta y le reenvía los resultados hasta obtener la respuesta
+    final. Solo los turnos completos (o parciales, si el perfil lo pide) se añaden al historial,
+    con todas sus partes.
+    """
+    theme_manager = session.theme_manager
+    policy = session.turn_policy
+    history = session.chat.history
+    attachments = list(attachments or [])
+    user_content = genai.protos.Content(role="user", parts=[genai.protos.Part(text=user_input)] + attachments)
+    turn_contents = [user_content]  # Mensajes nuevos de este turno (incluye rondas de herramientas)
+
+    if not check_token_budget(session.profile_name, session.token_budget, theme_manager):
+        return TurnOutcome("budget_exceeded")
+
+    # Caché semántico: solo si la respuesta no depende de turnos anteriores ni de adjuntos
+    cache_vector = None
+    cache = session.semantic_cache
+    if cache is not None and not attachments and (
+            cache.history_independent or not any(c.role == "model" for c in history)):
+        cache_vector, hit = _semantic_cache_lookup(cache, user_input, theme_manager)
+        if hit:
+            entry, score = hit
+            styled_model_name_prompt = theme_manager.style(
+                "prompt_model_name", f"{session.model_name.split('/')[-1]}:", apply_reset=False)
+            sys.stdout.write(f"{styled_model_name_prompt}{Colors.RESET} ")
+            sys.stdout.write(theme_manager.style("info_message", f"[caché · similitud {score:.2f}]") + "\n")
+            sys.stdout.write(entry["answer"] + "\n")
+            sys.stdout.flush()
+            _render_model_answer(entry["answer"], theme_manager)
+            history.extend([user_content, genai.protos.Content(
+                role="model", parts=[genai.protos.Part(text=entry["answer"])])])
+            return TurnOutcome("ok", entry["answer"])
+
+    # Los fragmentos recuperados se envían solo en este turno; el historial guarda el mensaje original
+    request_user_content = user_content
+    if session.retrieval_index is not None:
+        retrieved = session.retrieval_index.search(
+            user_input, int(session.retrieval_settings.get("top_k", DEFAULT_RAG_TOP_K)),
+            float(session.retrieval_settings.get("min_score", DEFAULT_RAG_MIN_SCORE)))
+        if retrieved:
+            sources = ", ".join(sorted({chunk["file"] for chunk in retrieved}))
+            print(theme_manager.style("info_message", f"[contexto: {sources}]"))
+            request_user_content = genai.protos.Content(role="user", parts=[genai.protos.Part(
+                text=augment_prompt_with_retrieval(user_input, retrieved))] + attachments)
+
+    if session.router is not None:
+        routed_model_name, reason = session.router.choose(
+            user_input, has_attachments=any("text" not in part for part in user_content.parts))
+        session.model = session.get_model(routed_model_name)
+        print(theme_manager.style("info_message", f"[modelo: {routed_model_name.split('/')[-1]} · {reason}]"))
+
+    for tool_round in range(MAX_TOOL_ROUNDS + 1):
+        outcome = _run_turn_attempts(session, history + [request_user_content] + turn_contents[1:])
+        function_calls = _function_calls(outcome.content) if outcome.status == "ok" else []
+        if not function_calls:
+            break
+        if tool_round == MAX_TOOL_ROUNDS:
+            print(theme_manager.style("warning_message",
+                  f"[Límite de {MAX_TOOL_ROUNDS} rondas de herramientas alcanzado]"))
+            break
+        turn_contents.append(outcome.content)
+        turn_contents.append(run_tool_calls(function_calls, session.tool_settings, theme_manager))
+
+    if outcome.status == "ok":
+        if outcome.content is not None:
+            history.extend(turn_contents + [outcome.content])
+        if not (session.generation_config or {}).get("response_mime_type", "").endswith("json"):
+            _render_model_answer(outcome.text, theme_manager)  # El JSON ya se mostró tal cual al llegar
+        if cache_vector is not None and len(turn_contents) == 1 and outcome.text.strip():
+            session.semantic_cache.store(user_input, cache_vector, outcome.text)
+    elif outcome.status in ("cancelled", "turn_timeout") and outcome.text and policy.get("keep_partial_on_cancel"):
+        partial = genai.protos.Content(role="model", parts=[genai.protos.Part(text=outcome.text)])
+        history.extend(turn_contents + [partial])
+        print(theme_manager.style("info_message", "Respuesta parcial guardada en el historial."))
+    return outcome
+
+
+# --- Cola de prompts sin conexión (/queue, pygemai queue) ---
+
+
+class PromptQueue:
+    """
+    Cola en disco de prompts pendientes (queue/ en el directorio de datos), que sobrevive a reinicios. Cada prompt
+    es un pending/<id>.json con sus metadatos más un <id>.pb con los mensajes a enviar (historial
+    incluido). La respuesta se escribe en done/<id>.json y done/<id>.pb antes de tocar ningún
+    historial, así que reanudar tras un corte nunca reenvía un prompt ya respondido.
+    """
+
+    def __init__(self, root: Optional[str] = None):
+        self._root = root  # Sin ruta: queue/ del directorio de datos (puede cambiar con --data-dir)
+
+    @property
+    def root(self) -> str:
+        return self._root or data_path("queue")
+
+    @property
+    def pending_dir(self) -> str:
+        return os.path.join(self.root, "pending")
+
+    @property
+    def done_dir(self) -> str:
+        return os.path.join(self.root, "done")
+
+    @staticmethod
+    def _write_json(path: str, data: dict):
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def _read_json_dir(directory: str) -> List[dict]:
+        if not os.path.isdir(directory):
+            return []
+        entries = []
+        for filename in sorted(os.listdir(directory)):
+            if filename.endswith(".json"):
+                try:
+                    with open(os.path.join(directory, filename), "r", encoding="utf-8") as f:
+                        entries.append(json.load(f))
+                except (OSError, ValueError):
+                    continue  # Escritura a medio hacer: se ignora hasta la próxima pasada
+        return entries
+
+    def enqueue(self, model_name: str, contents: list, history_file: str, profile_name: str,
+                model_settings: Optional[dict] = None) -> dict:
+        """`model_settings`: los de ChatSessionState.queued_model_settings(), para enviar el prompt con el mismo modelo."""
+        os.makedirs(self.pending_dir, exist_ok=True)
+        item_id = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-") + os.urandom(3).hex()
+        # Primero los mensajes y después los metadatos: sin el .json, el prompt aún no está en la cola
+        save_history_snapshot(contents, os.path.join(self.pending_dir, f"{item_id}.pb"))
+        item = {"id": item_id, "created": datetime.datetime.now().isoformat(timespec="seconds"),
+                "model": model_name, "history_file": history_file, "profile": profile_name,
+                "prompt": _first_user_text(contents[-1]) or "", "attempts": 0, "next_attempt": 0.0,
+                "last_error": None, "model_settings": model_settings or {}}
+        self._write_json(os.path.join(self.pending_dir, f"{item_id}.json"), item)
+        return item
+
+    def _lock_path(self, item_id: str) -> str:
+        return os.path.join(self.pending_dir, f"{item_id}.lock")
+
+    def _result_lock_path(self, item_id: str) -> str:
+        return os.path.join(self.done_dir, f"{item_id}.lock")
+
+    @staticmethod
+    def _is_live_lock(lock: str) -> bool:
+        try:
+            return time.time() - os.path.getmtime(lock) < QUEUE_LOCK_STALE_SECONDS
+        except OSError:
+            return False
+
+    def _is_locked(self, item_id: str) -> bool:
+        return self._is_live_lock(self._lock_path(item_id))
+
+    def pending(self) -> List[dict]:
+        """Prompts sin respuesta, del más antiguo al más reciente."""
+        items = []
+        for item in self._read_json_dir(self.pending_dir):
+            if os.path.exists(os.path.join(self.done_dir, f"{item['id']}.json")):
+                self._remove_pending(item["id"])  # Respondido justo antes de un corte
+                continue
+            item["state"] = "enviando" if self._is_locked(item["id"]) else "pendiente"
+            items.append(item)
+        return items
+
+    def results(self) -> List[dict]:
+        return self._read_json_dir(self.done_dir)
+
+    def claim(self, item_id: str) -> bool:
+        """Reserva un prompt para enviarlo (otra sesión abierta podría estar drenando la misma cola)."""
+        return self._acquire_lock(self._lock_path(item_id))
+
+    def claim_result(self, item_id: str) -> bool:
+        """Reserva una respuesta para añadirla a su historial: aunque varias sesiones drenen la cola, solo una."""
+        if not self._acquire_lock(self._result_lock_path(item_id)):
+            return False
+        try:
+            with open(os.path.join(self.done_dir, f"{item_id}.json"), "r", encoding="utf-8") as f:
+                applied = json.load(f).get("applied")
+        except (OSError, ValueError):
+            applied = True
+        if applied:  # Otra sesión la aplicó entre la lectura de undelivered() y la reserva
+            self.release_result(item_id)
+            return False
+        return True
+
+    def release_result(self, item_id: str):
+        with contextlib.suppress(OSError):
+            os.remove(self._result_lock_path(item_id))
+
+    def _acquire_lock(self, lock: str) -> bool:
+        if os.path.exists(lock):
+            if self._is_live_lock(lock):
+                return False
+            # Reserva caducada de un proceso que murió. Se aparta con un nombre único (solo un proceso
+            # lo consigue) y se comprueba que lo apartado seguía caducado: otro proceso podría haberla
+            # sustituido por una reserva nueva justo antes
+            stale = f"{lock}.{os.getpid()}-{os.urandom(3).hex()}"
+            try:
+                os.rename(lock, stale)
+            except OSError:
+                return False
+            try:
+                if time.time() - os.path.getmtime(stale) < QUEUE_LOCK_STALE_SECONDS:
+                    os.rename(stale, lock)  # Era una reserva viva: se devuelve a su dueño
+                    return False
+            finally:
+                with contextlib.suppress(OSError):
+                    os.remove(stale)
+        try:
+            os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except OSError:
+            return False
+
+    def contents(self, item_id: str) -> list:
+        return load_history_snapshot(os.path.join(self.pending_dir, f"{item_id}.pb"))
+
+    def reschedule(self, item: dict, error: Exception):
+        """Sin conexión: se reintenta más tarde, con espera exponencial y algo de azar."""
+        item = {k: v for k, v in item.items() if k != "state"}
+        item["attempts"] += 1
+        backoff = min(QUEUE_MAX_BACKOFF_SECONDS, QUEUE_BASE_BACKOFF_SECONDS * 2 ** (item["attempts"] - 1))
+        item["next_attempt"] = time.time() + backoff * (0.5 + random.random() / 2)
+        item["last_error"] = str(error)[:300]
+        self._write_json(os.path.join(self.pending_dir, f"{item['id']}.json"), item)
+        self._release(item["id"])
+
+    def store_result(self, item: dict, status: str, turn: Optional[list] = None, error: Optional[str] = None):
+        """Guarda la respuesta (o el error definitivo) y saca el prompt de la cola."""
+        os.makedirs(self.done_dir, exist_ok=True)
+        if turn:
+            save_history_snapshot(turn, os.path.join(self.done_dir, f"{item['id']}.pb"))
+        result = {k: v for k, v in item.items() if k != "state"}
+        result.update(status=status, error=error, answered=datetime.datetime.now().isoformat(timespec="seconds"),
+                      applied=status != "ok")
+        self._write_json(os.path.join(self.done_dir, f"{item['id']}.json"), result)
+        self._remove_pending(item["id"])
+
+    def result_turn(self, item_id: str) -> list:
+        """[mensaje del usuario, respuesta del modelo] de un prompt ya respondido."""
+        return load_history_snapshot(os.path.join(self.done_dir, f"{item_id}.pb"))
+
+    def undelivered(self) -> List[dict]:
+        return [result for result in self.results() if not result.get("applied")]
+
+    def mark_applied(self, item_id: str):
+        path = os.path.join(self.done_dir, f"{item_id}.json")
+        with open(path, "r", encoding="utf-8") as f:
+            result = json.load(f)
+        result["applied"] = True
+        self._write_json(path, result)
+        self.release_result(item_id)
+
+    def _release(self, item_id: str):
+        with contextlib.suppress(OSError):
+            os.remove(self._lock_path(item_id))
+
+    def _remove_pending(self, item_id: str):
+        for extension in (".json", ".pb", ".lock"):
+            with contextlib.suppress(OSError):
+                os.remove(os.path.join(self.pending_dir, item_id + extension))
+
+
+prompt_queue = PromptQueue()
+
+
+def _queued_model(item: dict):
+    """Modelo de un prompt en cola, con los ajustes de la sesión que lo encoló."""
+    settings = item.get("model_settings") or {}
+    safety_settings = {HarmCategory[category]: HarmBlockThreshold[threshold]
+                       for category, threshold in (settings.get("safety_settings") or {}).items()}
+    return genai.GenerativeModel(item["model"], safety_settings=safety_settings or None,
+                                 generation_config=settings.get("generation_config"), tools=settings.get("tools"),
+                                 system_instruction=settings.get("system_instruction"))
+
+
+class QueueDrainer:
+    """
+    Envía en segundo plano los prompts de la cola, como mucho `max_concurrency` a la vez, y
+    espera cada vez más entre intentos mientras no haya conexión. `deliver(result)` decide si la
+    respuesta la recoge la sesión abierta (True); si no, se añade directamente a su historial.
+    """
+
+    def __init__(self, queue_: PromptQueue, max_concurrency: int = QUEUE_MAX_CONCURRENCY, deliver=None):
+        self.queue = queue_
+        self.max_concurrency = max_concurrency
+        self.deliver = deliver
+        self._wake = threading.Event()
+        self._stopped = False
+        self._handed_over = set()
+        self._thread = None
+
+    def start(self) -> "QueueDrainer":
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def wake(self):
+        """Revisa la cola ahora (p. ej. tras añadir un prompt)."""
+        self._wake.set()
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
+
+    def _process(self, item: dict) -> str:
+        try:
+            contents = self.queue.contents(item["id"])
+            started = time.monotonic()
+            response = _queued_model(item).generate_content(
+                contents, request_options={"timeout": QUEUE_REQUEST_TIMEOUT_SECONDS})
+            usage = _usage_counts(getattr(response, "usage_metadata", None))
+            content = _response_content(response)
+            feedback = response.prompt_feedback
+            if feedback and feedback.block_reason:
+                status, error = "blocked", feedback.block_reason_message
+            elif content is None:
+                status, error = "error", "respuesta vacía"
+            else:
+                status, error = "ok", None
+            self.queue.store_result(item, status, [contents[-1], content] if status == "ok" else None, error)
+            usage_ledger.record(item["profile"], item["model"], usage, time.monotonic() - started, None,
+                                status, "queue")
+            return "ok" if status == "ok" else "error"
+        except Exception as e:
+            if is_connectivity_error(e) or is_quota_error(e):
+                self.queue.reschedule(item, e)
+                return "retry"
+            self.queue.store_result(item, "error", error=str(e)[:300])
+            return "error"
+
+    def _apply_results(self):
+        for result in self.queue.undelivered():
+            if result["id"] in self._handed_over or not self.queue.claim_result(result["id"]):
+                continue
+            if self.deliver is not None and self.deliver(result):
+                self._handed_over.add(result["id"])
+                continue  # La sesión la marca como aplicada (y libera la reserva) al mostrarla
+            try:
+                append_to_history_file(result["history_file"], self.queue.result_turn(result["id"]))
+                self.queue.mark_applied(result["id"])
+            except Exception:
+                self.queue.release_result(result["id"])
+                continue  # Se vuelve a intentar en la siguiente pasada
+
+    def drain(self) -> dict:
+        """Una pasada completa en primer plano (pygemai queue drain), sin esperar a los reintentos programados."""
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            futures = [executor.submit(self._process, item) for item in self.queue.pending()
+                       if self.queue.claim(item["id"])]
+            outcomes = [future.result() for future in futures]
+        self._apply_results()
+        return {outcome: outcomes.count(outcome) for outcome in ("ok", "retry", "error")}
+
+    def _run(self):
+        in_flight = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            while not self._stopped:
+                now = time.time()
+                next_due = now + QUEUE_POLL_SECONDS
+                for item_id in [i for i, future in in_flight.items() if future.done()]:
+                    del in_flight[item_id]
+                try:
+                    for item in self.queue.pending():
+                        if item["next_attempt"] > now:
+                            next_due = min(next_due, item["next_attempt"])
+                        elif (len(in_flight) < self.max_concurrency and item["id"] not in in_flight
+                              and self.queue.claim(item["id"])):
+                            future = executor.submit(self._process, item)
+                            future.add_done_callback(lambda _: self._wake.set())
+                            in_flight[item["id"]] = future
+                    self._apply_results()
+                except OSError:
+                    pass  # Disco no disponible un momento: se reintenta en la siguiente pasada
+                self._wake.wait(max(0.0, next_due - time.time()))
+                self._wake.clear()
+
+
+def _deliver_queued_answers(session: ChatSessionState):
+    """Muestra y añade al historial las respuestas de la cola que ya llegaron para esta conversación."""
+    while not session.queued_answers.empty():
+        result = session.queued_answers.get_nowait()
+        try:
+            turn = session.prompt_queue.result_turn(result["id"])
+        except (OSError, ValueError):
+            session.prompt_queue.release_result(result["id"])
+            continue
+        print(session.theme_manager.style("info_message",
+              f"\n[Respuesta a un prompt en cola ({result['created']}): {result['prompt'][:60]}]"))
+        text = "".join(part.text for part in turn[-1].parts if "text" in part)
+        sys.stdout.write(text + "\n")
+        _render_model_answer(text, session.theme_manager)
+        session.chat.history.extend(turn)
+        session.prompt_queue.mark_applied(result["id"])
+
+
+# --- Salida estructurada: JSON en streaming convertido a NDJSON (--json-stream) ---
+
+
+def profile_generation_config(profile: Optional[dict], json_output: bool = False) -> Optional[dict]:
+    """generation_config con `response_mime_type` y `response_schema` del perfil (si los declara)."""
+    profile = profile or {}
+    config = {}
+    if profile.get("response_mime_type") or json_output:
+        config["response_mime_type"] = profile.get("response_mime_type") or "application/json"
+    if profile.get("response_schema"):
+        config["response_schema"] = profile["response_schema"]
+        config.setdefault("response_mime_type", "application/json")
+    return config or None
+
+
+class JSONStreamError(ValueError):
+    """Salida JSON inválida o incompleta, con la posición exacta en el texto recibido."""
+
+    def __init__(self, message: str, offset: int, line: int, column: int):
+        super().__init__(message)
+        self.message = message
+        self.offset = offset
+        self.line = line
+        self.column = column
+
+    def __str__(self):
+        return f"{self.message} (línea {self.line}, columna {self.column}, carácter {self.offset})"
+
+
+def json_records_key(generation_config: Optional[dict]) -> Optional[str]:
+    """
+    Clave del arreglo de registros según `response_schema`: la única propiedad de un objeto,
+    si es un arreglo (p. ej. {"items": [...]}). None en cualquier otro caso.
+    """
+    schema = (generation_config or {}).get("response_schema") or {}
+    properties = schema.get("properties") or {}
+    if str(schema.get("type", "")).lower() == "object" and len(properties) == 1:
+        name, definition = next(iter(properties.items()))
+        if str((definition or {}).get("type", "")).lower() == "array":
+            return name
+    return None
+
+
+class IncrementalJSONParser:
+    """
+    Analiza JSON a medida que llega y devuelve cada registro en cuanto se cierra. Los registros
+    son los elementos del arreglo principal, o los del arreglo bajo `records_key` en el objeto
+    principal (ver json_records_key); en ese caso, cualquier otra clave es un error, porque su
+    valor se perdería. En los demás casos el registro es el documento completo.
+    """
+
+    def __init__(self, records_key: Optional[str] = None):
+        self.records_key = records_key
+        self.records = 0
+        self._stack = []  # (carácter de apertura, offset, línea, columna)
+        self._in_string = False
+        self._string_start = None
+        self._escape = False
+        self._record_depth = None  # Profundidad del arreglo de registros
+        self._record_chars = None  # Texto del registro en curso
+        self._record_start = None
+        self._document_chars = []  # Solo mientras no haya arreglo de registros
+        self._expect_record = False  # Tras '[' o ',' en el arreglo de registros
+        self._done = False
+        self._expect_key = False  # En el objeto principal, tras '{' o ','
+        self._key_chars = None    # Clave del objeto principal que se está leyendo
+        self._key = None          # Última clave leída del objeto principal
+        self._offset = 0
+        self._line = 1
+        self._column = 1
+
+    def _error(self, message: str, position: Optional[tuple] = None) -> JSONStreamError:
+        offset, line, column = position or (self._offset, self._line, self._column)
+        return JSONStreamError(message, offset, line, column)
+
+    def _finish_record(self) -> object:
+        text = "".join(self._record_chars)
+        try:
+            value = json.loads(text)
+        except json.JSONDecodeError as e:
+            start_offset, start_line, start_column = self._record_start
+            line = start_line + text.count("\n", 0, e.pos)
+            column = e.pos - text.rfind("\n", 0, e.pos) if line > start_line else start_column + e.pos
+            raise JSONStreamError(f"Registro {self.records + 1} inválido: {e.msg}",
+                                  start_offset + e.pos, line, column) from None
+        self.records += 1
+        self._record_chars = None
+        self._record_start = None
+        return value
+
+    def _finish_key(self):
+        try:
+            self._key = json.loads('"' + "".join(self._key_chars) + '"')
+        except json.JSONDecodeError as e:
+            raise self._error(f"Clave inválida: {e.msg}", self._string_start) from None
+        self._key_chars = None
+        if self.records_key is not None and self._key != self.records_key:
+            raise self._error(f"Clave '{self._key}' fuera del arreglo de registros '{self.records_key}': "
+                              "su valor no se emitiría", self._string_start)
+
+    def feed(self, text: str) -> list:
+        """Procesa un fragmento y devuelve los registros que se completaron en él."""
+        completed = []
+        for char in text:
+            position = (self._offset, self._line, self._column)
+            completed.extend(self._feed_char(char, position))
+            self._offset += 1
+            if char == "\n":
+                self._line += 1
+                self._column = 1
+            else:
+                self._column += 1
+        return completed
+
+    def _feed_char(self, char: str, position: tuple) -> list:
+        if self._done:
+            if not char.isspace():
+                raise self._error("Contenido inesperado después del JSON", position)
+            return []
+        depth = len(self._stack)
+        at_record_level = self._record_depth is not None and depth == self._record_depth and not self._in_string
+        if at_record_level and self._record_chars is None and not char.isspace() and char not in ",]":
+            self._record_chars = []
+            self._record_start = position
+            self._expect_record = False
+        if at_record_level and char in ",]" and self._record_chars is None and self._expect_record:
+            if char == "," or self.records:  # "[]" es válido; "[," o ",]" no
+                raise self._error("Falta un valor antes de '" + char + "'", position)
+
+        completed = []
+        if self._in_string:
+            if self._escape:
+                self._escape = False
+            elif char == "\\":
+                self._escape = True
+            elif char == '"':
+                self._in_string = False
+            if self._key_chars is not None:
+                if self._in_string:
+                    self._key_chars.append(char)
+                else:
+                    self._finish_key()
+        elif char == '"':
+            self._in_string = True
+            self._string_start = position
+            if self._expect_key:
+                self._expect_key = False
+                self._key_chars = []
+        elif char in "[{":
+            self._stack.append((char, *position))
+            if char == "{" and len(self._stack) == 1:
+                self._expect_key = True
+            records_array = len(self._stack) == 1 or (
+                len(self._stack) == 2 and self._stack[0][0] == "{" and
+                self.records_key is not None and self._key == self.records_key)
+            if char == "[" and self._record_depth is None and records_array:
+                self._record_depth = len(self._stack)
+                self._document_chars = None
+                self._expect_record = True
+                return []
+        elif char in "]}":
+            if not self._stack:
+                raise self._error(f"'{char}' sin apertura correspondiente", position)
+            opener, offset, line, column = self._stack[-1]
+            if (opener, char) not in (("[", "]"), ("{", "}")):
+                raise self._error(f"'{char}' inesperado: '{opener}' abierto en línea {line}, columna {column} "
+                                  "sigue sin cerrar", position)
+            if at_record_level and char == "]":
+                if self._record_chars is not None:
+                    completed.append(self._finish_record())
+                self._stack.pop()
+                self._record_depth = -1  # Arreglo de registros cerrado: no se buscan más
+                self._done = not self._stack
+                return completed
+            self._stack.pop()
+            if not self._stack:
+                self._done = True
+        elif char == "," and at_record_level:
+            if self._record_chars is not None:
+                completed.append(self._finish_record())
+            self._expect_record = True
+            return completed
+        elif char == "," and len(self._stack) == 1 and self._stack[0][0] == "{":
+            self._expect_key = True
+
+        if self._record_chars is not None:
+            self._record_chars.append(char)
+        if self._document_chars is not None:
+            self._document_chars.append(char)
+        if self._done and self._record_depth is None:
+            completed.append(self._finish_document())
+        return completed
+
+    def _finish_document(self) -> object:
+        text = "".join(self._document_chars)
+        self._document_chars = None
+        self._done = True
+        try:
+            value = json.loads(text)
+        except json.JSONDecodeError as e:
+            line = 1 + text.count("\n", 0, e.pos)
+            column = e.pos - text.rfind("\n", 0, e.pos)
+            raise JSONStreamError(f"JSON inválido: {e.msg}", e.pos, line, column) from None
+        self.records += 1
+        return value
+
+    def close(self) -> list:
+        """Fin del stream: devuelve un escalar pendiente o informa qué quedó sin cerrar."""
+        if self._in_string:
+            raise self._error(f"JSON incompleto: cadena sin cerrar ({self.records} registro(s) completos)",
+                              self._string_start)
+        if self._stack:
+            opener, offset, line, column = self._stack[-1]
+            raise JSONStreamError(f"JSON incompleto: falta cerrar '{opener}' ({self.records} registro(s) completos)",
+                                  offset, line, column)
+        if not self._done:
+            if self._document_chars and "".join(self._document_chars).strip():
+                return [self._finish_document()]
+            raise self._error("Respuesta vacía: no se recibió JSON")
+        return []
+
+
+# --- Modo de un solo disparo (pipe): pygemai -p "prompt" < entrada ---
+
+
+def _default_safety_settings() -> dict:
+    return {
+        HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
+        HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_ONLY_HIGH,
+        HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
+        HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
+    }
+
+
+def _chunk_text(chunk) -> str:
+    """Texto de un chunk de streaming; '' si el chunk no trae partes de texto."""
+    try:
+        return chunk.text or ""
+    except (ValueError, AttributeError):
+        return ""
+
+
+def load_api_keys_noninteractive(theme_manager: ThemeManager) -> Dict[str, str]:
+    """
+    Obtiene las API Keys sin preguntar nada al usuario, en este orden:
+    variable GOOGLE_API_KEY, comando agente (PYGEMAI_API_KEY_COMMAND, p. ej. `pass show gemini`),
+    archivo encriptado con la contraseña en PYGEMAI_KEY_PASSWORD (todas sus claves) y archivo sin encriptar.
+    """
+    api_key = os.getenv("GOOGLE_API_KEY")
+    if api_key:
+        return {"GOOGLE_API_KEY": api_key.strip()}
+
+    key_command = os.getenv("PYGEMAI_API_KEY_COMMAND")
+    if key_command:
+        try:
+            result = subprocess.run(key_command, shell=True, capture_output=True, text=True, timeout=30)
+            if result.returncode == 0 and result.stdout.strip():
+                return {"PYGEMAI_API_KEY_COMMAND": result.stdout.strip().splitlines()[0]}
+            print(theme_manager.style("error_message",
+                  f"El comando de API Key terminó con código {result.returncode}."))
+        except Exception as e:
+            print(theme_manager.style("error_message", f"Error al ejecutar el comando de API Key: {e}"))
+
+    password = os.getenv("PYGEMAI_KEY_PASSWORD")
+    key_file = data_path(ENCRYPTED_API_KEY_FILE)
+    if password and os.path.exists(key_file):
+        keys = load_decrypted_api_keys(password, theme_manager)
+        if keys:
+            return keys
+        print(theme_manager.style("error_message",
+              f"PYGEMAI_KEY_PASSWORD no desencripta {key_file}."))
+
+    api_key = load_unencrypted_api_key(theme_manager)
+    return {DEFAULT_KEY_NAME: api_key} if api_key else {}
+
+
+def load_api_key_noninteractive(theme_manager: ThemeManager) -> Optional[str]:
+    keys = load_api_keys_noninteractive(theme_manager)
+    return next(iter(keys.values())) if keys else None
+
+
+def _read_one_shot_prompt(prompt_arg: str) -> str:
+    """Combina el prompt de -p con lo que llegue por stdin (si stdin no es una terminal)."""
+    stdin_text = ""
+    if not sys.stdin.isatty():
+        stdin_text = sys.stdin.read()
+    if prompt_arg and stdin_text.strip():
+        return f"{prompt_arg}\n\n{stdin_text}"
+    return prompt_arg or stdin_text
+
+
+def run_one_shot(args) -> int:
+    """
+    Ejecuta un único prompt sin interacción: sin banner, sin animación y sin preguntas.
+    El texto del modelo va tal cual a stdout según llega; los mensajes van a stderr.
+    Devuelve un código de salida (EXIT_*).
+    """
+    # Sin colores: la salida de diagnóstico puede acabar en un log
+    theme_manager = ThemeManager({"Plain": {"colors": {}}}, "Plain")
+
+    with contextlib.redirect_stdout(sys.stderr):
+        prompt = _read_one_shot_prompt(args.prompt or "").strip()
+        if not prompt:
+            print("Error: No se recibió prompt (usa -p \"texto\" y/o envía la entrada por stdin).")
+            return EXIT_USAGE
+
+        profiles_data = load_profiles(theme_manager)
+        active_profile = profiles_data[0] if profiles_data else {}
+        model_name = args.model or active_profile.get("model_id") or \
+            load_preferences(theme_manager).get("last_used_model")
+        if not args.model and active_profile.get("router"):
+            try:
+                model_name, reason = ModelRouter.for_profile(active_profile).choose(prompt)
+                print(f"[modelo: {model_name.split('/')[-1]} · {reason}]")
+            except ValueError as e:
+                print(f"Advertencia: Router desactivado: {e}")
+        if not model_name:
+            print("Error: No hay modelo configurado. Usa -m/--model o define un perfil.")
+            return EXIT_USAGE
+
+        api_keys = load_api_keys_noninteractive(theme_manager)
+        if not api_keys:
+            print("Error: API Key no encontrada (GOOGLE_API_KEY, PYGEMAI_API_KEY_COMMAND, "
+                  "PYGEMAI_KEY_PASSWORD o archivo de clave).")
+            return EXIT_USAGE
+        try:
+            key_pool = KeyPool.from_env(api_keys)
+        except ValueError as e:
+            print(f"Error: {e}")
+            return EXIT_USAGE
+        key_name, api_key = key_pool.acquire()
+
+        safety_settings_data = active_profile.get("safety_settings")
+        safety_settings = (_parse_safety_settings(safety_settings_data, theme_manager)
+                           if safety_settings_data else None) or _default_safety_settings()
+        system_prompt = (active_profile.get("system_prompt") or "").strip()
+        generation_config = profile_generation_config(active_profile, args.json_stream)
+
+        key_attempts = len(api_keys)
+
+        def new_model():
+            return genai.GenerativeModel(model_name, safety_settings=safety_settings,
+                                         generation_config=generation_config,
+                                         system_instruction=system_prompt or None)
+
+        try:
+            key_pool.configure(key_name)
+            model = None
+            context_cache_settings = active_profile.get("context_cache") or {}
+            if context_cache_settings.get("enabled"):
+                cached_content = get_or_create_cached_content(
+                    model_name, active_profile.get("profile_name", "Default"), system_prompt,
+                    _read_pinned_documents(context_cache_settings.get("documents", []), theme_manager),
+                    int(context_cache_settings.get("ttl_seconds", DEFAULT_CONTEXT_CACHE_TTL_SECONDS)),
+                    theme_manager)
+                if cached_content is not None:
+                    model = genai.GenerativeModel.from_cached_content(
+                        cached_content, generation_config=generation_config, safety_settings=safety_settings)
+                    key_attempts = 1  # El caché de contexto pertenece al proyecto de esta clave
+            if model is None:
+                model = new_model()
+        except Exception as e:
+            print(f"Error al configurar la API: {e}")
+            return EXIT_API_ERROR
+
+        profile_name = active_profile.get("profile_name", "Default")
+        if not check_token_budget(profile_name, active_profile.get("token_budget") or {}, theme_manager):
+            return EXIT_BLOCKED
+
+        cache = SemanticCache.for_profile(active_profile, model_name)
+        cache_vector, hit = _semantic_cache_lookup(cache, prompt, theme_manager) if cache else (None, None)
+        if hit:
+            print(f"[caché · similitud {hit[1]:.2f}]")
+
+    # Con --json-stream, stdout recibe un registro NDJSON por cada elemento que se cierra
+    json_parser = IncrementalJSONParser(json_records_key(generation_config)) if args.json_stream else None
+
+    def emit(text: str):
+        if json_parser is None:
+            sys.stdout.write(text)
+        else:
+            for record in json_parser.feed(text):
+                sys.stdout.write(json.dumps(record, ensure_ascii=False) + "\n")
+        sys.stdout.flush()
+
+    def finish_output() -> int:
+        if json_parser is None:
+            if wrote_text:
+                sys.stdout.write("\n")
+                sys.stdout.flush()
+            return EXIT_OK
+        for record in json_parser.close():
+            sys.stdout.write(json.dumps(record, ensure_ascii=False) + "\n")
+        sys.stdout.flush()
+        return EXIT_OK
+
+    wrote_text = False
+    if hit:
+        try:
+            wrote_text = True
+            emit(hit[0]["answer"])
+            return finish_output()
+        except JSONStreamError as e:
+            sys.stderr.write(f"Salida JSON inválida: {e}\n")
+            return EXIT_INVALID_OUTPUT
+    for key_attempt in range(key_attempts):
+        started = time.monotonic()
+        first_chunk_latency = None
+        usage_metadata = None
+        try:
+            response = model.generate_content(prompt, stream=True)
+            response_text_parts = []
+            for chunk in response:
+                if first_chunk_latency is None:
+                    first_chunk_latency = time.monotonic() - started
+                if getattr(chunk, "usage_metadata", None):
+                    usage_metadata = chunk.usage_metadata
+                if chunk.prompt_feedback and chunk.prompt_feedback.block_reason:
+                    sys.stderr.write(f"Prompt bloqueado: {chunk.prompt_feedback.block_reason_message}\n")
+                    return EXIT_BLOCKED
+                text = _chunk_text(chunk)
+                if text:
+                    wrote_text = True
+                    response_text_parts.append(text)
+                    emit(text)
+            usage_ledger.record(profile_name, model_name, _usage_counts(usage_metadata),
+                                time.monotonic() - started, first_chunk_latency, "ok", "one-shot")
+            model_stats.record(model_name, None if first_chunk_latency is None else first_chunk_latency * 1000, True)
+            exit_code = finish_output()
+            if cache_vector is not None and wrote_text:
+                cache.store(prompt, cache_vector, "".join(response_text_parts))
+            return exit_code
+        except JSONStreamError as e:
+            sys.stderr.write(f"Salida JSON inválida: {e}\n")
+            return EXIT_INVALID_OUTPUT
+        except KeyboardInterrupt:
+            return EXIT_INTERRUPTED
+        except BrokenPipeError:
+            # El consumidor cerró la tubería (p. ej. `| head`); evitar el error al cerrar stdout
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, sys.stdout.fileno())
+            return EXIT_OK
+        except Exception as e:
+            model_stats.record(model_name, None, False)
+            if not is_quota_error(e):
+                sys.stderr.write(f"Error en comunicación con API: {e}\n")
+                return EXIT_API_ERROR
+            key_pool.report_throttled(key_name)
+            if wrote_text or key_attempt + 1 == key_attempts:
+                sys.stderr.write(f"Cuota agotada (clave '{key_name}'): {e}\n")
+                return EXIT_API_ERROR
+            key_name, _ = key_pool.acquire()
+            key_pool.configure(key_name)
+            model = new_model()  # El modelo anterior se quedó con el cliente de la otra clave
+            sys.stderr.write(f"Cuota agotada; reintentando con la clave '{key_name}'.\n")
+    return EXIT_API_ERROR
+
+
+def _parse_cli_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="pygemai",
+        description="Chatbot CLI para Google Gemini. Sin argumentos inicia el chat interactivo.")
+    parser.add_argument("-p", "--prompt", nargs="?", const="", default=None,
+                        help="Modo de un solo disparo: envía PROMPT (más la entrada de stdin, si la hay) "
+                             "y escribe la respuesta en stdout, sin preguntas interactivas.")
+    parser.add_argument("--json-stream", action="store_true",
+                        help="Modo de un solo disparo con salida JSON: escribe en stdout una línea NDJSON por "
+                             "cada elemento en cuanto se completa (usa response_schema del perfil, si existe).")
+    parser.add_argument("-m", "--model", default=None,
+                        help="Modelo para el modo -p (por defecto: el del perfil activo o el último usado).")
+    parser.add_argument("--data-dir", metavar="DIR", default=None,
+                        help=f"Directorio de datos (claves, perfiles, historial, cachés, índices y métricas). "
+                             f"Por defecto ${DATA_DIR_ENV_VAR} o $XDG_DATA_HOME/{DATA_DIR_NAME} "
+                             f"(~/.local/share/{DATA_DIR_NAME}).")
+    parser.add_argument("--history-format", choices=HISTORY_FORMATS, default=None,
+                        help="Formato al guardar el historial: json (por defecto) o snapshot (binario protobuf, "
+                             "carga más rápida y sin pérdidas). Sin esta opción se conserva el formato existente.")
+    parser.add_argument("--profile-cpu", metavar="ARCHIVO", default=None,
+                        help="Perfila la sesión con cProfile y guarda el volcado pstats en ARCHIVO al salir.")
+    parser.add_argument("--profile-top", metavar="N", type=int, default=DEFAULT_PROFILE_TOP_N,
+                        help=f"Funciones a mostrar en el resumen del perfil (por defecto {DEFAULT_PROFILE_TOP_N}).")
+    parser.add_argument("--trace-malloc", action="store_true",
+                        help="Informa los principales sitios de asignación de memoria (tracemalloc) al inicio, "
+                             "tras cargar el historial, cada N turnos y al salir.")
+    parser.add_argument("--trace-malloc-every", metavar="N", type=int, default=DEFAULT_TRACE_MALLOC_EVERY_TURNS,
+                        help=f"Turnos entre instantáneas de tracemalloc (por defecto {DEFAULT_TRACE_MALLOC_EVERY_TURNS}).")
+
+    parser.add_argument("--record", metavar="ARCHIVO", default=None,
+                        help="Graba la sesión interactiva (entradas, peticiones y chunks con sus tiempos) en ARCHIVO.")
+    parser.add_argument("--replay", metavar="ARCHIVO", default=None,
+                        help="Reproduce sin conexión una sesión grabada con --record.")
+    parser.add_argument("--replay-speed", metavar="X", type=float, default=1.0,
+                        help="Velocidad de reproducción: 1 = tiempos reales, 10 = diez veces más rápido, "
+                             "0 = sin esperas (por defecto 1).")
+
+    subparsers = parser.add_subparsers(dest="command", metavar="COMANDO")
+    history_parser = subparsers.add_parser("history", help="Mantenimiento del historial de chat.")
+    history_subparsers = history_parser.add_subparsers(dest="history_command", metavar="ACCIÓN")
+    history_subparsers.required = True
+    history_subparsers.add_parser("gc", help="Borra las partes de mensajes que ya no usa ninguna conversación.")
+    export_parser = history_subparsers.add_parser("export", help="Exporta una instantánea binaria (.pb) a JSON legible.")
+    export_parser.add_argument("snapshot", metavar="ARCHIVO", help="Instantánea del historial (chat_history_*.pb).")
+    export_parser.add_argument("-o", "--output", metavar="SALIDA", default=None,
+                               help="Archivo JSON de salida (por defecto ARCHIVO con extensión .export.json).")
+
+    key_parser = subparsers.add_parser("key", help="Gestión del archivo de API Key encriptada.")
+    key_subparsers = key_parser.add_subparsers(dest="key_command", metavar="ACCIÓN")
+    key_subparsers.required = True
+    calibrate_parser = key_subparsers.add_parser(
+        "calibrate", help="Mide esta máquina y vuelve a encriptar la clave para un tiempo de desbloqueo dado.")
+    calibrate_parser.add_argument("--target-ms", type=float, default=DEFAULT_KDF_TARGET_MS,
+                                  help=f"Tiempo de desbloqueo deseado en ms (por defecto {DEFAULT_KDF_TARGET_MS}).")
+    calibrate_parser.add_argument("--kdf", choices=SUPPORTED_KDFS, default="pbkdf2-sha256",
+                                  help="Función de derivación de clave (scrypt es resistente a hardware dedicado).")
+    add_key_parser = key_subparsers.add_parser(
+        "add", help="Añade (o reemplaza) una clave con nombre al archivo encriptado.")
+    add_key_parser.add_argument("name", metavar="NOMBRE")
+    remove_key_parser = key_subparsers.add_parser("remove", help="Elimina una clave del archivo encriptado.")
+    remove_key_parser.add_argument("name", metavar="NOMBRE")
+    key_subparsers.add_parser("list", help="Lista las claves guardadas con sus contadores de uso y de cuota.")
+
+    route_parser = subparsers.add_parser(
+        "route", help="Muestra qué modelo elegiría el router del perfil activo para un prompt (sin enviarlo).")
+    route_parser.add_argument("text", metavar="PROMPT", nargs="?", default="",
+                              help="Prompt a evaluar (por defecto se lee de stdin).")
+
+    migrate_parser = subparsers.add_parser(
+        "migrate", help="Mueve al directorio de datos los archivos que versiones anteriores dejaban en DIR.")
+    migrate_parser.add_argument("source_dir", metavar="DIR",
+                                help="Directorio desde el que ejecutabas la versión anterior.")
+
+    usage_parser = subparsers.add_parser("usage", help="Resumen de tokens consumidos (registro local).")
+    usage_parser.add_argument("--by", choices=USAGE_GROUPINGS, default="day",
+                              help="Agrupar por perfil, modelo o día (por defecto: day).")
+    usage_parser.add_argument("--since", metavar="AAAA-MM-DD", help="Solo desde esta fecha.")
+
+    queue_parser = subparsers.add_parser("queue", help="Prompts en cola para enviar cuando haya conexión.")
+    queue_subparsers = queue_parser.add_subparsers(dest="queue_command", metavar="ACCIÓN")
+    queue_subparsers.required = True
+    queue_ls_parser = queue_subparsers.add_parser("ls", help="Lista los prompts pendientes.")
+    queue_ls_parser.add_argument("--all", action="store_true",
+                                 help="Incluye también los ya respondidos y los que fallaron.")
+    queue_subparsers.add_parser("drain", help="Envía ahora los prompts pendientes y guarda las respuestas "
+                                              "en su historial.")
+
+    index_parser = subparsers.add_parser("index", help="Índice local de documentos para recuperación (RAG).")
+    index_subparsers = index_parser.add_subparsers(dest="index_command", metavar="ACCIÓN")
+    index_subparsers.required = True
+    build_parser = index_subparsers.add_parser(
+        "build", help="Trocea y embebe los archivos de DIR (solo los que cambiaron desde la última vez).")
+    build_parser.add_argument("source_dir", metavar="DIR")
+    build_parser.add_argument("--index", default=None,
+                              help=f"Directorio del índice (por defecto index/{RAG_INDEX_DIR} en el directorio de datos).")
+    build_parser.add_argument("--embedder", default=DEFAULT_EMBEDDING_MODEL,
+                              help=f"Modelo de embeddings (por defecto {DEFAULT_EMBEDDING_MODEL}; "
+                                   f"'{LOCAL_EMBEDDER}' usa embeddings locales sin red).")
+    return parser.parse_args(argv)
+
+
+def run_queue_command(args: argparse.Namespace) -> int:
+    theme_manager = ThemeManager(PREDEFINED_THEMES, "Legacy")
+    if args.queue_command == "ls":
+        rows = [(item["id"], item["state"], item["model"], str(item["attempts"]),
+                 (datetime.datetime.fromtimestamp(item["next_attempt"]).strftime("%H:%M:%S")
+                  if item["next_attempt"] > time.time() else "-"), item["prompt"])
+                for item in prompt_queue.pending()]
+        if args.all:
+            states = {"ok": "respondido", "blocked": "bloqueado", "error": "error"}
+            rows += [(result["id"], states.get(result["status"], result["status"]) +
+                      ("" if result.get("applied") else " (sin entregar)"), result["model"],
+                      str(result["attempts"] + 1), "-", result["error"] or result["prompt"])
+                     for result in prompt_queue.results()]
+        if not rows:
+            print(theme_manager.style("info_message", f"No hay prompts en la cola ({prompt_queue.root})."))
+            return EXIT_OK
+        print(f"{'id':<22}  {'estado':<24}  {'modelo':<32}  {'intentos':>8}  {'reintento':>9}  prompt")
+        for item_id, state, model_name, attempts, retry_at, prompt in rows:
+            print(f"{item_id:<22}  {state:<24}  {model_name.split('/')[-1]:<32}  {attempts:>8}  {retry_at:>9}  "
+                  f"{prompt.replace(chr(10), ' ')[:60]}")
+    elif args.queue_command == "drain":
+        if not prompt_queue.pending() and not prompt_queue.undelivered():
+            print(theme_manager.style("info_message", "La cola está vacía."))
+            return EXIT_OK
+        api_key = load_api_key_noninteractive(theme_manager)
+        if not api_key:
+            print(theme_manager.style("error_message",
+                  "API Key no encontrada (GOOGLE_API_KEY, PYGEMAI_API_KEY_COMMAND o PYGEMAI_KEY_PASSWORD)."))
+            return EXIT_USAGE
+        configure_genai(api_key)
+        counts = QueueDrainer(prompt_queue).drain()
+        print(theme_manager.style("info_message", f"Respondidos: {counts['ok']}; sin conexión (se reintentarán): "
+                                  f"{counts['retry']}; con error: {counts['error']}."))
+        if counts["retry"]:
+            return EXIT_API_ERROR
+    return EXIT_OK
+
+
+def run_index_command(args: argparse.Namespace) -> int:
+    theme_manager = ThemeManager(PREDEFINED_THEMES, "Legacy")
+    if args.index_command == "build":
+        if not os.path.isdir(args.source_dir):
+            print(theme_manager.style("error_message", f"No existe el directorio {args.source_dir}."))
+            return EXIT_USAGE
+        if args.embedder != LOCAL_EMBEDDER:
+            api_key = load_api_key_noninteractive(theme_manager)
+            if not api_key:
+                print(theme_manager.style("error_message",
+                      "API Key no encontrada (GOOGLE_API_KEY, PYGEMAI_API_KEY_COMMAND o PYGEMAI_KEY_PASSWORD)."))
+                return EXIT_USAGE
+            configure_genai(api_key)
+        index_dir = args.index or data_path("index", RAG_INDEX_DIR)
+        try:
+            stats = build_rag_index(args.source_dir, index_dir, args.embedder, theme_manager)
+        except Exception as e:
+            print(theme_manager.style("error_message", f"Error al construir el índice: {e}"))
+            return EXIT_API_ERROR
+        print(theme_manager.style("info_message",
+              f"Índice '{index_dir}': {stats['chunks']} fragmentos; archivos reutilizados {stats['reused']}, "
+              f"embebidos {stats['embedded']}, eliminados {stats['removed']}."))
+    return EXIT_OK
+
+
+def run_route_command(args: argparse.Namespace) -> int:
+    theme_manager = ThemeManager(PREDEFINED_THEMES, "Legacy")
+    profiles_data = load_profiles(theme_manager)
+    try:
+        router = ModelRouter.for_profile(profiles_data[0] if profiles_data else None)
+    except ValueError as e:
+        print(theme_manager.style("error_message", str(e)))
+        return EXIT_USAGE
+    if router is None:
+        print(theme_manager.style("error_message", "El perfil activo no tiene 'router'."))
+        return EXIT_USAGE
+    prompt = args.text or _read_one_shot_prompt("")
+    model_name, reason = router.choose(prompt)
+    print(f"{model_name}\t{reason}")
+    for alias, name in router.models.items():
+        summary = router.stats.summary(name)
+        p50 = "-" if summary["p50_ms"] is None else f"{summary['p50_ms']} ms"
+        print(theme_manager.style("info_message",
+              f"  {alias}: {summary['count']} peticiones recientes, {summary['error_rate']:.0%} errores, p50 {p50}"))
+    return EXIT_OK
+
+
+def run_migrate_command(args: argparse.Namespace) -> int:
+    theme_manager = ThemeManager(PREDEFINED_THEMES, "Legacy")
+    if not os.path.isdir(args.source_dir):
+        print(theme_manager.style("error_message", f"No existe el directorio {args.source_dir}."))
+        return EXIT_USAGE
+    messages = migrate_legacy_data(args.source_dir)
+    if not messages:
+        print(theme_manager.style("info_message",
+              f"No hay archivos de versiones anteriores en {os.path.abspath(args.source_dir)}."))
+    for message in messages:
+        print(theme_manager.style("info_message", message))
+    return EXIT_OK
+
+
+def run_usage_command(args: argparse.Namespace) -> int:
+    theme_manager = ThemeManager(PREDEFINED_THEMES, "Legacy")
+    rows = usage_ledger.summarize(args.by, args.since)
+    if not rows:
+        print(theme_manager.style("info_message", f"No hay registros de uso en {usage_ledger.path}."))
+        return EXIT_OK
+    width = max(len(args.by), *(len(key) for key, _ in rows))
+    print(f"{args.by:<{width}}  {'peticiones':>10}  {'prompt':>10}  {'en caché':>10}  {'salida':>10}  "
+          f"{'total':>10}  {'latencia media':>14}  {'duplicadas':>10}  {'ganadas':>7}")
+    for key, row in rows:
+        print(f"{key:<{width}}  {row['requests']:>10}  {row['prompt_tokens']:>10}  {row['cached_tokens']:>10}  "
+              f"{row['output_tokens']:>10}  {row['total_tokens']:>10}  "
+              f"{row['latency_ms'] / row['requests']:>11.0f} ms  "
+              f"{row['hedged'] / row['requests']:>10.0%}  {row['hedge_wins']:>7}")
+    return EXIT_OK
+
+
+def run_key_command(args: argparse.Namespace) -> int:
+    theme_manager = ThemeManager(PREDEFINED_THEMES, "Legacy")
+    key_file = data_path(ENCRYPTED_API_KEY_FILE)
+    if args.key_command == "calibrate":
+        if not os.path.exists(key_file):
+            print(theme_manager.style("error_message", f"No existe {key_file}."))
+            return EXIT_USAGE
+        password = getpass.getpass(theme_manager.style("prompt_user",
+                                   "Ingresa la contraseña para desencriptar la API Key: "))
+        if not recalibrate_encrypted_api_key(password, args.kdf, args.target_ms, theme_manager):
+            return EXIT_ERROR
+    elif args.key_command in ("add", "remove", "list"):
+        keys = {}
+        if os.path.exists(key_file):
+            password = getpass.getpass(theme_manager.style("prompt_user",
+                                       "Ingresa la contraseña para desencriptar la API Key: "))
+            keys = load_decrypted_api_keys(password, theme_manager)
+            if keys is None:
+                print(theme_manager.style("error_message", "Contraseña incorrecta o archivo corrupto."))
+                return EXIT_ERROR
+        elif args.key_command != "add":
+            print(theme_manager.style("error_message", f"No existe {key_file}."))
+            return EXIT_USAGE
+        else:
+            password = getpass.getpass(theme_manager.style("prompt_user",
+                                       "Ingresa contraseña para encriptar (mín. 8 car.): "))
+            if len(password) < 8 or password != getpass.getpass(
+                    theme_manager.style("prompt_user", "Confirma contraseña: ")):
+                print(theme_manager.style("error_message", "Contraseña muy corta o no coincide."))
+                return EXIT_USAGE
+
+        if args.key_command == "list":
+            stats = KeyPool(keys).stats()
+            for name, counters in stats.items():
+                sidelined = counters["sidelined_until"] > time.time()
+                print(f"{name}: {counters['requests']} peticiones, {counters['throttles']} errores de cuota"
+                      + (" (apartada)" if sidelined else ""))
+            return EXIT_OK
+        if args.key_command == "add":
+            api_key = getpass.getpass(theme_manager.style("prompt_user", f"API Key para '{args.name}': ")).strip()
+            if not api_key:
+                print(theme_manager.style("error_message", "No se ingresó clave de API."))
+                return EXIT_USAGE
+            keys[args.name] = api_key
+        else:
+            if args.name not in keys:
+                print(theme_manager.style("error_message", f"No hay ninguna clave llamada '{args.name}'."))
+                return EXIT_USAGE
+            if len(keys) == 1:
+                print(theme_manager.style("error_message", "No se puede eliminar la única clave del archivo."))
+                return EXIT_USAGE
+            del keys[args.name]
+        save_encrypted_api_keys(keys, password, theme_manager, _read_key_file()[0]
+                                if os.path.exists(key_file) else None)
+    return EXIT_OK
+
+
+def run_history_command(args: argparse.Namespace) -> int:
+    theme_manager = ThemeManager(PREDEFINED_THEMES, "Legacy")
+    if args.history_command == "gc":
+        removed = gc_history_blobs(theme_manager)
+        print(theme_manager.style("info_message", f"Partes de historial eliminadas: {removed}"))
+    elif args.history_command == "export":
+        output = args.output or os.path.splitext(args.snapshot)[0] + ".export.json"
+        try:
+            history = load_history_snapshot(args.snapshot)
+            export_history_json(history, output)
+        except (OSError, ValueError) as e:
+            print(theme_manager.style("error_message", f"No se pudo exportar {args.snapshot}: {e}"))
+            return EXIT_ERROR
+        print(theme_manager.style("info_message", f"{len(history)} mensajes exportados a {output}"))
+    return EXIT_OK
+
+
+def handle_slash_command(user_input: str, session: ChatSessionState) -> bool:
+    """
+    Ejecuta un comando '/...' del chat. Devuelve False si no es un comando conocido,
+    en cuyo caso el texto se envía al modelo como un mensaje normal.
+    """
+    command, *arguments = user_input.split()
+    command = command.lower()
+    if command == "/profile":
+        session.profiler.toggle_sampling(session.theme_manager)
+        return True
+    if command in ("/branch", "/checkout", "/rewind"):
+        _handle_branch_command(command, arguments, session)
+        return True
+    if command == "/attach":
+        _handle_attach_command(user_input, session)
+        return True
+    if command == "/queue":
+        _handle_queue_command(user_input, session)
+        return True
+    if command == "/multiline":
+        _toggle_multiline(session)
+        return True
+    return False
+
+
+def _toggle_multiline(session: ChatSessionState):
+    theme_manager = session.theme_manager
+    editor = session.prompt_editor
+    if editor is None:
+        print(theme_manager.style("warning_message", "El modo multilínea solo está disponible en el chat interactivo."))
+        return
+    editor.multiline = not editor.multiline
+    if editor.multiline:
+        print(theme_manager.style("info_message",
+              "Modo multilínea activado: Enter añade una línea; Alt+Enter o Ctrl+D envía el mensaje."))
+    else:
+        print(theme_manager.style("info_message",
+              "Modo multilínea desactivado: Enter envía el mensaje; Alt+Enter añade una línea."))
+
+
+def _queue_prompt(session: ChatSessionState, user_input: str, attachments: List) -> dict:
+    user_content = genai.protos.Content(role="user", parts=[genai.protos.Part(text=user_input)] + list(attachments))
+    item = session.prompt_queue.enqueue(session.model.model_name, list(session.chat.history) + [user_content],
+                                        session.history_filename, session.profile_name,
+                                        session.queued_model_settings())
+    if session.queue_drainer is not None:
+        session.queue_drainer.wake()
+    return item
+
+
+def _handle_queue_command(user_input: str, session: ChatSessionState):
+    """/queue PROMPT deja el prompt en la cola en lugar de esperar la respuesta; /queue solo, lista la cola."""
+    theme_manager = session.theme_manager
+    if session.prompt_queue is None:
+        print(theme_manager.style("warning_message", "La cola no está disponible al reproducir un cassette."))
+        return
+    prompt = user_input[len("/queue"):].strip()
+    if prompt:
+        attachments, session.pending_attachments = session.pending_attachments, []
+        item = _queue_prompt(session, prompt, attachments)
+        print(theme_manager.style("info_message", f"Prompt en cola ({item['id']}). La respuesta aparecerá aquí "
+                                  "cuando llegue, o en su historial si cierras la sesión antes."))
+        return
+    items = session.prompt_queue.pending()
+    if not items:
+        print(theme_manager.style("info_message", "La cola está vacía."))
+    for item in items:
+        print(theme_manager.style("list_item_bullet", f"  {item['id']} ") +
+              f"[{item['state']}, {item['attempts']} intentos] {item['prompt'][:60]}")
+
+
+def _handle_attach_command(user_input: str, session: ChatSessionState):
+    """/attach RUTA... prepara adjuntos para el próximo mensaje; sin rutas los lista, /attach clear los descarta."""
+    theme_manager = session.theme_manager
+    try:
+        paths = shlex.split(user_input)[1:]  # Admite rutas con espacios entre comillas
+    except ValueError as e:
+        print(theme_manager.style("error_message", f"Rutas inválidas: {e}"))
+        return
+    if paths == ["clear"]:
+        session.pending_attachments = []
+        print(theme_manager.style("info_message", "Adjuntos descartados."))
+        return
+    if paths:
+        if isinstance(session.cassette, CassettePlayer):
+            print(theme_manager.style("warning_message", "Los adjuntos no se reproducen desde un cassette; omitidos."))
+            return
+        session.pending_attachments.extend(prepare_attachments(paths, session.attachment_settings, theme_manager))
+    if not session.pending_attachments:
+        print(theme_manager.style("info_message", "No hay adjuntos pendientes. Uso: /attach RUTA [RUTA...]"))
+        return
+    for part in session.pending_attachments:
+        if "file_data" in part:
+            description = f"{part.file_data.mime_type}, File API: {part.file_data.file_uri}"
+        else:
+            description = f"{part.inline_data.mime_type}, {len(part.inline_data.data) / 1024:.0f} KB"
+        print(theme_manager.style("list_item_bullet", "  - ") + description)
+    print(theme_manager.style("info_message",
+          f"{len(session.pending_attachments)} adjunto(s) se enviarán con tu próximo mensaje."))
+
 
 # --- ¡Aquí empieza la fiesta! La función principal del chatbot ---
 def display_welcome_message(theme_manager: ThemeManager):
@@ -760,7 +5439,98 @@ Ahora con esteroides!  _________________________________________________________
     time.sleep(1.5)
 
 
-def run_chatbot():
+def run_chat_loop(session: ChatSessionState, read_input=input):
+    """
+    Bucle de conversación. `read_input(prompt)` devuelve el mensaje completo (PromptEditor en
+    una terminal) y permite reproducir las entradas de un cassette (--replay).
+    """
+    theme_manager = session.theme_manager
+    while True:
+        if session.prompt_queue is not None:
+            _deliver_queued_answers(session)
+        try:
+            user_input = read_input(theme_manager.style("prompt_user", "Tú: ")).strip()
+        except (KeyboardInterrupt, EOFError):
+            print(theme_manager.style("warning_message", "\nSaliendo..."))
+            break
+        if user_input.lower() in ["salir", "exit", "quit"]:
+            break
+        if not user_input:
+            continue
+        if user_input.startswith("/") and handle_slash_command(user_input, session):
+            continue
+
+        try:
+            attachments, session.pending_attachments = session.pending_attachments, []
+            run_chat_turn(session, user_input, attachments)
+            session.tree.sync(session.chat.history)
+            session.profiler.on_turn_end()
+        except Exception as e:
+            if session.prompt_queue is not None and is_connectivity_error(e):
+                # Sin conexión: el prompt no se pierde, se envía cuando vuelva la red
+                item = _queue_prompt(session, user_input, attachments)
+                print(theme_manager.style("warning_message",
+                      f"\nSin conexión con la API ({e}). Prompt guardado en la cola ({item['id']}); "
+                      "se enviará automáticamente."))
+                continue
+            print(theme_manager.style("error_message", f"\nError en comunicación con API: {e}"))
+            continue
+
+
+def run_replay(args: argparse.Namespace, profiler: SessionProfiler) -> int:
+    """
+    Reproduce un cassette por el mismo bucle de chat, sin red ni API Key: mismas entradas,
+    mismos chunks y, con --replay-speed 1, los mismos tiempos entre chunks.
+    """
+    theme_manager = ThemeManager(PREDEFINED_THEMES, "Legacy")
+    try:
+        player = CassettePlayer(args.replay, args.replay_speed)
+    except (OSError, ValueError, KeyError) as e:
+        print(theme_manager.style("error_message", f"No se pudo leer el cassette {args.replay}: {e}"))
+        return EXIT_USAGE
+    chat = genai.GenerativeModel(player.model_name).start_chat(history=[])
+    session = ChatSessionState(theme_manager, profiler, player.model_name, ReplayModel(player, player.model_name),
+                               chat, get_chat_history_filename(player.model_name))
+    session.cassette = player
+    session.record_usage = False  # Una reproducción no consume tokens
+    started = time.perf_counter()
+    run_chat_loop(session, player.read_input)
+    print(theme_manager.style("info_message",
+          f"\nReproducción terminada en {time.perf_counter() - started:.2f} s "
+          f"(velocidad x{args.replay_speed:g})."))
+    return EXIT_OK
+
+
+def run_chatbot(argv: Optional[List[str]] = None):
+    args = _parse_cli_args(argv)
+    set_data_dir(args.data_dir)
+    profiler = SessionProfiler.from_args(args)
+    with profiler.session():
+        if args.command == "history":
+            exit_code = run_history_command(args)
+        elif args.command == "key":
+            exit_code = run_key_command(args)
+        elif args.command == "index":
+            exit_code = run_index_command(args)
+        elif args.command == "usage":
+            exit_code = run_usage_command(args)
+        elif args.command == "queue":
+            exit_code = run_queue_command(args)
+        elif args.command == "route":
+            exit_code = run_route_command(args)
+        elif args.command == "migrate":
+            exit_code = run_migrate_command(args)
+        elif args.replay:
+            exit_code = run_replay(args, profiler)
+        elif args.prompt is not None or args.json_stream:
+            exit_code = run_one_shot(args)
+        else:
+            _run_interactive_chat(args, profiler)
+            exit_code = EXIT_OK
+    sys.exit(exit_code)
+
+
+def _run_interactive_chat(args: argparse.Namespace, profiler: SessionProfiler):
     theme_manager = ThemeManager(PREDEFINED_THEMES, "Legacy")
     profiles_data = load_profiles(theme_manager)
     active_profile = None
@@ -777,6 +5547,7 @@ def run_chatbot():
             theme_manager.set_active_theme(profile_color_theme)
 
     display_welcome_message(theme_manager)
+    show_legacy_data_notice(theme_manager)
 
     if active_profile:
         print(theme_manager.style("info_message",
@@ -798,9 +5569,12 @@ def run_chatbot():
 
     API_KEY = None
     key_loaded_from_file = False
-    if os.path.exists(ENCRYPTED_API_KEY_FILE):
+    key_pool, key_name = None, None
+    encrypted_key_file = data_path(ENCRYPTED_API_KEY_FILE)
+    unencrypted_key_file = data_path(UNENCRYPTED_API_KEY_FILE)
+    if os.path.exists(encrypted_key_file):
         print(theme_manager.style("info_message",
-              f"Intentando cargar API Key desde archivo encriptado ({ENCRYPTED_API_KEY_FILE})."))
+              f"Intentando cargar API Key desde archivo encriptado ({encrypted_key_file})."))
         password_attempts = 0
         max_password_attempts = 3
         while password_attempts < max_password_attempts:
@@ -809,11 +5583,15 @@ def run_chatbot():
             if not password:
                 print(theme_manager.style("warning_message", "Omitiendo carga desde archivo encriptado."))
                 break
-            temp_api_key = load_decrypted_api_key(password, theme_manager)
-            if temp_api_key:
-                API_KEY = temp_api_key
+            temp_api_keys = load_decrypted_api_keys(password, theme_manager)
+            if temp_api_keys:
+                # Con varias claves, la sesión interactiva usa una sola de principio a fin
+                key_pool = KeyPool(temp_api_keys)
+                key_name, API_KEY = key_pool.acquire()
                 key_loaded_from_file = True
                 print(theme_manager.style("info_message", "API Key cargada y desencriptada exitosamente."))
+                if len(temp_api_keys) > 1:
+                    print(theme_manager.style("info_message", f"Usando la clave '{key_name}' durante esta sesión."))
                 break
             else:
                 password_attempts += 1
@@ -822,28 +5600,28 @@ def run_chatbot():
                 else:
                     print(theme_manager.style("error_message", "Demasiados intentos fallidos."))
                     delete_choice = input(theme_manager.style("prompt_user",
-                                          f"¿Deseas eliminar el archivo {ENCRYPTED_API_KEY_FILE}? (s/N): ")).strip().lower()
+                                          f"¿Deseas eliminar el archivo {encrypted_key_file}? (s/N): ")).strip().lower()
                     if delete_choice == 's':
                         try:
-                            os.remove(ENCRYPTED_API_KEY_FILE)
-                            print(theme_manager.style("info_message", f"Archivo {ENCRYPTED_API_KEY_FILE} eliminado."))
+                            os.remove(encrypted_key_file)
+                            print(theme_manager.style("info_message", f"Archivo {encrypted_key_file} eliminado."))
                         except Exception as e:
                             print(theme_manager.style("error_message", f"No se pudo eliminar el archivo: {e}"))
                     break
 
-    if API_KEY is None and os.path.exists(UNENCRYPTED_API_KEY_FILE):
+    if API_KEY is None and os.path.exists(unencrypted_key_file):
         temp_api_key = load_unencrypted_api_key(theme_manager)
         if temp_api_key:
             API_KEY = temp_api_key
             key_loaded_from_file = True
-        elif os.path.exists(UNENCRYPTED_API_KEY_FILE):
+        elif os.path.exists(unencrypted_key_file):
             delete_choice = input(theme_manager.style("prompt_user",
-                                  f"El archivo {UNENCRYPTED_API_KEY_FILE} no pudo ser leído o está vacío. "
+                                  f"El archivo {unencrypted_key_file} no pudo ser leído o está vacío. "
                                   "¿Deseas eliminarlo? (s/N): ")).strip().lower()
             if delete_choice == 's':
                 try:
-                    os.remove(UNENCRYPTED_API_KEY_FILE)
-                    print(theme_manager.style("info_message", f"Archivo {UNENCRYPTED_API_KEY_FILE} eliminado."))
+                    os.remove(unencrypted_key_file)
+                    print(theme_manager.style("info_message", f"Archivo {unencrypted_key_file} eliminado."))
                 except Exception as e:
                     print(theme_manager.style("error_message", f"No se pudo eliminar el archivo: {e}"))
 
@@ -892,7 +5670,10 @@ def run_chatbot():
         sys.exit(1)
 
     try:
-        genai.configure(api_key=API_KEY)
+        if key_pool is not None:
+            key_pool.configure(key_name)
+        else:
+            configure_genai(API_KEY)
         print(theme_manager.style("info_message", "\nAPI de Gemini configurada correctamente."))
         time.sleep(0.5)
     except Exception as e:
@@ -994,137 +5775,130 @@ def run_chatbot():
         loaded_history = load_chat_history(history_filename, theme_manager)
         if loaded_history:
             initial_history = loaded_history
+        profiler.checkpoint("historial cargado")
     else:
         print(theme_manager.style("warning_message", "Empezando nueva sesión."))
 
+    safety_settings_to_use = profile_safety_settings or _default_safety_settings()
+    generation_config = profile_generation_config(active_profile)
+    profile_tools = build_tool_declarations((active_profile or {}).get("tools"), theme_manager)
+    if profile_tools:
+        tool_names = ", ".join(d["name"] for d in profile_tools[0]["function_declarations"])
+        print(theme_manager.style("info_message", f"Herramientas locales habilitadas: {tool_names}"))
+
+    # Caché de contexto: el system prompt y los documentos fijados se suben una sola vez
+    cached_context_model = None
+    context_instruction = None
+    context_cache_settings = (active_profile or {}).get("context_cache") or {}
+    if context_cache_settings.get("enabled"):
+        pinned_documents = _read_pinned_documents(context_cache_settings.get("documents", []), theme_manager)
+        cached_content = get_or_create_cached_content(
+            MODEL_NAME, profile_name, (profile_system_prompt or "").strip(), pinned_documents,
+            int(context_cache_settings.get("ttl_seconds", DEFAULT_CONTEXT_CACHE_TTL_SECONDS)),
+            theme_manager, profile_tools)
+        if cached_content is not None:
+            try:
+                cached_context_model = genai.GenerativeModel.from_cached_content(
+                    cached_content, generation_config=generation_config, safety_settings=safety_settings_to_use)
+                # Los demás modelos (respaldo, enrutado, duplicado) no ven el caché: lo reciben en línea
+                context_instruction = "\n\n".join(
+                    [(profile_system_prompt or "").strip()] + pinned_documents).strip() or None
+            except Exception as e:
+                print(theme_manager.style("warning_message",
+                      f"Advertencia: No se pudo usar el caché de contexto ({e}). Usando system prompt en línea."))
+
     if profile_system_prompt and isinstance(profile_system_prompt, str) and profile_system_prompt.strip():
         max_len = 70
         ellipsis = "..." if len(profile_system_prompt) > max_len else ""
         print(theme_manager.style("info_message",
               f"Usando system prompt del perfil '{profile_name}': '{profile_system_prompt[:max_len]}{ellipsis}'"))
         system_prompt_content = {'role': 'user', 'parts': [{'text': profile_system_prompt.strip()}]}
-        if not (initial_history and initial_history[0]['role'] == 'user' and
-                initial_history[0]['parts'][0]['text'] == profile_system_prompt.strip()):
+        system_prompt_in_history = (bool(initial_history) and
+                                    _first_user_text(initial_history[0]) == profile_system_prompt.strip())
+        if cached_context_model is not None:
+            # Ya va en el caché; no reenviarlo como primer turno
+            if system_prompt_in_history:
+                initial_history.pop(0)
+        elif not system_prompt_in_history:
             initial_history.insert(0, system_prompt_content)
 
     try:
-        safety_settings_to_use = profile_safety_settings or {
-            HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
-            HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_ONLY_HIGH,
-            HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
-            HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_ONLY_HIGH,
-        }
-        model = genai.GenerativeModel(MODEL_NAME, safety_settings=safety_settings_to_use)
+        if cached_context_model is not None:
+            model = cached_context_model
+        else:
+            model = genai.GenerativeModel(MODEL_NAME, safety_settings=safety_settings_to_use, tools=profile_tools,
+                                          generation_config=generation_config)
         chat = model.start_chat(history=initial_history)
-
-        while True:
-            print(theme_manager.style("prompt_user", "Tú: "), end="")
+        session = ChatSessionState(theme_manager, profiler, MODEL_NAME, model, chat, history_filename,
+                                   safety_settings_to_use, (active_profile or {}).get("turn_policy"))
+        session.tools = profile_tools
+        session.generation_config = generation_config
+        session.context_instruction = context_instruction
+        session.key_pool, session.key_name = key_pool, key_name
+        try:
+            session.router = ModelRouter.for_profile(active_profile)
+        except ValueError as e:
+            print(theme_manager.style("warning_message", f"Advertencia: Router desactivado: {e}"))
+        if session.router is not None:
+            print(theme_manager.style("info_message",
+                  f"Enrutado de modelos activo: {', '.join(session.router.models)}."))
+        session.tool_settings.update((active_profile or {}).get("tool_settings") or {})
+        session.attachment_settings.update((active_profile or {}).get("attachments") or {})
+        rag_settings = (active_profile or {}).get("rag") or {}
+        if rag_settings:
+            rag_index_dir = rag_settings.get("index") or data_path("index", RAG_INDEX_DIR)
             try:
-                user_input = input().strip()
-            except KeyboardInterrupt:
-                print(theme_manager.style("warning_message", "\nSaliendo..."))
-                break
-            if user_input.lower() in ["salir", "exit", "quit"]:
-                break
-            if not user_input:
-                continue
-
-            model_name_for_prompt = MODEL_NAME.split('/')[-1]
-            styled_model_name_prompt = theme_manager.style("prompt_model_name", f"{model_name_for_prompt}:", apply_reset=False)
+                session.retrieval_index = RetrievalIndex(rag_index_dir)
+                session.retrieval_settings = rag_settings
+                print(theme_manager.style("info_message",
+                      f"Índice de documentos cargado ({len(session.retrieval_index.chunks)} fragmentos)."))
+            except FileNotFoundError:
+                print(theme_manager.style("warning_message",
+                      f"Advertencia: No existe el índice '{rag_index_dir}'. Créalo con: pygemai index build <dir>"))
+        session.profile_name = profile_name
+        session.token_budget = (active_profile or {}).get("token_budget") or {}
+        session.semantic_cache = SemanticCache.for_profile(active_profile, MODEL_NAME)
+        if session.semantic_cache is not None:
+            print(theme_manager.style("info_message",
+                  f"Caché semántico activo ({len(session.semantic_cache.entries)} respuestas guardadas)."))
 
-            stop_animation_event.clear()
-            animation_thread = threading.Thread(
-                target=animate_thinking,
-                args=(theme_manager, styled_model_name_prompt)
-            )
-            animation_thread.daemon = True # Permite salir aunque el hilo esté activo
-            
-            full_response_text_parts = []
-            first_chunk_received = False
-            error_during_stream = False
+        session.prompt_queue = prompt_queue
 
-            try:
-                animation_thread.start()
-                response = chat.send_message(user_input, stream=True)
-
-                for chunk in response:
-                    if not first_chunk_received: # Al recibir el primer dato (texto o feedback)
-                        stop_animation_event.set()
-                        if animation_thread.is_alive():
-                            animation_thread.join(timeout=0.5) # Esperar a que limpie
-                        # Imprimir el prompt del modelo ahora que la animación terminó
-                        sys.stdout.write(f"\r{styled_model_name_prompt}{Colors.RESET} ") # \r para asegurar inicio de línea
-                        sys.stdout.flush()
-                        first_chunk_received = True
-
-                    if hasattr(chunk, "text") and chunk.text: # Asegurarse que hay texto
-                        sys.stdout.write(chunk.text) # Salida progresiva del texto
-                        sys.stdout.flush()
-                        full_response_text_parts.append(chunk.text)
-
-                    if chunk.prompt_feedback and chunk.prompt_feedback.block_reason:
-                        if not stop_animation_event.is_set(): # Asegurar que la animación se detenga
-                            stop_animation_event.set()
-                            if animation_thread.is_alive():
-                                animation_thread.join(timeout=0.5)
-                        if not first_chunk_received: # Si el error es lo primero que llega
-                             sys.stdout.write(f"\r{styled_model_name_prompt}{Colors.RESET} ")
-                             sys.stdout.flush()
-                        
-                        sys.stdout.write("\n") # Nueva línea para el mensaje de error
-                        # print() ya añade newline, \n en f-string es para asegurar que el mensaje de error esté en su propia línea
-                        print(theme_manager.style("error_message", f"Prompt bloqueado: {chunk.prompt_feedback.block_reason_message}"))
-                        full_response_text_parts.clear()
-                        error_during_stream = True
-                        break
-                
-                # Después del bucle de chunks
-                if not stop_animation_event.is_set(): # Si el bucle terminó muy rápido o respuesta vacía
-                    stop_animation_event.set()
-                    if animation_thread.is_alive():
-                        animation_thread.join(timeout=0.5)
-                
-                if not first_chunk_received and not error_during_stream:
-                    # Respuesta vacía, sin errores. La animación se detuvo (o se detendrá).
-                    # Imprimir el prompt del modelo.
-                    sys.stdout.write(f"\r{styled_model_name_prompt}{Colors.RESET} ")
-                    sys.stdout.flush()
-
-                # Nueva línea después de la salida progresiva (o el prompt si no hubo salida)
-                # Solo si no hubo un error que ya manejó su propia salida de línea.
-                if not error_during_stream:
-                    sys.stdout.write("\n")
-                    sys.stdout.flush()
-
-                # Ahora, si no hubo error y tenemos texto, lo formateamos y lo imprimimos.
-                if not error_during_stream and full_response_text_parts:
-                    final_text = "".join(full_response_text_parts)
-                    if final_text.strip(): # Solo si hay contenido real
-                        formatted_text = format_gemini_output(final_text, theme_manager)
-                        sys.stdout.write(formatted_text) # Imprime el texto formateado
-                        sys.stdout.write("\n") # Añade la nueva línea final para el turno de respuesta
-                        sys.stdout.flush()
-                
-            except Exception as e:
-                if not stop_animation_event.is_set():
-                    stop_animation_event.set()
-                if animation_thread.is_alive():
-                    animation_thread.join(timeout=0.5)
-                
-                if not first_chunk_received: # Si el error ocurrió antes de imprimir el prompt del modelo
-                    sys.stdout.write(f"\r{styled_model_name_prompt}{Colors.RESET} ")
-                    sys.stdout.flush()
-                print(theme_manager.style("error_message", f"\nError en comunicación con API: {e}"))
-                full_response_text_parts.clear() # No guardar historial si hubo este error
-                continue
+        def deliver_to_session(result: dict) -> bool:
+            # Las respuestas de esta conversación se muestran en el chat; las demás van a su historial
+            if result["history_file"] != session.history_filename:
+                return False
+            session.queued_answers.put(result)
+            return True
+
+        session.queue_drainer = QueueDrainer(prompt_queue, deliver=deliver_to_session).start()
+
+        session.prompt_editor = PromptEditor(PromptHistory(data_path("history", PROMPT_HISTORY_FILE),
+                                                           data_path("history", PROMPT_HISTORY_INDEX_FILE)),
+                                             theme_manager)
+        read_input = session.prompt_editor
+        if args.record:
+            session.cassette = CassetteRecorder(args.record, MODEL_NAME)
+            session.model = session._models[MODEL_NAME] = session.cassette.wrap(model)
+            read_input = session.cassette.record_input_reader(session.prompt_editor)
+            print(theme_manager.style("info_message", f"Grabando la sesión en {args.record}."))
+        run_chat_loop(session, read_input)
     except Exception as e:
         print(theme_manager.style("error_message", f"Error inesperado en chat: {e}. Chat terminado."))
 
+    if 'session' in locals() and isinstance(session.cassette, CassetteRecorder):
+        session.cassette.close()
+    if 'session' in locals() and session.queue_drainer is not None:
+        session.queue_drainer.stop()
+
     if 'chat' in locals() and chat.history:
+        snapshot_filename = get_history_snapshot_filename(history_filename)
+        history_format = args.history_format or ("snapshot" if os.path.exists(snapshot_filename) else "json")
+        save_target = snapshot_filename if history_format == "snapshot" else history_filename
         save_hist_choice = input(theme_manager.style("prompt_user",
-                                 f"¿Guardar historial en '{history_filename}'? (S/n): ")).strip().lower()
+                                 f"¿Guardar historial en '{save_target}'? (S/n): ")).strip().lower()
         if save_hist_choice == "" or save_hist_choice == "s":
-            save_chat_history(chat, history_filename, theme_manager)
+            save_chat_history(chat, history_filename, theme_manager, history_format)
 
     print(theme_manager.style("section_header", "\n--- Script finalizado. ¡Hasta la próxima! ---"))
 
@@ -0,0 +1,17 @@
+import pytest
+
+from pygemai_cli import main as pygemai
+
+
+@pytest.fixture(autouse=True)
+def data_dir(tmp_path):
+    """Cada prueba usa su propio directorio de datos, nunca el del usuario."""
+    directory = tmp_path / "data"
+    pygemai.set_data_dir(str(directory))
+    yield directory
+    pygemai.set_data_dir(None)
+
+
+@pytest.fixture
+def theme_manager():
+    return pygemai.ThemeManager({"Plain": {"colors": {}}}, "Plain")
@@ -0,0 +1,68 @@
+import datetime
+from types import SimpleNamespace
+
+import pytest
+
+from pygemai_cli import main as pygemai
+
+
+class FakeFileAPI:
+    """upload_file/get_file de genai sin red; `states` son los estados que devuelve cada consulta."""
+
+    def __init__(self, monkeypatch, states=("ACTIVE",)):
+        self.uploads = []
+        self.states = list(states)
+        monkeypatch.setattr(pygemai.genai, "configure", lambda api_key: None)
+        monkeypatch.setattr(pygemai.genai, "upload_file", self.upload_file)
+        monkeypatch.setattr(pygemai.genai, "get_file", lambda name: self.file(name))
+        monkeypatch.setattr(pygemai.time, "sleep", lambda seconds: None)
+
+    def file(self, name):
+        state = self.states.pop(0) if len(self.states) > 1 else self.states[0]
+        expires = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=48)
+        return SimpleNamespace(name=name, uri=f"https://files/{name}", mime_type="application/pdf",
+                               state=SimpleNamespace(name=state), expiration_time=expires)
+
+    def upload_file(self, source, mime_type, display_name):
+        self.uploads.append(pygemai.current_key_id())
+        return self.file(f"files/{len(self.uploads)}")
+
+
+def attach(cache):
+    return pygemai._upload_attachment(b"%PDF-1.4 contenido", "digest", "application/pdf", "doc.pdf", cache)
+
+
+def test_uploads_are_reused_only_with_the_same_key(monkeypatch, tmp_path):
+    api = FakeFileAPI(monkeypatch)
+    cache = pygemai.UploadCache(str(tmp_path / "uploads.json"))
+
+    pygemai.configure_genai("AIza-a")
+    first = attach(cache)
+    assert attach(cache).file_data.file_uri == first.file_data.file_uri
+    assert api.uploads == [pygemai.api_key_id("AIza-a")]
+
+    pygemai.configure_genai("AIza-b")  # Otro proyecto no puede leer el archivo de la clave a
+    assert attach(cache).file_data.file_uri != first.file_data.file_uri
+    assert api.uploads == [pygemai.api_key_id("AIza-a"), pygemai.api_key_id("AIza-b")]
+
+    reopened = pygemai.UploadCache(str(tmp_path / "uploads.json"))
+    assert reopened.get(pygemai.api_key_id("AIza-a"), "digest")["uri"] == first.file_data.file_uri
+
+
+def test_processing_timeout_is_an_error(monkeypatch, tmp_path):
+    FakeFileAPI(monkeypatch, states=("PROCESSING",))
+    monkeypatch.setattr(pygemai, "UPLOAD_PROCESSING_TIMEOUT_SECONDS", 3)
+    cache = pygemai.UploadCache(str(tmp_path / "uploads.json"))
+    pygemai.configure_genai("AIza-a")
+
+    with pytest.raises(RuntimeError, match="no terminó de procesar doc.pdf"):
+        attach(cache)
+    assert cache.get(pygemai.api_key_id("AIza-a"), "digest") is None
+
+
+def test_failed_processing_is_an_error(monkeypatch, tmp_path):
+    FakeFileAPI(monkeypatch, states=("PROCESSING", "FAILED"))
+    pygemai.configure_genai("AIza-a")
+
+    with pytest.raises(RuntimeError, match="no pudo procesar doc.pdf"):
+        attach(pygemai.UploadCache(str(tmp_path / "uploads.json")))
@@ -0,0 +1,82 @@
+from pygemai_cli import main as pygemai
+
+
+def text(role, value):
+    return pygemai.genai.protos.Content(role=role, parts=[pygemai.genai.protos.Part(text=value)])
+
+
+def turns(*pairs):
+    history = []
+    for question, answer in pairs:
+        history += [text("user", question), text("model", answer)]
+    return history
+
+
+def texts(history):
+    return [content.parts[0].text for content in history]
+
+
+def test_checkout_switches_branches_in_place_sharing_the_prefix():
+    history = turns(("hola", "¡hola!"), ("a", "A"))
+    tree = pygemai.ConversationTree(history)
+    tree.create_branch("idea")
+    assert tree.rewind(2, history) is None  # La punta sigue en 'main'
+    history += turns(("b", "B"), ("c", "C"))
+    tree.sync(history)
+    same_list = history
+
+    tree.checkout("main", history)
+    assert history is same_list
+    assert texts(history) == ["hola", "¡hola!", "a", "A"]
+
+    tree.checkout("idea", history)
+    assert texts(history) == ["hola", "¡hola!", "b", "B", "c", "C"]
+    # El prefijo común es el mismo nodo en las dos ramas, no una copia
+    assert tree._ancestor(tree.branches["idea"], 2) == tree._ancestor(tree.branches["main"], 2)
+
+
+def test_rewind_keeps_discarded_turns_as_a_new_branch():
+    history = turns(("1", "uno"), ("2", "dos"), ("3", "tres"))
+    tree = pygemai.ConversationTree(history)
+
+    saved_as = tree.rewind(pygemai._messages_in_last_turns(history, 2), history)
+
+    assert texts(history) == ["1", "uno"]
+    assert saved_as == "main~1"
+    tree.checkout(saved_as, history)
+    assert texts(history) == ["1", "uno", "2", "dos", "3", "tres"]
+
+
+def test_rewind_does_not_duplicate_a_tip_kept_by_another_branch():
+    history = turns(("1", "uno"), ("2", "dos"))
+    tree = pygemai.ConversationTree(history)
+    tree.create_branch("copia")
+    tree.checkout("main", history)
+
+    assert tree.rewind(2, history) is None
+    assert texts(history) == ["1", "uno"]
+    assert set(tree.branches) == {"main", "copia"}
+
+
+def test_sync_follows_messages_removed_by_the_session():
+    history = turns(("1", "uno"), ("2", "dos"))
+    tree = pygemai.ConversationTree(history)
+    del history[2:]
+    history += turns(("2b", "dos b"))
+
+    tree.sync(history)
+
+    assert tree.depth(tree.branches["main"]) == 4
+    tree.checkout("main", history)
+    assert texts(history) == ["1", "uno", "2b", "dos b"]
+
+
+def test_messages_in_last_turns_counts_tool_rounds_as_part_of_the_turn():
+    call = pygemai.genai.protos.Content(role="model", parts=[pygemai.genai.protos.Part(
+        function_call=pygemai.genai.protos.FunctionCall(name="grep", args={"pattern": "x"}))])
+    reply = pygemai.genai.protos.Content(role="user", parts=[pygemai.genai.protos.Part(
+        function_response=pygemai.genai.protos.FunctionResponse(name="grep", response={"result": {}}))])
+    history = turns(("1", "uno")) + [text("user", "2"), call, reply, text("model", "dos")]
+
+    assert pygemai._messages_in_last_turns(history, 1) == 4
+    assert pygemai._messages_in_last_turns(history, 5) == len(history)
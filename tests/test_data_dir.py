@@ -0,0 +1,59 @@
+import json
+import os
+
+import pytest
+
+from pygemai_cli import main as pygemai
+
+
+def write_legacy_files(directory):
+    directory.mkdir(exist_ok=True)
+    (directory / ".gemini_chatbot_prefs.json").write_text(json.dumps({"last_model": "gemini-pro"}))
+    (directory / "chat_history_gemini-pro.json").write_text("[]")
+
+
+def test_plain_runs_never_touch_the_working_directory(tmp_path, monkeypatch, capsys):
+    old_install = tmp_path / "proyecto"
+    write_legacy_files(old_install)
+    monkeypatch.chdir(old_install)
+
+    with pytest.raises(SystemExit) as exit_info:
+        pygemai.run_chatbot(["--data-dir", pygemai.get_data_dir(), "usage"])
+    assert exit_info.value.code == pygemai.EXIT_OK
+    assert sorted(os.listdir(old_install)) == [".gemini_chatbot_prefs.json", "chat_history_gemini-pro.json"]
+
+
+def test_migrate_command_moves_files_from_the_given_directory(tmp_path, capsys):
+    old_install = tmp_path / "proyecto"
+    write_legacy_files(old_install)
+
+    args = pygemai._parse_cli_args(["migrate", str(old_install)])
+    assert pygemai.run_migrate_command(args) == pygemai.EXIT_OK
+
+    assert os.listdir(old_install) == []
+    with open(pygemai.data_path(pygemai.PREFERENCES_FILE)) as f:
+        assert json.load(f) == {"last_model": "gemini-pro"}
+    assert os.path.exists(pygemai.data_path("history", "chat_history_gemini-pro.json"))
+    assert "Se movieron 2 archivo(s)" in capsys.readouterr().out
+
+
+def test_migrate_never_overwrites_existing_targets(tmp_path):
+    old_install = tmp_path / "proyecto"
+    write_legacy_files(old_install)
+    with open(pygemai.data_path(pygemai.PREFERENCES_FILE), "w") as f:
+        json.dump({"last_model": "gemini-flash"}, f)
+
+    messages = pygemai.migrate_legacy_data(str(old_install))
+
+    assert any("No se movió .gemini_chatbot_prefs.json" in m for m in messages)
+    assert (old_install / ".gemini_chatbot_prefs.json").exists()
+    with open(pygemai.data_path(pygemai.PREFERENCES_FILE)) as f:
+        assert json.load(f) == {"last_model": "gemini-flash"}
+
+
+def test_legacy_notice_is_shown_once(theme_manager, capsys):
+    pygemai.show_legacy_data_notice(theme_manager)
+    assert "pygemai migrate" in capsys.readouterr().out
+
+    pygemai.show_legacy_data_notice(theme_manager)
+    assert capsys.readouterr().out == ""
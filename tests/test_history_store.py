@@ -0,0 +1,129 @@
+import json
+import os
+import time
+
+import pytest
+
+from pygemai_cli import main as pygemai
+
+
+def contents(*texts):
+    return pygemai.content_types.to_contents(
+        [{"role": "user" if n % 2 == 0 else "model", "parts": [{"text": text}]} for n, text in enumerate(texts)])
+
+
+def test_history_json_round_trips_through_blobs():
+    filename = pygemai.get_chat_history_filename("gemini-pro")
+    pygemai._write_history_json(contents("hola", "buenas"), filename)
+
+    with open(filename) as f:
+        assert json.load(f)["format"] == pygemai.HISTORY_STORE_FORMAT
+    assert pygemai._read_history_json(filename) == [{"role": "user", "parts": [{"text": "hola"}]},
+                                                    {"role": "model", "parts": [{"text": "buenas"}]}]
+    # Sin temporales a la vista
+    assert sorted(os.listdir(os.path.dirname(filename))) == sorted([os.path.basename(filename),
+                                                                    pygemai.HISTORY_BLOBS_DIR])
+
+
+def test_interrupted_write_keeps_the_previous_history(monkeypatch):
+    filename = pygemai.get_chat_history_filename("gemini-pro")
+    pygemai._write_history_json(contents("hola", "buenas"), filename)
+
+    def interrupted(*args, **kwargs):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(pygemai.json, "dump", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        pygemai._write_history_json(contents("hola", "buenas", "otra", "respuesta"), filename)
+    monkeypatch.undo()
+
+    assert len(pygemai._read_history_json(filename)) == 2
+
+
+def test_blob_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(pygemai, "HISTORY_BLOB_CACHE_SIZE", 3)
+    monkeypatch.setattr(pygemai, "_history_blob_cache", {})
+    hashes = [pygemai.store_history_blob({"text": f"parte {n}"}) for n in range(3)]
+    pygemai.load_history_blob(hashes[0])  # La más antigua pasa a ser la más reciente
+
+    pygemai.store_history_blob({"text": "parte 3"})
+
+    assert hashes[1] not in pygemai._history_blob_cache
+    assert hashes[0] in pygemai._history_blob_cache
+    assert pygemai.load_history_blob(hashes[1]) == {"text": "parte 1"}  # Se vuelve a leer del disco
+
+
+def rich_history():
+    """Historial con todo lo que un JSON de texto perdería: llamadas a herramientas, bytes y un texto grande."""
+    protos = pygemai.genai.protos
+    return [
+        protos.Content(role="user", parts=[protos.Part(text="¿Qué hay en notas.txt? ñ 漢字 🙂"),
+                                           protos.Part(inline_data={"mime_type": "image/png",
+                                                                    "data": bytes(range(256))})]),
+        protos.Content(role="model", parts=[protos.Part(function_call={"name": "read_file",
+                                                                       "args": {"path": "notas.txt"}})]),
+        protos.Content(role="user", parts=[protos.Part(function_response={"name": "read_file",
+                                                                          "response": {"content": "x" * 20000}})]),
+        protos.Content(role="model", parts=[protos.Part(text="")]),
+    ]
+
+
+def test_snapshot_round_trip_is_exact():
+    filename = pygemai.get_history_snapshot_filename(pygemai.get_chat_history_filename("gemini-pro"))
+    history = rich_history()
+    pygemai.save_history_snapshot(history, filename)
+
+    loaded = pygemai.load_history_snapshot(filename)
+    assert [type(c).serialize(c) for c in loaded] == [type(c).serialize(c) for c in history]
+    pygemai.save_history_snapshot([], filename)
+    assert pygemai.load_history_snapshot(filename) == []
+
+
+def test_snapshot_rejects_truncated_or_foreign_files():
+    filename = pygemai.get_history_snapshot_filename(pygemai.get_chat_history_filename("gemini-pro"))
+    pygemai.save_history_snapshot(rich_history(), filename)
+    with open(filename, "rb") as f:
+        data = f.read()
+
+    with open(filename, "wb") as f:
+        f.write(data[:-10])
+    with pytest.raises(ValueError, match="truncada"):
+        pygemai.load_history_snapshot(filename)
+    with open(filename, "wb") as f:
+        f.write(b"[]")
+    with pytest.raises(ValueError, match="no es una instantánea"):
+        pygemai.load_history_snapshot(filename)
+
+
+def blob_files():
+    blobs_dir = pygemai.data_path("history", pygemai.HISTORY_BLOBS_DIR)
+    return {prefix + name[:-len(".json")] for prefix in os.listdir(blobs_dir)
+            for name in os.listdir(os.path.join(blobs_dir, prefix))}
+
+
+def test_gc_keeps_referenced_and_recent_blobs(theme_manager):
+    kept_file = pygemai.get_chat_history_filename("gemini-pro")
+    dropped_file = pygemai.get_chat_history_filename("gemini-flash")
+    pygemai._write_history_json(contents("compartida", "solo en pro"), kept_file)
+    pygemai._write_history_json(contents("compartida", "solo en flash"), dropped_file)
+    os.remove(dropped_file)  # La conversación de flash ya no existe
+    shared, only_pro = (pygemai.store_history_blob({"text": t}) for t in ("compartida", "solo en pro"))
+
+    # Dentro del plazo de gracia no se borra nada: podría haber un guardado en curso
+    assert pygemai.gc_history_blobs(theme_manager) == 0
+    later = time.time() + pygemai.HISTORY_GC_GRACE_SECONDS + 1
+    assert pygemai.gc_history_blobs(theme_manager, now=later) == 1
+    assert blob_files() == {shared, only_pro}
+    assert pygemai._read_history_json(kept_file) == [{"role": "user", "parts": [{"text": "compartida"}]},
+                                                     {"role": "model", "parts": [{"text": "solo en pro"}]}]
+
+
+def test_gc_deletes_nothing_if_a_history_is_unreadable(theme_manager, capsys):
+    pygemai._write_history_json(contents("hola"), pygemai.get_chat_history_filename("gemini-pro"))
+    with open(pygemai.get_chat_history_filename("gemini-flash"), "w") as f:
+        f.write('{"format": "pygemai-cas-v1", "messages": [')  # A medio escribir por una versión anterior
+
+    later = time.time() + pygemai.HISTORY_GC_GRACE_SECONDS + 1
+    pygemai.store_history_blob({"text": "huérfana"})
+    assert pygemai.gc_history_blobs(theme_manager, now=later) == 0
+    assert len(blob_files()) == 2
+    assert "cancelada" in capsys.readouterr().out
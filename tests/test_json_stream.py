@@ -0,0 +1,126 @@
+import json
+
+import pytest
+
+from pygemai_cli import main as pygemai
+
+
+def feed_in_pieces(text, size, records_key=None):
+    parser = pygemai.IncrementalJSONParser(records_key)
+    emitted = []
+    for start in range(0, len(text), size):
+        emitted.append(parser.feed(text[start:start + size]))
+    return parser, emitted
+
+
+@pytest.mark.parametrize("size", [1, 3, 1000])
+def test_array_elements_are_emitted_as_soon_as_they_close(size):
+    text = '[{"n": 1, "s": "a,]}"}, {"n": 2, "l": [1, 2]}, 3, "x"]'
+    parser, emitted = feed_in_pieces(text, size)
+
+    assert [record for batch in emitted for record in batch] == [
+        {"n": 1, "s": "a,]}"}, {"n": 2, "l": [1, 2]}, 3, "x"]
+    assert parser.close() == []
+    assert parser.records == 4
+
+
+def test_first_record_is_available_before_the_stream_ends():
+    parser = pygemai.IncrementalJSONParser()
+
+    assert parser.feed('[{"id": 1},') == [{"id": 1}]
+    assert parser.feed(' {"id": 2') == []
+    assert parser.feed("}]") == [{"id": 2}]
+
+
+@pytest.mark.parametrize("size", [1, 4, 1000])
+def test_records_come_from_the_array_under_records_key(size):
+    parser, emitted = feed_in_pieces('{"items": [{"a": 1}, {"b": [2]}]}', size, "items")
+
+    assert [record for batch in emitted for record in batch] == [{"a": 1}, {"b": [2]}]
+    assert parser.close() == []
+
+
+@pytest.mark.parametrize("text", [
+    '{"tags": ["a", "b"], "items": [{"x": 1}]}',
+    '{"count": 3, "items": [{"x": 1}]}',
+    '{"a": [1], "b": [2]}',
+])
+def test_object_without_records_key_is_one_record_and_nothing_is_dropped(text):
+    parser, emitted = feed_in_pieces(text, 3)
+
+    assert [record for batch in emitted for record in batch] == [json.loads(text)]
+    assert parser.close() == []
+
+
+@pytest.mark.parametrize("text, key, column", [
+    ('{"tags": ["a", "b"], "items": [{"x": 1}]}', "tags", 2),
+    ('{"items": [{"x": 1}], "count": 3}', "count", 23),
+    ('{"it\\u0065ms": [1], "b": [2]}', "b", 21),
+])
+def test_keys_outside_the_records_array_are_an_error(text, key, column):
+    parser = pygemai.IncrementalJSONParser("items")
+
+    with pytest.raises(pygemai.JSONStreamError) as error:
+        parser.feed(text)
+
+    assert f"Clave '{key}'" in error.value.message
+    assert (error.value.line, error.value.column) == (1, column)
+
+
+def test_records_key_comes_from_a_single_array_property_in_the_schema():
+    items = {"type": "array", "items": {"type": "object"}}
+
+    assert pygemai.json_records_key({"response_schema": {"type": "object", "properties": {"items": items}}}) == "items"
+    assert pygemai.json_records_key({"response_schema": {"type": "OBJECT", "properties": {"filas": items}}}) == "filas"
+    assert pygemai.json_records_key({"response_schema": {"type": "object", "properties": {
+        "count": {"type": "integer"}, "items": items}}}) is None
+    assert pygemai.json_records_key({"response_schema": items}) is None
+    assert pygemai.json_records_key({"response_mime_type": "application/json"}) is None
+    assert pygemai.json_records_key(None) is None
+
+
+def test_document_without_array_is_a_single_record():
+    parser = pygemai.IncrementalJSONParser()
+    assert parser.feed('{"ok": true, "n": {"x": 1}}') == [{"ok": True, "n": {"x": 1}}]
+
+    scalar = pygemai.IncrementalJSONParser()
+    assert scalar.feed("42") == []
+    assert scalar.close() == [42]
+
+
+def test_empty_array_has_no_records():
+    parser = pygemai.IncrementalJSONParser()
+    assert parser.feed("[]") == []
+    assert parser.close() == []
+
+
+@pytest.mark.parametrize("text, message, line, column", [
+    ('[\n  {"a": 1},\n  {"b": 2}', "falta cerrar '['", 1, 1),
+    ('[{"a": 1}, {"b": "sin cerrar', "cadena sin cerrar", 1, 18),
+    ("", "Respuesta vacía", 1, 1),
+])
+def test_truncated_output_reports_what_is_still_open(text, message, line, column):
+    parser = pygemai.IncrementalJSONParser()
+    parser.feed(text)
+
+    with pytest.raises(pygemai.JSONStreamError) as error:
+        parser.close()
+
+    assert message in error.value.message
+    assert (error.value.line, error.value.column) == (line, column)
+
+
+@pytest.mark.parametrize("text, message, line, column", [
+    ('[{"a": 1},\n {"b": tru}]', "Registro 2 inválido", 2, 8),
+    ('[{"a": 1}, , {"b": 2}]', "Falta un valor", 1, 12),
+    ('[{"a": 1]', "']' inesperado", 1, 9),
+    ('{"a": 1} x', "Contenido inesperado", 1, 10),
+])
+def test_invalid_output_reports_exact_position(text, message, line, column):
+    parser = pygemai.IncrementalJSONParser()
+
+    with pytest.raises(pygemai.JSONStreamError) as error:
+        parser.feed(text)
+
+    assert message in error.value.message
+    assert (error.value.line, error.value.column) == (line, column)
@@ -0,0 +1,65 @@
+import os
+
+from pygemai_cli import main as pygemai
+
+# Coste mínimo para que las pruebas no tarden lo que un desbloqueo real
+FAST_PBKDF2 = {"kdf": "pbkdf2-sha256", "iterations": 1000}
+FAST_SCRYPT = {"kdf": "scrypt", "n": 2 ** 4, "r": 8, "p": 1}
+
+
+def write_legacy_key_file(api_key, password):
+    """Archivo de clave anterior a la cabecera versionada: salt || token, PBKDF2 con ITERATIONS."""
+    salt = os.urandom(pygemai.SALT_SIZE)
+    token = pygemai.Fernet(pygemai._derive_key(password, salt)).encrypt(api_key.encode())
+    with open(pygemai.data_path(pygemai.ENCRYPTED_API_KEY_FILE), "wb") as f:
+        f.write(salt + token)
+
+
+def test_legacy_key_file_is_upgraded_to_v2_on_load(theme_manager):
+    write_legacy_key_file("AIza-legacy", "secreto")
+    assert pygemai._read_key_file()[3] is True
+
+    assert pygemai.load_decrypted_api_keys("secreto", theme_manager) == {"default": "AIza-legacy"}
+
+    kdf_params, salt, _, is_legacy = pygemai._read_key_file()
+    assert is_legacy is False
+    assert kdf_params == pygemai.DEFAULT_KDF_PARAMS  # Mismo coste KDF que el archivo antiguo
+    assert len(salt) == pygemai.SALT_SIZE
+    with open(pygemai.data_path(pygemai.ENCRYPTED_API_KEY_FILE), "rb") as f:
+        assert f.read().startswith(pygemai.KEY_FILE_MAGIC + bytes([pygemai.KEY_FILE_VERSION]))
+    assert pygemai.load_decrypted_api_key("secreto", theme_manager) == "AIza-legacy"
+
+
+def test_wrong_password_does_not_upgrade_legacy_file(theme_manager):
+    write_legacy_key_file("AIza-legacy", "secreto")
+
+    assert pygemai.load_decrypted_api_keys("otra", theme_manager) is None
+    assert pygemai._read_key_file()[3] is True
+
+
+def test_v2_file_round_trips_kdf_params_and_key_sets(theme_manager):
+    keys = {"default": "AIza-1", "batch": "AIza-2"}
+    for kdf_params in (FAST_PBKDF2, FAST_SCRYPT):
+        pygemai.save_encrypted_api_keys(keys, "secreto", theme_manager, kdf_params)
+
+        assert pygemai._read_key_file()[0] == kdf_params
+        assert pygemai.load_decrypted_api_keys("secreto", theme_manager) == keys
+
+
+def test_saving_keeps_previous_calibration(theme_manager):
+    pygemai.save_encrypted_api_key("AIza-1", "secreto", theme_manager, FAST_SCRYPT)
+    pygemai.save_encrypted_api_keys({"default": "AIza-1", "otra": "AIza-2"}, "secreto", theme_manager)
+
+    assert pygemai._read_key_file()[0] == FAST_SCRYPT
+
+
+def test_unknown_key_file_version_is_rejected(theme_manager):
+    pygemai.save_encrypted_api_key("AIza-1", "secreto", theme_manager, FAST_PBKDF2)
+    path = pygemai.data_path(pygemai.ENCRYPTED_API_KEY_FILE)
+    with open(path, "rb") as f:
+        data = bytearray(f.read())
+    data[len(pygemai.KEY_FILE_MAGIC)] = pygemai.KEY_FILE_VERSION + 1
+    with open(path, "wb") as f:
+        f.write(data)
+
+    assert pygemai.load_decrypted_api_keys("secreto", theme_manager) is None
@@ -0,0 +1,66 @@
+import json
+import os
+
+from pygemai_cli import main as pygemai
+
+KEYS = {"a": "AIza-a", "b": "AIza-b"}
+
+
+def state_file():
+    return pygemai.data_path("metrics", pygemai.KEY_POOL_STATE_FILE)
+
+
+def test_acquire_does_not_write_until_flush():
+    pool = pygemai.KeyPool(KEYS)
+    assert [pool.acquire()[0] for _ in range(3)] == ["a", "b", "a"]
+    assert not os.path.exists(state_file())
+
+    pool.flush()
+    with open(state_file()) as f:
+        state = json.load(f)
+    assert state["keys"]["a"]["requests"] == 2
+    assert state["next"] == 1
+    assert not os.path.exists(state_file() + ".tmp")
+
+    os.remove(state_file())
+    pool.flush()  # Sin cambios desde la última escritura
+    assert not os.path.exists(state_file())
+
+
+def test_round_robin_continues_across_runs():
+    pool = pygemai.KeyPool(KEYS)
+    pool.acquire()
+    pool.flush()
+    assert pygemai.KeyPool(KEYS).acquire()[0] == "b"
+
+
+def test_throttled_key_is_saved_at_once_and_sidelined():
+    pool = pygemai.KeyPool(KEYS)
+    pool.report_throttled("a")
+    with open(state_file()) as f:
+        assert json.load(f)["keys"]["a"]["throttles"] == 1
+
+    other_run = pygemai.KeyPool(KEYS)
+    assert [other_run.acquire()[0] for _ in range(2)] == ["b", "b"]
+
+
+def test_state_file_without_keys_is_accepted():
+    with open(state_file(), "w") as f:
+        json.dump({"next": 1}, f)
+    pool = pygemai.KeyPool(KEYS)
+    assert pool.acquire()[0] == "b"
+    assert set(pool.stats()) == {"a", "b"}
+
+
+def test_generate_content_with_another_key_restores_the_configured_one(monkeypatch):
+    configured = []
+    monkeypatch.setattr(pygemai.genai, "configure", lambda api_key: configured.append(api_key))
+
+    class FakeModel:
+        def generate_content(self, contents, stream=False):
+            return configured[-1]
+
+    pool = pygemai.KeyPool(KEYS)
+    pool.configure("a")
+    assert pool.generate_content("b", FakeModel(), ["hola"], stream=True) == "AIza-b"
+    assert configured == ["AIza-a", "AIza-b", "AIza-a"]
@@ -0,0 +1,85 @@
+import pytest
+
+from pygemai_cli import main as pygemai
+
+MODELS = {"flash": "models/gemini-1.5-flash", "pro": "models/gemini-1.5-pro"}
+
+
+@pytest.fixture
+def stats(tmp_path):
+    return pygemai.ModelStats(str(tmp_path / "model_stats.json"))
+
+
+def record(stats, alias, first_chunk_ms, ok=True, times=pygemai.ROUTER_MIN_SAMPLES):
+    for _ in range(times):
+        stats.record(MODELS[alias], first_chunk_ms, ok)
+
+
+def make_router(stats, **settings):
+    return pygemai.ModelRouter(dict({"models": MODELS}, **settings), stats)
+
+
+def test_first_matching_rule_wins(stats):
+    router = make_router(stats, default="flash", rules=[
+        {"when": "attachment", "use": "pro"},
+        {"when": "code", "use": "pro"},
+        {"when": "tokens_over", "value": 100, "use": "pro"},
+    ])
+
+    assert router.choose("hola") == (MODELS["flash"], "modelo por defecto")
+    assert router.choose("revisa\n```py\nx = 1\n```") == (MODELS["pro"], "el prompt contiene bloques de código")
+    assert router.choose("hola", has_attachments=True) == (MODELS["pro"], "el prompt lleva adjuntos")
+    model, reason = router.choose("palabra " * 100)
+    assert model == MODELS["pro"] and reason.startswith("prompt largo")
+
+
+def test_fastest_default_uses_observed_p50(stats):
+    router = make_router(stats, default="fastest")
+    record(stats, "flash", 300)
+    record(stats, "pro", 900)
+
+    assert router.choose("hola") == (MODELS["flash"], "menor latencia observada")
+    record(stats, "flash", 2000, times=pygemai.MODEL_STATS_WINDOW)
+    assert router.choose("hola")[0] == MODELS["pro"]
+
+
+def test_failing_model_is_replaced_by_a_healthy_one(stats):
+    router = make_router(stats, default="pro", max_error_rate=0.5)
+    record(stats, "pro", None, ok=False, times=pygemai.ROUTER_MIN_SAMPLES - 1)
+    assert router.choose("hola")[0] == MODELS["pro"]  # Pocas muestras: aún no se juzga
+
+    record(stats, "pro", None, ok=False, times=1)
+    record(stats, "flash", 400)
+    model, reason = router.choose("hola")
+    assert model == MODELS["flash"]
+    assert reason == "pro falla (100% de errores recientes)"
+
+
+def test_stats_keep_a_window_and_persist(stats, tmp_path):
+    stats.window = 3
+    for ms in (100, 200, 300, 400):
+        stats.record(MODELS["flash"], ms, True)
+    stats.record(MODELS["flash"], None, False)
+
+    summary = pygemai.ModelStats(str(tmp_path / "model_stats.json"), window=3).summary(MODELS["flash"])
+    assert summary["count"] == 3
+    assert summary["error_rate"] == pytest.approx(1 / 3)
+    assert (summary["p50_ms"], summary["p95_ms"]) == (400, 400)
+
+
+@pytest.mark.parametrize("settings", [
+    {"models": {}},
+    {"models": MODELS, "default": "ultra"},
+    {"models": MODELS, "rules": [{"when": "siempre", "use": "pro"}]},
+    {"models": MODELS, "rules": [{"when": "code", "use": "ultra"}]},
+])
+def test_invalid_settings_are_rejected(stats, settings):
+    with pytest.raises(ValueError):
+        pygemai.ModelRouter(settings, stats)
+
+
+def test_model_list_is_aliased_by_short_name(stats):
+    router = pygemai.ModelRouter({"models": list(MODELS.values())}, stats)
+
+    assert router.models == {"gemini-1.5-flash": MODELS["flash"], "gemini-1.5-pro": MODELS["pro"]}
+    assert pygemai.ModelRouter.for_profile({"profile_name": "P"}) is None
@@ -0,0 +1,55 @@
+import array
+import multiprocessing
+
+import pytest
+
+from pygemai_cli import main as pygemai
+
+PROMPTS_PER_WRITER = 300
+
+
+def append_prompts(path, tag):
+    history = pygemai.PromptHistory(path)
+    for n in range(PROMPTS_PER_WRITER):
+        history.append(f"{tag} {n} " + "x" * (n % 97) + "\nsegunda línea")
+
+
+def reopen_repeatedly(path):
+    for _ in range(50):
+        len(pygemai.PromptHistory(path))  # Abrir también puede reparar el índice
+
+
+def test_append_and_get_round_trip(tmp_path):
+    history = pygemai.PromptHistory(str(tmp_path / "prompts.jsonl"))
+    for text in ("primero", "con\nsalto", "último"):
+        history.append(text)
+
+    reopened = pygemai.PromptHistory(str(tmp_path / "prompts.jsonl"))
+    assert [reopened.get(i) for i in range(len(reopened))] == ["primero", "con\nsalto", "último"]
+    assert reopened.search("salto", len(reopened)) == 1
+
+
+@pytest.mark.skipif(pygemai.fcntl is None or "fork" not in multiprocessing.get_all_start_methods(),
+                    reason="El bloqueo entre sesiones necesita fcntl")
+def test_concurrent_sessions_never_lose_or_mix_prompts(tmp_path):
+    path = str(tmp_path / "prompts.jsonl")
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=append_prompts, args=(path, tag)) for tag in "AB"]
+    processes.append(context.Process(target=reopen_repeatedly, args=(path,)))
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+
+    history = pygemai.PromptHistory(path)
+    texts = [history.get(i) for i in range(len(history))]
+    assert len(texts) == 2 * PROMPTS_PER_WRITER
+    for tag in "AB":
+        own = [t for t in texts if t.startswith(tag + " ")]
+        assert own == [f"{tag} {n} " + "x" * (n % 97) + "\nsegunda línea" for n in range(PROMPTS_PER_WRITER)]
+
+    index = array.array("q")
+    with open(path[:-len(".jsonl")] + ".idx", "rb") as f:
+        index.frombytes(f.read())
+    assert list(index) == list(history._offsets)  # El índice en disco coincide con el archivo
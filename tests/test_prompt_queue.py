@@ -0,0 +1,178 @@
+import os
+import threading
+import time
+
+import pytest
+
+from pygemai_cli import main as pygemai
+
+
+def user_message(text):
+    return pygemai.content_types.to_contents([{"role": "user", "parts": [{"text": text}]}])
+
+
+def enqueue(prompt_queue, text="hola"):
+    return prompt_queue.enqueue("models/gemini-pro", user_message(text),
+                                pygemai.get_chat_history_filename("models/gemini-pro"), "Default")
+
+
+def answer(text):
+    return pygemai.generation_types.GenerateContentResponse.from_response(pygemai.genai.protos.GenerateContentResponse(
+        candidates=[{"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}]))
+
+
+class FakeQueuedModel:
+    """Sustituye a _queued_model: cuenta las peticiones y responde (o falla) sin red."""
+
+    def __init__(self, error=None, delay=0.0):
+        self.error = error
+        self.delay = delay
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, item):
+        return self
+
+    def generate_content(self, contents, request_options=None):
+        with self._lock:
+            self.calls.append(pygemai._first_user_text(contents[-1]))
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return answer("respuesta a " + pygemai._first_user_text(contents[-1]))
+
+
+def age_lock(prompt_queue, item_id, seconds):
+    old = time.time() - seconds
+    os.utime(prompt_queue._lock_path(item_id), (old, old))
+
+
+def test_only_one_drainer_claims_an_item():
+    item = enqueue(pygemai.PromptQueue())
+    other_session = pygemai.PromptQueue()  # Otra sesión con el mismo directorio de datos
+
+    results = []
+    barrier = threading.Barrier(8)
+
+    def claim(prompt_queue):
+        barrier.wait()
+        results.append(prompt_queue.claim(item["id"]))
+    threads = [threading.Thread(target=claim, args=(q,)) for q in [pygemai.PromptQueue(), other_session] * 4]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(results) == [False] * 7 + [True]
+    assert [i["state"] for i in other_session.pending()] == ["enviando"]
+
+
+def test_stale_lock_of_a_dead_process_is_recovered():
+    prompt_queue = pygemai.PromptQueue()
+    item = enqueue(prompt_queue)
+    assert prompt_queue.claim(item["id"])
+
+    age_lock(prompt_queue, item["id"], pygemai.QUEUE_LOCK_STALE_SECONDS - 60)
+    assert not pygemai.PromptQueue().claim(item["id"])  # Reserva viva: no se roba
+
+    age_lock(prompt_queue, item["id"], pygemai.QUEUE_LOCK_STALE_SECONDS + 60)
+    assert [i["state"] for i in prompt_queue.pending()] == ["pendiente"]
+    assert pygemai.PromptQueue().claim(item["id"])
+    assert not prompt_queue.claim(item["id"])  # La nueva reserva es válida
+    assert sorted(os.listdir(prompt_queue.pending_dir)) == sorted(
+        f"{item['id']}{extension}" for extension in (".json", ".pb", ".lock"))  # Sin restos apartados
+
+
+def test_reschedule_backs_off_exponentially_and_releases_the_claim(monkeypatch):
+    monkeypatch.setattr(pygemai.random, "random", lambda: 1.0)  # Sin azar: espera completa
+    prompt_queue = pygemai.PromptQueue()
+    item = enqueue(prompt_queue)
+
+    waits = []
+    for _ in range(8):
+        assert prompt_queue.claim(item["id"])
+        before = time.time()
+        prompt_queue.reschedule(item, ConnectionError("sin red"))
+        item = prompt_queue.pending()[0]
+        waits.append(round(item["next_attempt"] - before))
+    base = pygemai.QUEUE_BASE_BACKOFF_SECONDS
+    assert waits[:3] == [base, 2 * base, 4 * base]
+    assert waits[-1] == pygemai.QUEUE_MAX_BACKOFF_SECONDS
+    assert item["attempts"] == 8 and item["last_error"] == "sin red"
+    assert item["state"] == "pendiente"
+
+
+def test_answered_item_is_not_sent_again_after_a_crash():
+    prompt_queue = pygemai.PromptQueue()
+    item = enqueue(prompt_queue)
+    # Corte justo después de guardar la respuesta y antes de sacar el prompt de la cola
+    os.makedirs(prompt_queue.done_dir, exist_ok=True)
+    prompt_queue._write_json(os.path.join(prompt_queue.done_dir, f"{item['id']}.json"),
+                             dict(item, status="ok", applied=False))
+
+    assert prompt_queue.pending() == []
+    assert os.listdir(prompt_queue.pending_dir) == []
+
+
+def test_half_enqueued_item_is_ignored():
+    prompt_queue = pygemai.PromptQueue()
+    item = enqueue(prompt_queue)
+    os.remove(os.path.join(prompt_queue.pending_dir, f"{item['id']}.json"))  # Corte antes de los metadatos
+    assert prompt_queue.pending() == []
+
+
+def test_drain_sends_each_item_once_and_appends_the_answer(monkeypatch):
+    model = FakeQueuedModel(delay=0.05)
+    monkeypatch.setattr(pygemai, "_queued_model", model)
+    monkeypatch.setattr(pygemai.usage_ledger, "record", lambda *args, **kwargs: None)
+    for n in range(4):
+        enqueue(pygemai.PromptQueue(), f"prompt {n}")
+
+    counts = []
+    drainers = [threading.Thread(target=lambda: counts.append(pygemai.QueueDrainer(pygemai.PromptQueue()).drain()))
+                for _ in range(2)]
+    for thread in drainers:
+        thread.start()
+    for thread in drainers:
+        thread.join()
+
+    assert sorted(model.calls) == [f"prompt {n}" for n in range(4)]
+    assert sum(c["ok"] for c in counts) == 4
+    prompt_queue = pygemai.PromptQueue()
+    assert prompt_queue.pending() == [] and prompt_queue.undelivered() == []
+    history = pygemai._read_history_json(pygemai.get_chat_history_filename("models/gemini-pro"))
+    assert sorted(m["parts"][0]["text"] for m in history if m["role"] == "model") == \
+        [f"respuesta a prompt {n}" for n in range(4)]
+
+
+@pytest.mark.parametrize("error, outcome", [(ConnectionError("sin red"), "retry"), (ValueError("petición inválida"), "error")])
+def test_drain_retries_only_connectivity_errors(monkeypatch, error, outcome):
+    monkeypatch.setattr(pygemai, "_queued_model", FakeQueuedModel(error=error))
+    prompt_queue = pygemai.PromptQueue()
+    item = enqueue(prompt_queue)
+
+    assert pygemai.QueueDrainer(prompt_queue).drain()[outcome] == 1
+    if outcome == "retry":
+        pending = prompt_queue.pending()
+        assert [(i["id"], i["attempts"], i["state"]) for i in pending] == [(item["id"], 1, "pendiente")]
+    else:
+        assert prompt_queue.pending() == []
+        assert [(r["status"], r["error"]) for r in prompt_queue.results()] == [("error", "petición inválida")]
+
+
+def test_an_answer_is_applied_by_one_session_only(monkeypatch):
+    monkeypatch.setattr(pygemai, "_queued_model", FakeQueuedModel())
+    prompt_queue = pygemai.PromptQueue()
+    item = enqueue(prompt_queue)
+    delivered = []
+    pygemai.QueueDrainer(prompt_queue, deliver=lambda result: delivered.append(result) or True).drain()
+    assert [r["id"] for r in delivered] == [item["id"]]
+
+    # Otra sesión ve la respuesta sin aplicar, pero la primera la tiene reservada hasta mostrarla
+    other = pygemai.QueueDrainer(pygemai.PromptQueue())
+    other._apply_results()
+    assert not os.path.exists(pygemai.get_chat_history_filename("models/gemini-pro"))
+
+    prompt_queue.mark_applied(item["id"])
+    assert prompt_queue.undelivered() == []
+    assert not prompt_queue.claim_result(item["id"])
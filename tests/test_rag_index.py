@@ -0,0 +1,101 @@
+import pytest
+
+from pygemai_cli import main as pygemai
+
+np = pytest.importorskip("numpy")
+
+DOCS = {
+    "instalacion.md": "Para instalar PyGemAi usa pip install PyGemAi en un entorno virtual.",
+    "claves.md": "La API Key se guarda encriptada con una contraseña y PBKDF2 o scrypt.",
+    "temas.txt": "Los temas de color cambian los colores del prompt y de las respuestas.",
+}
+
+
+@pytest.fixture(autouse=True)
+def no_network(monkeypatch):
+    """El embedder local nunca debe llamar a la API."""
+    def embed_content(**kwargs):
+        raise AssertionError("embed_content llamado con el embedder local")
+    monkeypatch.setattr(pygemai.genai, "embed_content", embed_content)
+
+
+@pytest.fixture
+def docs(tmp_path):
+    source = tmp_path / "docs"
+    source.mkdir()
+    for name, text in DOCS.items():
+        (source / name).write_text(text, encoding="utf-8")
+    (source / "imagen.png").write_bytes(b"\x89PNG")  # No es texto: no se indexa
+    return source
+
+
+def build(source, index_dir, theme_manager):
+    return pygemai.build_rag_index(str(source), str(index_dir), pygemai.LOCAL_EMBEDDER, theme_manager)
+
+
+def test_local_embedder_is_deterministic_and_normalized():
+    texts = ["hola mundo", "Hola, MUNDO", "otra cosa distinta"]
+
+    raw = pygemai._local_embed_texts(texts)
+    vectors = pygemai.embed_texts(texts, pygemai.LOCAL_EMBEDDER, "retrieval_document")
+
+    assert raw.shape == (3, pygemai.LOCAL_EMBEDDING_DIM)
+    assert np.array_equal(raw[0], raw[1])  # Mismas palabras, sin importar mayúsculas ni puntuación
+    assert np.array_equal(raw, pygemai._local_embed_texts(texts))
+    assert np.allclose(np.linalg.norm(vectors, axis=1), 1.0)
+
+
+def test_rebuild_only_embeds_changed_files(docs, tmp_path, theme_manager):
+    index_dir = tmp_path / "index"
+    assert build(docs, index_dir, theme_manager) == {"reused": 0, "embedded": 3, "removed": 0, "chunks": 3}
+    first_vectors = np.load(index_dir / pygemai.RAG_VECTORS_FILE)
+
+    assert build(docs, index_dir, theme_manager) == {"reused": 3, "embedded": 0, "removed": 0, "chunks": 3}
+    assert np.array_equal(np.load(index_dir / pygemai.RAG_VECTORS_FILE), first_vectors)
+
+    (docs / "temas.txt").write_text("Los temas ahora incluyen un modo de alto contraste.", encoding="utf-8")
+    (docs / "claves.md").unlink()
+    stats = build(docs, index_dir, theme_manager)
+
+    assert stats == {"reused": 1, "embedded": 1, "removed": 1, "chunks": 2}
+    index = pygemai.RetrievalIndex(str(index_dir))
+    assert [chunk["file"] for chunk in index.chunks] == ["instalacion.md", "temas.txt"]
+    assert "alto contraste" in index.chunks[1]["text"]
+
+
+def test_search_returns_top_k_by_similarity(docs, tmp_path, theme_manager):
+    build(docs, tmp_path / "index", theme_manager)
+    index = pygemai.RetrievalIndex(str(tmp_path / "index"))
+
+    results = index.search("¿cómo se guarda la API Key encriptada?", top_k=2, min_score=-1.0)
+
+    assert len(results) == 2
+    assert results[0]["file"] == "claves.md"
+    assert results[0]["score"] >= results[1]["score"]
+    assert index.search("¿cómo se guarda la API Key encriptada?", top_k=10, min_score=-1.0)[0]["file"] == "claves.md"
+    assert index.search("xyzzy", top_k=3, min_score=0.5) == []
+
+
+def test_large_files_are_chunked_with_line_numbers(tmp_path, theme_manager):
+    source = tmp_path / "docs"
+    source.mkdir()
+    lines = [f"línea {n} " + "texto " * 20 for n in range(200)]
+    (source / "largo.md").write_text("\n".join(lines), encoding="utf-8")
+
+    stats = build(source, tmp_path / "index", theme_manager)
+
+    chunks = pygemai.RetrievalIndex(str(tmp_path / "index")).chunks
+    assert stats["chunks"] == len(chunks) > 1
+    assert all(len(chunk["text"]) <= pygemai.RAG_CHUNK_CHARS for chunk in chunks)
+    assert chunks[0]["line"] == 1
+    assert chunks[1]["text"].startswith(lines[chunks[1]["line"] - 1].strip())
+
+
+def test_augment_prompt_with_retrieval_cites_file_and_line():
+    retrieved = [{"file": "claves.md", "line": 3, "text": "La API Key se guarda encriptada."}]
+
+    prompt = pygemai.augment_prompt_with_retrieval("¿Dónde está la clave?", retrieved)
+
+    assert "[1] claves.md (línea 3):\nLa API Key se guarda encriptada." in prompt
+    assert prompt.endswith("¿Dónde está la clave?")
+    assert pygemai.augment_prompt_with_retrieval("hola", []) == "hola"
@@ -0,0 +1,73 @@
+import pytest
+
+from pygemai_cli import main as pygemai
+
+pytest.importorskip("numpy")
+
+
+def make_cache(tmp_path, threshold=0.9, capacity=10, embedder=pygemai.LOCAL_EMBEDDER):
+    return pygemai.SemanticCache(str(tmp_path / "semantic"), embedder, threshold, capacity)
+
+
+def remember(cache, prompt, answer):
+    cache.store(prompt, cache.embed(prompt), answer)
+
+
+def test_lookup_hits_only_above_threshold(tmp_path):
+    cache = make_cache(tmp_path, threshold=0.9)
+    remember(cache, "cómo instalo pygemai en linux", "Con pip install PyGemAi.")
+
+    entry, score = cache.lookup(cache.embed("Cómo instalo PyGemAi en Linux?"))
+    assert entry["answer"] == "Con pip install PyGemAi."
+    assert score == pytest.approx(1.0)
+    assert entry["hits"] == 1
+
+    assert cache.lookup(cache.embed("cómo instalo pygemai en windows con conda")) is None
+
+
+def test_full_cache_evicts_least_recently_used(tmp_path):
+    cache = make_cache(tmp_path, capacity=2)
+    remember(cache, "primera pregunta sobre temas", "uno")
+    remember(cache, "segunda pregunta sobre claves", "dos")
+    cache.entries[0]["last_used"] = cache.entries[1]["last_used"] + 10  # La primera se usó después
+
+    remember(cache, "tercera pregunta sobre historial", "tres")
+
+    assert sorted(entry["answer"] for entry in cache.entries) == ["tres", "uno"]
+    assert cache.lookup(cache.embed("segunda pregunta sobre claves")) is None
+    assert cache.lookup(cache.embed("tercera pregunta sobre historial"))[0]["answer"] == "tres"
+
+
+def test_entries_persist_per_embedder(tmp_path):
+    remember(make_cache(tmp_path), "pregunta guardada en disco", "respuesta")
+
+    reopened = make_cache(tmp_path)
+    assert reopened.lookup(reopened.embed("pregunta guardada en disco"))[0]["answer"] == "respuesta"
+    assert make_cache(tmp_path, embedder="models/otro").entries == []  # Vectores de otro modelo: incompatibles
+
+
+def test_for_profile_separates_caches_by_model_and_system_prompt():
+    profile = {"profile_name": "P", "system_prompt": "Eres breve.",
+               "semantic_cache": {"enabled": True, "embedder": pygemai.LOCAL_EMBEDDER, "threshold": 0.8,
+                                  "capacity": 5, "history_independent": True}}
+
+    cache = pygemai.SemanticCache.for_profile(profile, "models/a")
+
+    assert (cache.threshold, cache.capacity, cache.history_independent) == (0.8, 5, True)
+    assert cache.cache_dir != pygemai.SemanticCache.for_profile(profile, "models/b").cache_dir
+    assert cache.cache_dir != pygemai.SemanticCache.for_profile(
+        dict(profile, system_prompt="Eres detallista."), "models/a").cache_dir
+    assert pygemai.SemanticCache.for_profile({"profile_name": "P"}, "models/a") is None
+
+
+def test_hits_are_saved_on_flush_not_on_lookup(tmp_path):
+    cache = make_cache(tmp_path)
+    remember(cache, "pregunta repetida muchas veces", "respuesta")
+    entries_path = tmp_path / "semantic" / "entries.json"
+    saved = entries_path.read_text()
+
+    cache.lookup(cache.embed("pregunta repetida muchas veces"))
+    assert entries_path.read_text() == saved  # El acierto no escribe en disco
+
+    cache.flush()
+    assert make_cache(tmp_path).entries[0]["hits"] == 1
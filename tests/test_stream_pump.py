@@ -0,0 +1,122 @@
+import queue
+import threading
+import time
+
+from pygemai_cli import main as pygemai
+
+
+def chunk(text):
+    return pygemai.genai.protos.GenerateContentResponse(
+        candidates=[{"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}])
+
+
+class FakeStreamModel:
+    """
+    Modelo sin red: cada petición sigue un guion (segundos hasta cada chunk, texto). Como el SDK,
+    generate_content(stream=True) no vuelve hasta recibir el primer chunk. Anota qué streams se cerraron.
+    """
+
+    model_name = "models/gemini-pro"
+
+    def __init__(self, *scripts):
+        self.scripts = list(scripts)
+        self.requests = 0
+        self.closed = []
+        self._lock = threading.Lock()
+
+    def generate_content(self, contents, stream=True):
+        with self._lock:
+            number = self.requests
+            self.requests += 1
+        script = self.scripts[min(number, len(self.scripts) - 1)]
+
+        def connection():
+            try:
+                for delay, text in script:
+                    time.sleep(delay)
+                    yield chunk(text)
+            finally:
+                self.closed.append(number)
+        return pygemai.generation_types.GenerateContentResponse.from_iterator(connection())
+
+
+def make_session(theme_manager, model, **policy):
+    chat = pygemai.genai.GenerativeModel(model.model_name).start_chat(history=[])
+    session = pygemai.ChatSessionState(theme_manager, pygemai.SessionProfiler(), model.model_name, model, chat,
+                                       pygemai.get_chat_history_filename(model.model_name), turn_policy=policy)
+    session.record_usage = False
+    return session
+
+
+def send(session):
+    contents = pygemai.content_types.to_contents([{"role": "user", "parts": [{"text": "hola"}]}])
+    return pygemai._stream_turn_attempt(session, session.model, contents)
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_pump_delivers_chunks_then_end():
+    events = queue.Queue()
+    model = FakeStreamModel([(0, "uno"), (0, "dos")])
+    pump = pygemai.StreamPump(lambda: model.generate_content([], stream=True), events).start()
+
+    received = [pump.get(timeout=2) for _ in range(3)]
+    assert [(source, kind) for source, kind, _ in received] == [(pump, "chunk"), (pump, "chunk"), (pump, "end")]
+    assert [pygemai._chunk_text(value) for _, kind, value in received if kind == "chunk"] == ["uno", "dos"]
+
+
+def test_cancel_before_the_first_chunk_closes_the_stream_and_stays_silent():
+    events = queue.Queue()
+    model = FakeStreamModel([(0.2, "tarde"), (0, "más")])
+    pump = pygemai.StreamPump(lambda: model.generate_content([], stream=True), events).start()
+    pump.cancel()
+
+    assert wait_until(lambda: model.closed == [0])
+    assert events.empty()  # Un stream cancelado no entrega nada
+
+
+def test_hedged_request_wins_and_the_slow_one_is_cancelled(theme_manager, capsys):
+    model = FakeStreamModel([(0.6, "lenta")], [(0, "rápida"), (0, " y completa")])
+    session = make_session(theme_manager, model, hedge_after_ms=50)
+
+    started = time.monotonic()
+    outcome = send(session)
+
+    assert outcome.status == "ok" and outcome.text == "rápida y completa"
+    assert time.monotonic() - started < 0.5  # No esperó a la petición lenta
+    assert model.requests == 2
+    assert wait_until(lambda: 0 in model.closed)  # La perdedora se cierra en cuanto llega su primer chunk
+    assert "lenta" not in capsys.readouterr().out
+
+
+def test_no_hedge_when_the_first_chunk_is_on_time(theme_manager, capsys):
+    model = FakeStreamModel([(0, "a tiempo")])
+    session = make_session(theme_manager, model, hedge_after_ms=300)
+
+    assert send(session).text == "a tiempo"
+    assert model.requests == 1
+
+
+def test_first_chunk_deadline_cancels_the_request(theme_manager, capsys):
+    model = FakeStreamModel([(0.6, "demasiado tarde")])
+    session = make_session(theme_manager, model, first_chunk_timeout_seconds=0.1)
+
+    started = time.monotonic()
+    assert send(session).status == "first_chunk_timeout"
+    assert time.monotonic() - started < 0.5
+    assert wait_until(lambda: model.closed == [0])
+
+
+def test_turn_deadline_keeps_the_partial_text(theme_manager, capsys):
+    model = FakeStreamModel([(0, "parcial"), (0.6, " nunca llega")])
+    session = make_session(theme_manager, model, turn_timeout_seconds=0.2)
+
+    outcome = send(session)
+    assert outcome.status == "turn_timeout"
+    assert outcome.text == "parcial"
+    assert wait_until(lambda: model.closed == [0])
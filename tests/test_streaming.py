@@ -0,0 +1,76 @@
+import json
+import time
+
+from pygemai_cli import main as pygemai
+
+
+def chunk(text):
+    return pygemai.genai.protos.GenerateContentResponse(
+        candidates=[{"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}])
+
+
+def sdk_stream(texts, pulled):
+    """Respuesta en streaming del SDK sin red; `pulled` anota cada chunk que el SDK pide a la conexión."""
+    def connection():
+        for text in texts:
+            pulled.append(text)
+            yield chunk(text)
+    return pygemai.generation_types.GenerateContentResponse.from_iterator(connection())
+
+
+def test_sdk_still_has_the_stream_internals_we_rely_on():
+    # _iter_stream_chunks, RecordingModel y _close_stream usan estos detalles internos del SDK. Si
+    # una versión nueva los cambia, esta prueba falla en vez de degradarse sin avisar
+    response = sdk_stream(["uno", "dos"], [])
+    assert len(response._chunks) == 1
+    assert response._iterator is not None
+    assert response._done is False
+    assert response._result is not None
+    assert callable(pygemai.generation_types._join_chunks)
+
+
+def test_first_chunk_is_delivered_before_the_next_is_read():
+    pulled = []
+    response = sdk_stream(["Hola", ", ", "mundo"], pulled)
+    stream = pygemai._iter_stream_chunks(response)
+
+    assert pygemai._chunk_text(next(stream)) == "Hola"
+    assert pulled == ["Hola"]  # El SDK habría esperado a ", " antes de entregar "Hola"
+    assert [pygemai._chunk_text(c) for c in stream] == [", ", "mundo"]
+    assert response.text == "Hola, mundo"  # La respuesta agregada no cambia
+
+
+def test_recording_model_records_every_chunk(tmp_path):
+    class FakeModel:
+        model_name = "models/gemini-pro"
+
+        def generate_content(self, contents, stream=False):
+            return sdk_stream(["uno", "dos"], [])
+
+    path = tmp_path / "cassette.jsonl"
+    recorder = pygemai.CassetteRecorder(str(path), "models/gemini-pro")
+    response = recorder.wrap(FakeModel()).generate_content(["hola"], stream=True)
+    assert "".join(pygemai._chunk_text(c) for c in pygemai._iter_stream_chunks(response)) == "unodos"
+    recorder.close()
+
+    request = [json.loads(line) for line in path.read_text().splitlines()][-1]
+    assert request["type"] == "request"
+    assert [c["chunk"]["candidates"][0]["content"]["parts"][0]["text"] for c in request["chunks"]] == ["uno", "dos"]
+
+
+def test_thinking_indicator_hands_the_line_over_on_stop(capsys, theme_manager):
+    indicator = pygemai.ThinkingIndicator()
+    for _ in range(2):
+        indicator.start(theme_manager, "gemini-pro: ")
+        time.sleep(indicator.FRAME_SECONDS * 2)
+        indicator.stop(takeover_text="gemini-pro: ")
+        out = capsys.readouterr().out
+        assert "gemini-pro:  " in out  # Al menos un fotograma de la animación
+        assert out.endswith("\rgemini-pro: ")
+
+        time.sleep(indicator.FRAME_SECONDS * 2)
+        assert capsys.readouterr().out == ""  # Tras stop() no se cuela ningún fotograma
+    first_thread = indicator._thread
+    indicator.start(theme_manager, "gemini-pro: ")
+    indicator.stop()
+    assert indicator._thread is first_thread  # Un solo hilo de dibujo para toda la sesión